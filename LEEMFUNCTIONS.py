@@ -2,7 +2,9 @@ import os
 import numpy as np
 import cv2
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
+import chunkstore
 
 # deprecated
 DEF_IMHEIGHT = 600
@@ -48,7 +50,356 @@ def energy_to_filenumber(el, val):
         return None
 
 
-def process_LEEM_Data(dirname, ht=0, wd=0, bits=None, byte='L'):
+def energy_window(elist, emin=None, emax=None, stride=1):
+    """
+    Select a sub-range of energies, sampled every stride energies, for partial loading
+    File i of a data set corresponds to elist[i], so the returned indices select which files to load
+    :param elist: list of energy values in eV in increasing order, one per data file
+    :param emin: lowest energy to include in eV; default None for the first energy
+    :param emax: highest energy to include in eV; default None for the last energy
+    :param stride: integer step between selected energies; default 1 selects every energy
+    :return (indices, elist_cut): list of integer file indices and the corresponding list of energies
+    """
+    energies = np.asarray(elist, dtype=np.float64)
+    # small tolerance as energies are generated by repeated addition of the step size
+    lo = 0 if emin is None else int(np.searchsorted(energies, emin - 1e-6, side='left'))
+    hi = len(elist) if emax is None else int(np.searchsorted(energies, emax + 1e-6, side='right'))
+    indices = list(range(lo, hi, max(1, int(stride))))
+    return indices, [elist[idx] for idx in indices]
+
+
+def select_files(files, indices=None):
+    """
+    :param files: sorted list of file names
+    :param indices: list of integer indices into files, or None for all files
+    :return: list of selected file names
+    """
+    if indices is None:
+        return files
+    if indices and max(indices) >= len(files):
+        raise ValueError("Energy window selects file {0} but only {1} files were found".format(
+            max(indices), len(files)))
+    return [files[idx] for idx in indices]
+
+
+def raw_format_string(bits=None, byte='L'):
+    """
+    Generate numpy format string for raw data given a bit size and byte order
+    :param bits: integer representing bit depth of image, default is 16 bit
+    :param byte: string representing byte order, 'L' for Little-Endian (Intel), 'B' for Big-Endian (Motorola)
+    :return formatstring: numpy data type string, ex. '<u2' = little endian, unsigned integer, 2 bytes per pixel
+    """
+    if bits is None:
+        bits = 16  # default to 16 bit images
+    if bits not in [8, 16] or byte not in ['L', 'B']:
+        print("Error in process_LEEM_Data() - unknown bit size when loading raw data")
+        print("Check for incorrect bitsize in YAML experiment file")
+        raise ValueError("Invalid bit size {0} or byte order {1} for raw data".format(bits, byte))
+    return {'L': '<', 'B': '>'}[byte] + 'u' + str(int(bits/8))
+
+
+def raw_data_files(dirname):
+    """
+    Sorted list of raw .dat files in a data directory
+    Hidden files beginning with a leading period are excluded
+    :param dirname: string path to current data directory
+    :return files: sorted list of file names
+    """
+    files = [name for name in os.listdir(dirname) if name.endswith('.dat') and not name.startswith(".")]
+    files.sort()
+    return files
+
+
+class MemmapStack(object):
+    """
+    Lazily assembled 3d stack of raw image files
+    Each file is exposed as a 2d np.memmap view offset past its header,
+    thus no pixel data is read from disk until it is indexed.
+    Supports the indexing used throughout the GUI on a (h, w, E) array:
+        stack[:, :, idx] -> 2d image
+        stack[r, c, :] -> 1d I(V) curve
+        stack[r0:r1, c0:c1, :] -> 3d sub-stack
+    np.asarray(stack) assembles the full 3d numpy array in a single pass
+    """
+
+    def __init__(self, frames, ht, wd, dtype):
+        """
+        :param frames: list of 2d np.memmap arrays of shape (ht, wd)
+        :param ht: integer pixel height of image
+        :param wd: integer pixel width of image
+        :param dtype: numpy dtype of the pixel data
+        """
+        self.frames = frames
+        self.dtype = np.dtype(dtype)
+        self.shape = (ht, wd, len(frames))
+        self.ndim = 3
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1] * self.shape[2]
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3 or any(k is Ellipsis for k in key):
+            raise IndexError("MemmapStack supports at most three explicit indices")
+        rows, cols, energies = key + (slice(None),) * (3 - len(key))
+
+        if isinstance(energies, (int, np.integer)):
+            return np.array(self.frames[energies][rows, cols])
+
+        indices = np.arange(self.shape[2])[energies]
+        first = self.frames[indices[0]][rows, cols] if indices.size else self.frames[0][rows, cols]
+        out = np.empty(np.shape(first) + (indices.size,), dtype=self.dtype)
+        for k, idx in enumerate(indices):
+            out[..., k] = self.frames[idx][rows, cols]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :, :]
+        if dtype is not None:
+            return out.astype(dtype)
+        return out
+
+    def byteswap(self):
+        """
+        Return a new MemmapStack interpreting the same files with the opposite byte order
+        No data is copied or read from disk
+        """
+        dtype = self.dtype.newbyteorder()
+        return MemmapStack([fr.view(dtype) for fr in self.frames],
+                           self.shape[0], self.shape[1], dtype)
+
+
+def memmap_LEEM_Data(dirname, ht=0, wd=0, bits=None, byte='L', files=None):
+    """
+    Memory map all .dat files in current data directory
+    The header length of each file is calculated from its size on disk
+    via os.stat() so file contents are never read during loading
+
+    :argument dirname: string path to current data directory
+    :param ht: integer pixel height of image
+    :param wd: integer pixel width of image
+    :param bits: integer representing bit depth of image, default is 16 bit
+    :param byte: string representing byte order, 'L' for Little-Endian (Intel), 'B' for Big-Endian (Motorola)
+    :param files: optional list of file names to map; defaults to all .dat files in dirname
+    :return MemmapStack: lazily assembled 3d stack with shape (ht, wd, num files)
+    """
+    formatstring = raw_format_string(bits, byte)
+    if ht == 0 and wd == 0:
+        ht = DEF_IMHEIGHT
+        wd = DEF_IMWIDTH
+    if files is None:
+        files = raw_data_files(dirname)
+    frame_bytes = np.dtype(formatstring).itemsize * ht * wd
+
+    frames = []
+    for fl in files:
+        path = os.path.join(dirname, fl)
+        hdln = os.stat(path).st_size - frame_bytes
+        if hdln < 0:
+            raise ValueError("File {0} is smaller than one {1}x{2} image".format(fl, ht, wd))
+        frames.append(np.memmap(path, dtype=formatstring, mode='r',
+                                offset=hdln, shape=(ht, wd)))
+    if frames:
+        print('Memory mapped {0} files; header length of first file: {1}'.format(
+            len(frames), frames[0].offset))
+    return MemmapStack(frames, ht, wd, formatstring)
+
+
+def read_raw_frame(path, ht, wd, formatstring):
+    """
+    Read the pixel data of a single raw .dat file into a 2d numpy array
+    The header length is calculated from the file size on disk so that
+    the file contents are only read once.
+
+    :param path: string path to .dat file
+    :param ht: integer pixel height of image
+    :param wd: integer pixel width of image
+    :param formatstring: numpy data type string from raw_format_string()
+    :return: 2d numpy array of shape (ht, wd)
+    """
+    count = ht * wd
+    hdln = os.stat(path).st_size - np.dtype(formatstring).itemsize * count
+    with open(path, 'rb') as f:
+        f.seek(hdln)
+        return np.fromfile(f, dtype=formatstring, count=count).reshape((ht, wd))
+
+
+def resolve_workers(workers):
+    """
+    Translate a user setting for the number of parallel workers into a usable count
+    :param workers: positive integer, or None to use one worker per cpu core
+    :return: integer >= 1
+    """
+    if workers is None:
+        return mp.cpu_count()
+    return max(1, int(workers))
+
+
+def build_stack(paths, reader, shape=None, dtype=None, progress=None, workers=1, processes=False):
+    """
+    Assemble a 3d numpy array from a list of files in a single pass
+    The output array of shape (ht, wd, num files) is allocated once and
+    each file is decoded directly into its slice along the third axis.
+    This avoids holding a list of 2d arrays alongside the final np.dstack() copy.
+
+    Files may be decoded in parallel. A thread pool suits raw reads which release the GIL
+    while waiting on disk; a process pool suits CPU bound image decoding in PIL.
+    Each frame is always stored at the index of its path so file order is deterministic.
+
+    :param paths: list of string paths to image files, in energy order
+    :param reader: callable taking a path and returning a 2d numpy array;
+                   must be a module level function when processes is True
+    :param shape: tuple (ht, wd) of the image size; if None, taken from the first file
+    :param dtype: numpy dtype of output array; if None, taken from the first file
+    :param progress: optional callable progress(num_done, num_total) called after each frame
+    :param workers: number of parallel workers; None for one per cpu core, default 1 (serial)
+    :param processes: if True use a process pool rather than a thread pool for parallel decoding
+    :return dat_arr: 3d numpy array
+    """
+    workers = resolve_workers(workers)
+    first = None
+    if shape is None or dtype is None:
+        first = reader(paths[0])
+        shape = first.shape
+        dtype = first.dtype
+
+    dat_arr = np.empty((shape[0], shape[1], len(paths)), dtype=dtype)
+    start = 0
+    if first is not None:
+        dat_arr[:, :, 0] = first
+        start = 1
+        if progress is not None:
+            progress(1, len(paths))
+
+    if workers == 1 or len(paths) - start <= 1:
+        for idx in range(start, len(paths)):
+            dat_arr[:, :, idx] = reader(paths[idx])
+            if progress is not None:
+                progress(idx + 1, len(paths))
+        return dat_arr
+
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(max_workers=workers) as pool:
+        # map() yields results in submission order
+        frames = pool.map(reader, paths[start:], chunksize=max(1, (len(paths) - start) // (4 * workers)))
+        for idx, frame in enumerate(frames, start):
+            dat_arr[:, :, idx] = frame
+            if progress is not None:
+                progress(idx + 1, len(paths))
+    return dat_arr
+
+
+def center_out_order(num, first=0):
+    """
+    Order in which to load a stack so a chosen frame comes first
+    Frames are then taken alternately above and below it, so the frames
+    loaded so far always form a contiguous range of indices.
+    :param num: integer number of frames
+    :param first: integer index of first frame; negative values count from the end
+    :return order: list of integer indices
+    """
+    if first < 0:
+        first += num
+    first = min(max(first, 0), num - 1)
+    order = [first]
+    lo = hi = first
+    while len(order) < num:
+        if hi + 1 < num:
+            hi += 1
+            order.append(hi)
+        if lo > 0 and len(order) < num:
+            lo -= 1
+            order.append(lo)
+    return order
+
+
+def stream_stack(paths, reader, shape=None, dtype=None, first=0, batch_size=8, workers=1, processes=False):
+    """
+    Generator which assembles a 3d numpy array while yielding partial results
+    The frame at index first is loaded on its own and yielded immediately,
+    then the remaining frames are loaded in batches in center_out_order().
+    Each step yields the same preallocated array along with the inclusive range
+    of indices [lo, hi] which have been filled so far.
+
+    :param paths: list of string paths to image files, in energy order
+    :param reader: callable taking a path and returning a 2d numpy array;
+                   must be a module level function when processes is True
+    :param shape: tuple (ht, wd) of the image size; if None, taken from the first file loaded
+    :param dtype: numpy dtype of output array; if None, taken from the first file loaded
+    :param first: integer index of the frame to load first; negative values count from the end
+    :param batch_size: number of frames loaded between each yield
+    :param workers: number of parallel workers; None for one per cpu core, default 1 (serial)
+    :param processes: if True use a process pool rather than a thread pool for parallel decoding
+    :return: yields tuples (dat_arr, lo, hi)
+    """
+    order = center_out_order(len(paths), first)
+    first_frame = reader(paths[order[0]])
+    if shape is None or dtype is None:
+        shape = first_frame.shape
+        dtype = first_frame.dtype
+    dat_arr = np.empty((shape[0], shape[1], len(paths)), dtype=dtype)
+    dat_arr[:, :, order[0]] = first_frame
+    lo = hi = order[0]
+    yield dat_arr, lo, hi
+
+    workers = resolve_workers(workers)
+    pool = None
+    if workers > 1:
+        pool = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(max_workers=workers)
+    try:
+        for start in range(1, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            if pool is None:
+                frames = (reader(paths[idx]) for idx in batch)
+            else:
+                frames = pool.map(reader, [paths[idx] for idx in batch])
+            for idx, frame in zip(batch, frames):
+                dat_arr[:, :, idx] = frame
+            lo = min(lo, min(batch))
+            hi = max(hi, max(batch))
+            yield dat_arr, lo, hi
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def stream_LEEM_Data(dirname, ht=0, wd=0, bits=None, byte='L', first=0, batch_size=8, workers=1, indices=None):
+    """
+    Generator version of process_LEEM_Data() for progressive display of raw data
+    See stream_stack() for the order in which files are loaded
+    :argument dirname: string path to current data directory
+    :param ht: integer pixel height of image
+    :param wd: integer pixel width of image
+    :param bits: integer representing bit depth of image, default is 16 bit
+    :param byte: string representing byte order, 'L' for Little-Endian (Intel), 'B' for Big-Endian (Motorola)
+    :param first: integer index of the file to load first; negative values count from the end
+    :param batch_size: number of files loaded between each yield
+    :param workers: number of threads used to read files; None for one per cpu core
+    :param indices: optional list of file indices to load, see energy_window(); default loads all files
+    :return: yields tuples (dat_arr, lo, hi)
+    """
+    files = select_files(raw_data_files(dirname), indices)
+    formatstring = raw_format_string(bits, byte)
+    if ht == 0 and wd == 0:
+        ht = DEF_IMHEIGHT
+        wd = DEF_IMWIDTH
+    paths = [os.path.join(dirname, fl) for fl in files]
+    return stream_stack(paths, lambda p: read_raw_frame(p, ht, wd, formatstring),
+                        shape=(ht, wd), dtype=formatstring, first=first,
+                        batch_size=batch_size, workers=workers)
+
+
+def process_LEEM_Data(dirname, ht=0, wd=0, bits=None, byte='L', mmap=False, progress=None, workers=1,
+                      indices=None):
     """
     read in all .dat files in current data directory
     process each .dat file into a numpy array
@@ -60,56 +411,32 @@ def process_LEEM_Data(dirname, ht=0, wd=0, bits=None, byte='L'):
     :param wd: integer pixel width of image
     :param bits: integer representing bit depth of image, default is 16 bit
     :param byte: string representing byte order, 'L' for Little-Endian (Intel), 'B' for Big-Endian (Motorola)
+    :param mmap: if True, return a lazily assembled MemmapStack instead of reading all files
+    :param progress: optional callable progress(num_done, num_total) called after each file is read
+    :param workers: number of threads used to read files; None for one per cpu core
+    :param indices: optional list of file indices to load, see energy_window(); default loads all files
     :return dat_arr: 3d numpy array
     """
+    files = select_files(raw_data_files(dirname), indices)
+    if mmap:
+        print('Memory mapping Data ...')
+        return memmap_LEEM_Data(dirname, ht, wd, bits, byte, files=files)
+
     print('Processing Data ...')
-    # progress = pb.ProgressBar(fd=sys.stdout)
-    arr_list = []
-    flag = True
-    # add filter on file names to exclude hidden files beginning with a leading period
-    files = [name for name in os.listdir(dirname) if name.endswith('.dat') and not name.startswith(".")]
-    files.sort()
     print('First file is {}.'.format(files[0]))
 
-    for fl in files:
-        with open(os.path.join(dirname, fl), 'rb') as f:
-            # dynamically calculate file header length
-            if ht == 0 and wd == 0:
-                hdln = DEF_IMHEAD
-                ht = DEF_IMHEIGHT
-                wd = DEF_IMWIDTH
-            else: hdln = len(f.read()) - (int(bits/8)*ht*wd)  # multiply by number of bytes per pixel
-
-            if flag:
-                print('Calculated Header Length of First File: {}'.format(hdln))
-                # only print first file header length
-                flag = False
-            f.seek(0)
-
-            # Generate format string given a bit size read from YAML config file
-            if bits == 8 and byte == 'L':
-                formatstring = '<u1'  # 1 byte (8 bits) per pixel
-            elif bits == 8 and byte == 'B':
-                formatstring = '>u1'
-
-            elif bits == 16 and byte == 'L':
-                formatstring = '<u2'  # 2 bytes (16 bits) per pixel
-            elif bits == 16 and byte == 'B':
-                formatstring = '>u2'
+    # Generate format string given a bit size read from YAML config file
+    formatstring = raw_format_string(bits, byte)
+    if ht == 0 and wd == 0:
+        ht = DEF_IMHEIGHT
+        wd = DEF_IMWIDTH
+    hdln = os.stat(os.path.join(dirname, files[0])).st_size - np.dtype(formatstring).itemsize*ht*wd
+    print('Calculated Header Length of First File: {}'.format(hdln))
 
-            elif bits is None:
-                formatstring = '<u2'  # default to 16 bit images
-
-            else:
-                print("Error in process_LEEM_Data() - unknown bit size when loading raw data")
-                print("Check for incorrect bitsize in YAML experiment file")
-
-            arr_list.append(np.fromstring(f.read()[hdln:],
-                                          formatstring).reshape((ht, wd)))
     print('Creating 3D Array ...')
-
-    dat_arr = np.dstack(arr_list)  # create 3D stack of all image files
-    del arr_list[:]  # clear data from list as it ahs now been stored in numpy array
+    paths = [os.path.join(dirname, fl) for fl in files]
+    dat_arr = build_stack(paths, lambda p: read_raw_frame(p, ht, wd, formatstring),
+                          shape=(ht, wd), dtype=formatstring, progress=progress, workers=workers)
     # print('Returning New Array Shape: {}'.format(dat_arr.shape))
     return dat_arr
 
@@ -187,36 +514,37 @@ def count_minima_locations(e_cut, smth_iv):
     :argument smth_iv:  array-like container of intensity values cut to desired energy window
     :return:  tuple with two values (# of minima, list of minima locations)
     """
-    diff_iv = list(np.diff(smth_iv)/np.diff(e_cut))
-    sgn = np.sign(diff_iv[0])  # get sign of first point
-    count = 0
-    min_locations = []
+    diff_iv = np.diff(smth_iv)/np.diff(e_cut)
+    # the derivative changing sign from - to + indicates a local minima in the I(V) spectrum
+    # by the intermediate value theorem dI/dV must have a zero point in between
+    min_locations = np.flatnonzero(sign_change_locations(diff_iv)).tolist()
 
-    for point in diff_iv:
-        if np.sign(point) != sgn and np.sign(point) == 1:
-            # the derivative has changed signs - ie. crossed the x axis
-            # thus by the intermediate value theorem it must have a zero point in between
-            # the zero point in the dI/dV spectra corresponds to a local extrema in the I(V) spectrum
+    return (len(min_locations), min_locations)
 
-            # the current point in the derivative is positive which means the last point was negative
-            # a derivative changing from - to + indicates a local minima
-            min_locations.append(diff_iv.index(point))
-            count += 1
-        sgn = np.sign(point)  # update sgn and continue loop with next point in the derivative
 
-    return (count, min_locations)
+# Window functions available for data smoothing
+WINDOW_FUNCTIONS = {'hanning': np.hanning,
+                    'hamming': np.hamming,
+                    'bartlett': np.bartlett,
+                    'blackman': np.blackman}
 
 
-def smooth(inpt, window_len=10, window_type='flat'):
+def smoothing_window(window_len, window_type='flat'):
     """
-    Smoothing function based on Scipy Cookbook recipe for data smoothing
-    Uses predefined window function (selectable) to smooth a 1D data set
-    Computes the convolution with a normalized window
-
-    :param inpt: input list or 1d array
-    :param window_len: even integer size of window
+    Generate a window function for smooth() and smooth_cube()
+    :param window_len: integer size of window
     :param window_type: string for type of window function
-    :return otpt: 1d numpy array of smoothed data with same length as inpt
+    :return w: 1d numpy array
+    """
+    if window_type == 'flat':  # moving average
+        return np.ones(window_len, 'd')
+    return WINDOW_FUNCTIONS[window_type](window_len)
+
+
+def check_smoothing_params(window_len, window_type):
+    """
+    Validate the parameters for smooth() and smooth_cube()
+    :return window_len: even integer window length, or None if the parameters are invalid
     """
     if not (window_len % 2 == 0):
         window_len += 1
@@ -224,11 +552,27 @@ def smooth(inpt, window_len=10, window_type='flat'):
 
     if window_len <= 3:
         print('Error in data smoothing - please select a larger window length')
-        return
+        return None
 
-    # window_type = 'hanning'
-    if not window_type in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
+    if window_type != 'flat' and window_type not in WINDOW_FUNCTIONS:
         print('Error - Invalid window_type')
+        return None
+    return window_len
+
+
+def smooth(inpt, window_len=10, window_type='flat'):
+    """
+    Smoothing function based on Scipy Cookbook recipe for data smoothing
+    Uses predefined window function (selectable) to smooth a 1D data set
+    Computes the convolution with a normalized window
+
+    :param inpt: input list or 1d array
+    :param window_len: even integer size of window
+    :param window_type: string for type of window function
+    :return otpt: 1d numpy array of smoothed data with same length as inpt
+    """
+    window_len = check_smoothing_params(window_len, window_type)
+    if window_len is None:
         return
 
     # Generate two arguments to pass into numpy.convolve()
@@ -237,11 +581,7 @@ def smooth(inpt, window_len=10, window_type='flat'):
     # w is the window matrix based on pre-defined window functions or unit matrix for flat window
 
     s = np.r_[inpt[window_len-1:0:-1], inpt, inpt[-1:-window_len:-1]]
-    # w = eval('np.'+window_type+'(window_len)')
-    if window_type == 'flat':  # moving average
-        w = np.ones(window_len, 'd')
-    else:
-        w = eval('np.'+window_type+'(window_len)')
+    w = smoothing_window(window_len, window_type)
 
     # create smoothed data via numpy.convolve using the normalized input window matrix
     otpt = np.convolve(w/w.sum(), s, mode='valid')
@@ -250,6 +590,124 @@ def smooth(inpt, window_len=10, window_type='flat'):
     return otpt[int(window_len/2-1):-int(window_len/2)]
 
 
+def smooth_cube(data, axis=2, window_len=10, window_type='flat', block_size=2**16):
+    """
+    Vectorized equivalent of np.apply_along_axis(smooth, axis, data, window_len, window_type)
+    All curves are reflected at their ends and convolved together rather than one at a time.
+    The 'flat' window uses a running sum computed with np.cumsum (exact in int64 for integer data),
+    other windows sum shifted views of the reflected curves weighted by the window.
+    Results agree with smooth() to floating point rounding.
+
+    :param data: n-d numpy array or array-like
+    :param axis: integer axis along which to smooth, default 2 for the energy axis of (h, w, E) data
+    :param window_len: even integer size of window
+    :param window_type: string for type of window function
+    :param block_size: integer number of curves processed at a time to bound temporary memory
+    :return out: float64 numpy array of smoothed data with the same shape as data
+    """
+    window_len = check_smoothing_params(window_len, window_type)
+    if window_len is None:
+        return
+
+    data = np.moveaxis(np.asarray(data), axis, -1)
+    num = data.shape[-1]
+    curves = data.reshape((-1, num))
+    out = np.empty(curves.shape, dtype=np.float64)
+    # offset of the first output point within the reflected curve
+    start = int(window_len/2 - 1)
+    w = smoothing_window(window_len, window_type)
+    w = w/w.sum()
+    integer = np.issubdtype(data.dtype, np.integer) or data.dtype == np.bool_
+
+    for b0 in range(0, curves.shape[0], block_size):
+        block = curves[b0:b0 + block_size]
+        # same reflections as smooth()
+        s = np.concatenate((block[:, window_len-1:0:-1], block, block[:, -1:-window_len:-1]), axis=1)
+        if window_type == 'flat':
+            csum = np.zeros((s.shape[0], s.shape[1] + 1), dtype=np.int64 if integer else np.float64)
+            np.cumsum(s, axis=1, out=csum[:, 1:])
+            out[b0:b0 + block_size] = (csum[:, start + window_len:start + window_len + num] -
+                                       csum[:, start:start + num]) / float(window_len)
+        else:
+            s = s.astype(np.float64, copy=False)
+            acc = out[b0:b0 + block_size]
+            acc[...] = 0
+            # convolution flips the window
+            for k, wk in enumerate(w[::-1]):
+                acc += wk * s[:, start + k:start + k + num]
+    return np.moveaxis(out.reshape(data.shape), -1, axis)
+
+
+def derivative_operator(elist, window_len=10, window_type='flat', smooth_before=True, smooth_after=True):
+    """
+    Matrix of the linear map from an I(V) curve to its smoothed derivative
+    smooth(), np.diff(curve)/np.diff(elist) and smooth() again are all linear, so the whole
+    chain, including the reflected ends of smooth() and non-uniform energy steps, is
+    a single (E-1, E) matrix. It is built by passing the identity matrix through the chain.
+    :param elist: list of energy values in eV
+    :param window_len: even integer size of window used by both smoothing steps
+    :param window_type: string for type of window function
+    :param smooth_before: boolean; if True smooth the curve before taking the derivative
+    :param smooth_after: boolean; if True smooth the derivative
+    :return op: 2d float64 numpy array with shape (E-1, E)
+    """
+    num = len(elist)
+    op = np.eye(num)
+    if smooth_before:
+        op = smooth_cube(op, axis=0, window_len=window_len, window_type=window_type)
+    op = np.diff(op, axis=0) / np.diff(np.asarray(elist, dtype=np.float64))[:, None]
+    if smooth_after:
+        op = smooth_cube(op, axis=0, window_len=window_len, window_type=window_type)
+    return op
+
+
+def derivative_cube(data, elist, window_len=10, window_type='flat', smooth_before=True, smooth_after=True,
+                    out=None, axis=2, block_size=2**14, energy_block=128):
+    """
+    Smoothed derivative, dI/dE, of every I(V) curve in a data set in a single pass
+    Equivalent to smooth_cube(np.diff(smooth_cube(data), axis=2) / np.diff(elist), axis=2)
+    without the full size float64 intermediate cubes. The combined operator from
+    derivative_operator() is banded, so it is applied to blocks of curves as matrix
+    products over bands of energies. Results agree with the step by step calculation
+    to floating point rounding.
+
+    :param data: n-d numpy array or array-like
+    :param elist: list of energy values in eV along axis
+    :param window_len: even integer size of window used by both smoothing steps
+    :param window_type: string for type of window function
+    :param smooth_before: boolean; if True smooth the curves before taking the derivative
+    :param smooth_after: boolean; if True smooth the derivative
+    :param out: optional float32 numpy array to write into, with the shape of data and E-1 along axis
+    :param axis: integer energy axis, default 2 for (h, w, E) data
+    :param block_size: integer number of curves processed at a time to bound temporary memory
+    :param energy_block: integer number of output energies per matrix product
+    :return out: float32 numpy array with E-1 points along axis
+    """
+    if check_smoothing_params(window_len, window_type) is None:
+        return
+    op = derivative_operator(elist, window_len, window_type, smooth_before, smooth_after)
+    rows, cols = np.nonzero(op)
+    lo, hi = (rows - cols).max(), (cols - rows).max()  # band below and above the diagonal
+
+    data = np.moveaxis(np.asarray(data), axis, -1)
+    num = data.shape[-1]
+    curves = data.reshape((-1, num))
+    shape = data.shape[:-1] + (num - 1,)
+    if out is None:
+        out = np.empty(np.moveaxis(np.empty(shape, dtype=np.bool_), -1, axis).shape, dtype=np.float32)
+    out_curves = np.moveaxis(out, axis, -1).reshape((-1, num - 1))
+    if not np.shares_memory(out_curves, out):
+        raise ValueError("out must be a C-contiguous array with the energy axis last")
+
+    for b0 in range(0, curves.shape[0], block_size):
+        block = curves[b0:b0 + block_size].astype(np.float64)
+        for j0 in range(0, num - 1, energy_block):
+            j1 = min(num - 1, j0 + energy_block)
+            i0, i1 = max(0, j0 - lo), min(num, j1 + hi)
+            out_curves[b0:b0 + block_size, j0:j1] = np.dot(block[:, i0:i1], op[j0:j1, i0:i1].T)
+    return out
+
+
 def crop_images(data, indices):
     """
     Crop images based on the indices specified
@@ -261,100 +719,282 @@ def crop_images(data, indices):
                 indices[0][1]:indices[1][1]+1]
 
 
-def get_img_array(path, ext=None, swap=False):
+def integral_cube(data, block_size=16):
+    """
+    Summed-area table (integral image) of every image in a 3d stack
+    sat[r, c, e] is the sum of data[:r, :c, e], so a zero row and column are padded at the start.
+    Integer data is accumulated in int64 so sums are exact; other data in float64.
+    :param data: 3d numpy array or array-like with shape (h, w, E)
+    :param block_size: integer number of images processed at a time to bound temporary memory
+    :return sat: 3d numpy array with shape (h+1, w+1, E)
+    """
+    integer = np.issubdtype(data.dtype, np.integer) or data.dtype == np.bool_
+    ht, wd, num = data.shape
+    sat = np.zeros((ht + 1, wd + 1, num), dtype=np.int64 if integer else np.float64)
+    for e0 in range(0, num, block_size):
+        block = sat[1:, 1:, e0:e0 + block_size]
+        np.cumsum(np.asarray(data[:, :, e0:e0 + block_size]), axis=0, dtype=sat.dtype, out=block)
+        np.cumsum(block, axis=1, out=block)
+    return sat
+
+
+def window_bounds(start, stop, length):
+    """
+    Vectorized slice.indices() for unit step slices
+    Bounds follow numpy slicing rules: negative values count from the end and are clipped
+    :param start: integer or array of integer slice starts
+    :param stop: integer or array of integer slice stops
+    :param length: integer length of the sliced axis
+    :return (start, stop): integer arrays with 0 <= start <= stop <= length
+    """
+    bounds = []
+    for val in (start, stop):
+        val = np.asarray(val, dtype=np.int64)
+        val = np.where(val < 0, val + length, val)
+        bounds.append(np.clip(val, 0, length))
+    return bounds[0], np.maximum(bounds[0], bounds[1])
+
+
+def window_sums(sat, r0, r1, c0, c1):
+    """
+    I(V) curves summed over rectangular windows using a summed-area table from integral_cube()
+    Each window is data[r0:r1, c0:c1, :] with the usual numpy slicing rules
+    and costs four lookups per energy regardless of its size.
+    :param sat: 3d numpy array from integral_cube()
+    :param r0, r1, c0, c1: integer bounds of one window, or equal length arrays of bounds for many windows
+    :return: numpy array with shape (E,) for one window or (num windows, E)
+    """
+    r0, r1 = window_bounds(r0, r1, sat.shape[0] - 1)
+    c0, c1 = window_bounds(c0, c1, sat.shape[1] - 1)
+    return sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+
+
+def direct_window_sums(data, r0, r1, c0, c1):
+    """
+    Same as window_sums() but summing data directly, for when no summed-area table is available
+    :param data: 3d numpy array or array-like with shape (h, w, E)
+    :return: numpy array with shape (E,) for one window or (num windows, E)
+    """
+    if np.ndim(r0) == 0:
+        return np.asarray(data[r0:r1, c0:c1, :]).sum(axis=(0, 1))
+    return np.array([np.asarray(data[a:b, c:d, :]).sum(axis=(0, 1))
+                     for a, b, c, d in zip(r0, r1, c0, c1)]).reshape((len(r0), data.shape[2]))
+
+
+BACKGROUND_MODELS = ['perimeter', 'plane', 'annulus']
+
+
+def window_background(data, r0, r1, c0, c1, model='perimeter', width=2, sat=None):
+    """
+    Background subtracted I(V) curves for many rectangular windows at once
+    The background of each window is estimated at every energy by one of:
+        'perimeter': mean of the pixels on the edge of the window
+        'plane': least squares plane a + b*row + c*col fit to the edge pixels
+        'annulus': mean of a ring of pixels width wide surrounding the window
+    and integrated over the area of the window.
+    Sums are taken over the whole energy axis with 64 bit accumulators.
+
+    :param data: 3d numpy array or array-like with shape (h, w, E)
+    :param r0, r1, c0, c1: equal length sequences of window bounds, windows are data[r0:r1, c0:c1, :]
+    :param model: string name of background model from BACKGROUND_MODELS
+    :param width: integer width in pixels of the ring used by the 'annulus' model
+    :param sat: optional summed-area table of data from integral_cube(); windows are summed directly if None
+    :return (corrected, background, average): float64 arrays with shape (num windows, E),
+            (num windows, E) and (E,) of corrected intensity, subtracted background
+            and the background averaged over all windows
+    """
+    if model not in BACKGROUND_MODELS:
+        raise ValueError("Unknown background model {0}; valid models are {1}".format(model, BACKGROUND_MODELS))
+    ht, wd = data.shape[0], data.shape[1]
+    r0, r1 = window_bounds(r0, r1, ht)
+    c0, c1 = window_bounds(c0, c1, wd)
+
+    def sums(a, b, c, d):
+        if sat is not None:
+            return window_sums(sat, a, b, c, d).astype(np.float64)
+        return direct_window_sums(data, a, b, c, d).astype(np.float64)
+
+    area = ((r1 - r0) * (c1 - c0)).astype(np.float64)
+    totals = sums(r0, r1, c0, c1)
+
+    if model == 'perimeter':
+        # the perimeter is the window minus its interior one pixel in from each edge
+        ir0, ir1 = window_bounds(r0 + 1, r1 - 1, ht)
+        ic0, ic1 = window_bounds(c0 + 1, c1 - 1, wd)
+        count = area - (ir1 - ir0) * (ic1 - ic0)
+        ring = totals - sums(ir0, ir1, ic0, ic1)
+    elif model == 'annulus':
+        or0, or1 = window_bounds(r0 - width, r1 + width, ht)
+        oc0, oc1 = window_bounds(c0 - width, c1 + width, wd)
+        count = (or1 - or0) * (oc1 - oc0) - area
+        ring = sums(or0, or1, oc0, oc1) - totals
+
+    if model in ['perimeter', 'annulus']:
+        count = count.astype(np.float64)
+        mean = np.divide(ring, count[:, None], out=np.zeros_like(ring), where=count[:, None] > 0)
+        background = mean * area[:, None]
+    else:
+        background = np.zeros(totals.shape)
+        for idx in range(len(r0)):
+            win = np.asarray(data[r0[idx]:r1[idx], c0[idx]:c1[idx], :])
+            if win.size == 0:
+                continue
+            edge = np.ones(win.shape[:2], dtype=bool)
+            edge[1:-1, 1:-1] = False
+            rows, cols = np.nonzero(edge)
+            design = np.column_stack((np.ones(rows.size), rows, cols))
+            # one least squares fit per energy, solved together
+            coef = np.linalg.lstsq(design, win[rows, cols, :].astype(np.float64), rcond=None)[0]
+            # sum of the plane over every pixel in the window
+            nr, nc = win.shape[:2]
+            background[idx] = (coef[0] * nr * nc + coef[1] * nc * nr * (nr - 1) / 2.0 +
+                               coef[2] * nr * nc * (nc - 1) / 2.0)
+
+    corrected = totals - background
+    average = background.mean(axis=0) if len(background) else np.zeros(data.shape[2])
+    return corrected, background, average
+
+
+def img_files(path, ext):
+    """
+    List the image files with a given extension in a directory
+    '.tif' and '.tiff' are tried in turn if no files with ext are found
+    :param path: path to image files
+    :param ext: file extension including .
+    :return files: sorted list of file names, or None if no files were found
+    """
+    # Handle Tiff and Png with '.tif', '.tiff',  and '.png'
+    print('Searching for {0} files in path: {1}'.format(ext, path))
+    files = [name for name in os.listdir(path) if name.endswith(ext)]
+
+    if not files and ext == '.tif':
+        # ext = .tif, but not files found, try ext=.tiff
+        # print('Error: No Files Found')
+        print('Directory does not contain files with \'.tif\' extensions')
+        print('Trying \'.tiff\' instead')
+        files = [name for name in os.listdir(path) if name.endswith('.tiff')]
+
+    elif not files and ext == '.tiff':
+        # ext=.tiff but no files found, try .tif
+        print('Directory does not contain files with \'.tiff\' extensions')
+        print('Trying \'.tif\' instead')
+        files = [name for name in os.listdir(path) if name.endswith('.tif')]
+
+    elif not files:
+        # ext must be '.png' but no files were found
+        print('Directory does not contain files with \'.png\' extensions')
+        print('Aborting Loading ...')
+        return None
+
+    if not files:
+        # still no files found
+        print('Error no Files Found')
+        print('Please verify settings in Experiment CONFIG file and try loading again')
+        return None
+    files.sort()
+    return files
+
+
+def get_img_array(path, ext=None, swap=False, progress=None, workers=1, indices=None):
     """
     Generate a 3d numpy array of gray-scale image files
     :param path: path to image files
     :param ext: file extension, default None for raw (.dat) data (not yet implemented)
     :param swap: boolean to swap the byte order of the array; default False
+    :param progress: optional callable progress(num_done, num_total) called after each image is read
+    :param workers: number of processes used to decode images; None for one per cpu core
+    :param indices: optional list of file indices to load, see energy_window(); default loads all files
     :return dat_3d: 3d numpy array (height, width, image number)
     """
     if ext is None:
         # Raw Data - implement this later
         pass
     else:
-        # Handle Tiff and Png with '.tif', '.tiff',  and '.png'
-        print('Searching for {0} files in path: {1}'.format(ext, path))
-        files = [name for name in os.listdir(path) if name.endswith(ext)]
-
-        if not files and ext == '.tif':
-            # ext = .tif, but not files found, try ext=.tiff
-            # print('Error: No Files Found')
-            print('Directory does not contain files with \'.tif\' extensions')
-            print('Trying \'.tiff\' instead')
-            files = [name for name in os.listdir(path) if name.endswith('.tiff')]
-
-        elif not files and ext == '.tiff':
-            # ext=.tiff but no files found, try .tif
-            print('Directory does not contain files with \'.tiff\' extensions')
-            print('Trying \'.tif\' instead')
-            files = [name for name in os.listdir(path) if name.endswith('.tif')]
-
-        elif not files:
-            # ext must be '.png' but no files were found
-            print('Directory does not contain files with \'.png\' extensions')
-            print('Aborting Loading ...')
-            return None
-
-        if not files:
-            # still no files found
-            print('Error no Files Found')
-            print('Please verify settings in Experiment CONFIG file and try loading again')
+        files = img_files(path, ext)
+        if files is None:
             return None
+        files = select_files(files, indices)
 
         # at this point we have found a list of files to parse
         print("Found {} data files to parse.".format(len(files)))
-        files.sort()
-        arr_list = []
-        for fl in files:
-            arr_list.append(read_img(os.path.join(path, fl)))
+        dat_3d = build_stack([os.path.join(path, fl) for fl in files], read_img,
+                             progress=progress, workers=workers, processes=True)
         if swap:
-            return np.dstack(arr_list).byteswap()
+            return dat_3d.byteswap(inplace=True)
         else:
-            return np.dstack(arr_list)
+            return dat_3d
+
+
+def stream_img_array(path, ext, first=0, batch_size=8, workers=1, indices=None):
+    """
+    Generator version of get_img_array() for progressive display of image data
+    See stream_stack() for the order in which files are loaded
+    :param path: path to image files
+    :param ext: file extension including .
+    :param first: integer index of the file to load first; negative values count from the end
+    :param batch_size: number of files loaded between each yield
+    :param workers: number of processes used to decode images; None for one per cpu core
+    :param indices: optional list of file indices to load, see energy_window(); default loads all files
+    :return: yields tuples (dat_arr, lo, hi); yields nothing if no files were found
+    """
+    files = img_files(path, ext)
+    if files is None:
+        return iter([])
+    files = select_files(files, indices)
+    print("Found {} data files to parse.".format(len(files)))
+    return stream_stack([os.path.join(path, fl) for fl in files], read_img, first=first,
+                        batch_size=batch_size, workers=workers, processes=True)
+
+
+# numpy data type for each PIL image mode which can be converted without loss of bit depth
+PIL_MODE_DTYPES = {'L': np.uint8,
+                   'I;16': np.uint16,
+                   'I;16L': np.uint16,
+                   'I;16B': np.uint16,
+                   'I;16N': np.uint16,
+                   'I': np.int32,
+                   'F': np.float32}
 
 
 def read_img(path):
         """
-        Use PIL to open an image file, convert to greyscale and output a 2D numpy array.
+        Use PIL to open an image file and output a 2D numpy array.
         In principle should work for .tif, .png, .jpg,
         and possibly anything else supported by Image.open().
+
+        Grey scale images keep their native bit depth: 8-bit images are returned as uint8,
+        16-bit images as uint16 (in native byte order), 32-bit integer and float images as
+        int32 and float32. The output dtype is taken from the image mode and the pixel data
+        is converted via the buffer protocol without building python lists of pixels.
+        Colour images are flattened to 8-bit grey scale.
         :param path: path to image to be opened
-        :return:
+        :return: 2d numpy array
         """
         # print 'opening image %s' % path
 
         im = Image.open(path)
-
-        # Use the greyscale transformation as defined in the Python Image Library
-        # When converting from a colour image to black and white, the library uses the
-        # ITU - R 601 - 2 luma transform:
-        # L = R * 299 / 1000 + G * 587 / 1000 + B * 114 / 1000
-
-        im = im.convert('L')
-
-        pixels = list(im.getdata())
-        w, h = im.size
-        # generate list of lists of pixel values then convert to numpy array
-        pixels = [pixels[i*w:(i+1)*w] for i in range(h)]
-
-        # try to determine optimal numpy data type
-        m = max(max(pixels))
-        if 0 < m <= 255:
-            typ = np.uint8
-        elif 255 < m <= 65535:
+        rawmode = ''
+        if im.tile:
+            # decoder arguments are the raw mode itself for PNG and a tuple starting with it for TIFF
+            args = im.tile[0][3]
+            rawmode = str(args[0] if isinstance(args, tuple) and args else args)
+
+        if im.mode == 'I' and rawmode.startswith('I;16'):
+            # 16-bit grey scale (eg. PNG) decoded by PIL into a 32-bit integer image
             typ = np.uint16
-        elif 65535 < m <= 4294967295:
-            typ = np.uint32
+        elif im.mode in PIL_MODE_DTYPES:
+            typ = PIL_MODE_DTYPES[im.mode]
         else:
-            typ = np.uint64
+            # Use the greyscale transformation as defined in the Python Image Library
+            # When converting from a colour image to black and white, the library uses the
+            # ITU - R 601 - 2 luma transform:
+            # L = R * 299 / 1000 + G * 587 / 1000 + B * 114 / 1000
+            im = im.convert('L')
+            typ = np.uint8
 
-        try:
-            return np.array(pixels).astype(typ)
-        except TypeError as e:
-            print("Error reading image into numpy array")
-            print("Max value stored exceeds that of 64 bit integer")
-            raise e
+        # np.asarray reads the decoded image through the array interface; astype
+        # only copies again when the byte order or integer width has to change
+        return np.asarray(im).astype(typ, copy=False)
 
 
 def parse_tiff_header(img, w, h, byte_depth):
@@ -405,8 +1045,67 @@ def parse_tiff_header(img, w, h, byte_depth):
         raise ParseError(message="Header Length too short; Need at least two bytes to read correct byte order.", errors=None)
 
 
+def strip_header(infile, outfile, w, h, fmtstr):
+    """
+    Strip the header from a single image file and write the pixel data as a raw binary file
+    :param infile: string path to input image file
+    :param outfile: string path to output .dat file
+    :param w: img width
+    :param h: img height
+    :param fmtstr: numpy data format string, ex. '<u2'
+    :return none:
+    """
+    data = read_raw_frame(infile, h, w, fmtstr)  # strip header information
+    with open(outfile, 'wb') as o:
+        data.tofile(o)  # store image data as raw binary file
+
+
+def write_dat_files(dirname, outdirname, files, w, h, fmtstr, workers=1, progress=None):
+    """
+    Strip headers from a list of image files and output raw .dat files using a thread pool
+    :param dirname: string path to directory containing image files
+    :param outdirname: string path to directory to output raw .dat files
+    :param files: list of file names in dirname
+    :param w: img width
+    :param h: img height
+    :param fmtstr: numpy data format string, ex. '<u2'
+    :param workers: number of threads; None for one per cpu core
+    :param progress: optional callable progress(num_done, num_total) called after each file is written
+    :return none:
+    """
+    def convert(fl):
+        strip_header(os.path.join(dirname, fl),
+                     os.path.join(outdirname, fl.split('.')[0]+'.dat'), w, h, fmtstr)
+
+    with ThreadPoolExecutor(max_workers=resolve_workers(workers)) as pool:
+        for num, _ in enumerate(pool.map(convert, files), 1):
+            if progress is not None:
+                progress(num, len(files))
+
+
+def write_chunked_stack(dirname, outpath, files, w, h, fmtstr, progress=None, **kwargs):
+    """
+    Strip headers from a list of image files and stream the pixel data into a single chunked stack file
+    Only one energy block of frames is held in memory at a time
+    :param dirname: string path to directory containing image files
+    :param outpath: string path to output chunked stack file
+    :param files: list of file names in dirname, in order of increasing energy
+    :param w: img width
+    :param h: img height
+    :param fmtstr: numpy data format string, ex. '<u2'
+    :param progress: optional callable progress(num_done, num_total) called after each file is written
+    :param kwargs: chunks, codec, level and elist passed to chunkstore.ChunkWriter
+    :return none:
+    """
+    with chunkstore.ChunkWriter(outpath, h, w, fmtstr, **kwargs) as writer:
+        for num, fl in enumerate(files, 1):
+            writer.append(read_raw_frame(os.path.join(dirname, fl), h, w, fmtstr))
+            if progress is not None:
+                progress(num, len(files))
+
+
 def gen_dat_files(dirname=None, outdirname=None, ext=None,
-                  w=None, h=None, byte_depth=None):
+                  w=None, h=None, byte_depth=None, workers=1, fmt='dat'):
     """
     Given a directory with image files, output raw binary files with no header
     :param dirname: string path to directory containing image files
@@ -415,6 +1114,9 @@ def gen_dat_files(dirname=None, outdirname=None, ext=None,
     :param h: imh height
     :param byte_depth: number of bits per pixel
     :param ext:
+    :param workers: number of threads used to convert files; None for one per cpu core
+    :param fmt: 'dat' to output one headerless .dat file per image,
+                'chunked' to output a single compressed chunked stack file (see chunkstore.py)
     :return:
     """
     if dirname is None or outdirname is None or ext is None or w is None or h is None or byte_depth is None:
@@ -452,15 +1154,15 @@ def gen_dat_files(dirname=None, outdirname=None, ext=None,
     elif byte_order == 'B':
         byte_order = '>'
 
-    for file in files:
-        with open(os.path.join(dirname, file), 'rb') as f:
-            header = len(f.read()) - byte_depth * w * h
-            f.seek(0)
-            # generate numpy friendly data format string: ex. '<u2' = little endian, unsigned integer, 2 bytes per pixel
-            fmtstr = byte_order + 'u' + str(byte_depth)
-            data = np.fromstring(f.read()[header:], fmtstr).reshape((h,w))  # strip header information
-            with open(os.path.join(outdirname, file.split('.')[0]+'.dat'), 'wb') as o:
-                data.tofile(o)  # store image data as raw binary file
+    # generate numpy friendly data format string: ex. '<u2' = little endian, unsigned integer, 2 bytes per pixel
+    fmtstr = byte_order + 'u' + str(byte_depth)
+    if fmt == 'chunked':
+        files.sort()
+        outpath = os.path.join(outdirname, os.path.basename(os.path.normpath(dirname)) + chunkstore.EXT)
+        write_chunked_stack(dirname, outpath, files, w, h, fmtstr)
+        print("Done outputting chunked stack file {0} ...".format(outpath))
+        return
+    write_dat_files(dirname, outdirname, files, w, h, fmtstr, workers=workers)
     print("Done outputting dat files ...")
     return
 
@@ -520,50 +1222,189 @@ def find_local_maximum(window, radius=25):
     return maxLoc
 
 
-# DEPRECATED - MultiProcessing is troublesome to use with Qt
-def count_layers_new(data, ecut):
-        '''
-        Currently set to use multiprocessing.
-        Note this will not work well with the PyQt Gui
-        Alternate methods need to be used to parallelize this code for use in the main GUI
-
-        :param data: 3d numpy array of smooth data cut to specific data range
-        :param ecut: 1d list of energy values cut to specific data range
-        :return none:
-        '''
-
-        # calculate the derivative of input data
-        diff_data = np.diff(data, axis=2) / np.diff(ecut)
-
-        # smooth the derivative data
-        smooth_diff_data = np.apply_along_axis(smooth, 2, diff_data)
-        # print('Creating process pool ...')
-        # process pool
-        pool = mp.Pool(4)
-
-        # create list of 1-d arrays as input to count_mins()
-        ins = [smooth_diff_data[r,c, :] for r in range(data.shape[0])
-                                        for c in range(data.shape[1])]
-        # list of outputs from check_flat using pool.map()
-        # print('Starting parallel computation')
-        outs = pool.map(check_flat_and_count, ins)
-        pool.close()
-        pool.join()
-        # print('Closing pool and joining ...')
-        # convert back to np array and reshape
-        outs = np.array(outs).reshape((data.shape[0], data.shape[1]))
-        return outs
-
-
-# DEPRECATED
-def check_flat_and_count(data, thresh=5):
-        '''
-
-        :param data: 1d numpy array containing smoothed dI/dE data
-        :param thresh: threshold value for
-        :return:
-        '''
+# OpenCV uses fixed kernels for small sizes when sigma is not given
+SMALL_GAUSSIAN_KERNELS = {1: [1.0],
+                          3: [0.25, 0.5, 0.25],
+                          5: [0.0625, 0.25, 0.375, 0.25, 0.0625],
+                          7: [0.03125, 0.109375, 0.21875, 0.28125, 0.21875, 0.109375, 0.03125]}
+
+
+def gaussian_kernel(ksize, sigma=0):
+    """
+    1d Gaussian kernel matching cv2.getGaussianKernel()
+    :param ksize: odd integer kernel size
+    :param sigma: float standard deviation; if <= 0 it is computed from ksize as in OpenCV
+    :return: 1d float64 numpy array which sums to 1
+    """
+    if sigma <= 0 and ksize in SMALL_GAUSSIAN_KERNELS:
+        return np.array(SMALL_GAUSSIAN_KERNELS[ksize])
+    if sigma <= 0:
+        sigma = 0.3*((ksize - 1)*0.5 - 1) + 0.8
+    x = np.arange(ksize) - (ksize - 1)/2.0
+    kernel = np.exp(-x**2/(2*sigma**2))
+    return kernel/kernel.sum()
 
+
+def blur_matrix(num, kernel):
+    """
+    Banded matrix which convolves a length num axis with a 1d kernel
+    Edges are reflected without repeating the edge pixel, like cv2.BORDER_REFLECT_101
+    :param num: integer length of axis
+    :param kernel: 1d numpy array with odd length
+    :return: 2d float32 numpy array with shape (num, num)
+    """
+    mat = np.zeros((num, num))
+    half = len(kernel)//2
+    rows = np.arange(num)
+    for k, wk in enumerate(kernel):
+        cols = rows + k - half
+        if num > 1:
+            # reflect indices falling outside the axis back inside it
+            period = 2*num - 2
+            cols = np.abs(cols) % period
+            cols = np.where(cols >= num, period - cols, cols)
+        else:
+            cols = np.zeros_like(cols)
+        np.add.at(mat, (rows, cols), wk)
+    return mat.astype(np.float32)
+
+
+def track_beams(data, centers, rad, ksize=None, max_shift=None, method='max', axis=2):
+    """
+    Extract I(V) curves from LEED beams, re-centering each integration window on its beam at every energy
+    The sub-stack around each selection is blurred with a separable Gaussian in a single pass
+    of batched matrix products. The beam is then tracked through energy: at each energy the
+    beam is searched for in a window of radius rad around its position at the previous energy.
+
+    :param data: 3d numpy array or array-like with shape (h, w, E), or (E, h, w) if axis is 0
+    :param centers: list of (row, col) user selected beam positions
+    :param rad: integer half width of the square search and integration windows
+    :param ksize: odd integer size of the Gaussian kernel; defaults to min(25, rad) as in find_local_maximum()
+    :param max_shift: integer maximum distance in pixels a beam may move from its selected position;
+                      defaults to rad. The blur costs grow with the cube of rad + max_shift
+    :param method: 'max' to locate the beam at the maximum of the blurred image
+                   or 'centroid' to use the intensity weighted centroid of the search window
+    :param axis: integer index of the energy axis of data; 2 or 0, see StackData.view('spatial')
+    :return (ilists, paths): numpy array with shape (num centers, E) of intensity summed over
+             the integration window, and float64 array with shape (num centers, E, 2) of (row, col)
+             beam positions at each energy
+    """
+    if method not in ['max', 'centroid']:
+        raise ValueError("Unknown beam tracking method {}; use 'max' or 'centroid'".format(method))
+    if axis == 0:
+        num, ht, wd = data.shape
+    else:
+        ht, wd, num = data.shape
+    rad = int(rad)
+    if ksize is None:
+        ksize = min(25, rad)
+        if ksize % 2 == 0:
+            ksize += 1
+    if max_shift is None:
+        max_shift = rad
+    kernel = gaussian_kernel(ksize)
+    integer = np.issubdtype(data.dtype, np.integer) or data.dtype == np.bool_
+    ilists = np.zeros((len(centers), num), dtype=np.int64 if integer else np.float64)
+    paths = np.zeros((len(centers), num, 2))
+
+    for idx, (r_u, c_u) in enumerate(centers):
+        r_u, c_u = int(r_u), int(c_u)
+        lo_r, hi_r = max(0, r_u - rad - max_shift), min(ht, r_u + rad + max_shift)
+        lo_c, hi_c = max(0, c_u - rad - max_shift), min(wd, c_u + rad + max_shift)
+        if axis == 0:
+            frames = np.asarray(data[:, lo_r:hi_r, lo_c:hi_c])  # (E, h, w)
+        else:
+            frames = np.moveaxis(np.asarray(data[lo_r:hi_r, lo_c:hi_c, :]), 2, 0)
+        sub_ht, sub_wd = frames.shape[1:]
+        # blur along columns then rows, each as a single matrix product over all energies
+        blurred = np.dot(frames.reshape((-1, sub_wd)).astype(np.float32), blur_matrix(sub_wd, kernel).T)
+        blurred = np.dot(blur_matrix(sub_ht, kernel),
+                         blurred.reshape((num, sub_ht, sub_wd)).transpose(1, 0, 2).reshape((sub_ht, -1)))
+        blurred = blurred.reshape((sub_ht, num, sub_wd)).transpose(1, 0, 2)
+
+        pos = np.array([r_u - lo_r, c_u - lo_c], dtype=np.float64)
+        for en in range(num):
+            # search around the position at the previous energy
+            a0, a1 = max(0, int(pos[0]) - rad), min(sub_ht, int(pos[0]) + rad)
+            b0, b1 = max(0, int(pos[1]) - rad), min(sub_wd, int(pos[1]) + rad)
+            win = blurred[en, a0:a1, b0:b1]
+            if method == 'max':
+                r_bm, c_bm = np.unravel_index(np.argmax(win), win.shape)
+                pos = np.array([a0 + r_bm, b0 + c_bm], dtype=np.float64)
+            else:
+                weights = win - win.min()
+                total = weights.sum()
+                if total > 0:
+                    pos = np.array([a0 + np.dot(weights.sum(axis=1), np.arange(win.shape[0]))/total,
+                                    b0 + np.dot(weights.sum(axis=0), np.arange(win.shape[1]))/total])
+            paths[idx, en] = pos
+
+        # integration windows centered on the beam, kept inside the sub-stack
+        top = np.clip(np.round(paths[idx, :, 0]).astype(int) - rad, 0, max(0, sub_ht - 2*rad))
+        left = np.clip(np.round(paths[idx, :, 1]).astype(int) - rad, 0, max(0, sub_wd - 2*rad))
+        rows = np.minimum(top[:, None] + np.arange(2*rad), sub_ht - 1)[:, :, None]
+        cols = np.minimum(left[:, None] + np.arange(2*rad), sub_wd - 1)[:, None, :]
+        inside = (top[:, None] + np.arange(2*rad) < sub_ht)[:, :, None] & \
+                 (left[:, None] + np.arange(2*rad) < sub_wd)[:, None, :]
+        wins = frames[np.arange(num)[:, None, None], rows, cols]
+        ilists[idx] = np.where(inside, wins, 0).sum(axis=(1, 2), dtype=ilists.dtype)
+        paths[idx] += (lo_r, lo_c)
+    return ilists, paths
+
+
+def count_layers_new(data, ecut, thresh=5):
+    """
+    Count the number of minima in each I(V) curve of a data set
+    Minima are found as sign changes from - to + in the smoothed derivative, dI/dE.
+    Curves whose derivative is flat between the first and last minimum are counted as 0.
+
+    :param data: 3d numpy array of smooth data cut to specific data range
+    :param ecut: 1d list of energy values cut to specific data range
+    :param thresh: variance threshold below which the derivative is considered flat
+    :return outs: 2d numpy array with the number of minima counted at each pixel
+    """
+    # calculate and smooth the derivative of input data in a single pass
+    smooth_diff_data = derivative_cube(data, ecut, smooth_before=False, axis=2)
+
+    return check_flat_and_count(smooth_diff_data, thresh=thresh, axis=2)
+
+
+def range_variance(data, first, last, axis=-1):
+    """
+    Variance of each curve in data over the index range [first, last)
+    :param data: n-d numpy array
+    :param first: integer array of start indices, with the shape of data without axis
+    :param last: integer array of end indices, with the shape of data without axis
+    :param axis: integer axis along the curves
+    :return var: float64 array of variances; nan where the range is empty
+    """
+    data = np.moveaxis(np.asarray(data, dtype=np.float64), axis, -1)
+    # remove the mean of each curve to limit cancellation in the sum of squares
+    data = data - data.mean(axis=-1, keepdims=True)
+    zero = np.zeros(data.shape[:-1] + (1,))
+    csum = np.concatenate((zero, np.cumsum(data, axis=-1)), axis=-1)
+    csum_sq = np.concatenate((zero, np.cumsum(data**2, axis=-1)), axis=-1)
+    first = np.expand_dims(np.clip(first, 0, data.shape[-1]), -1)
+    last = np.expand_dims(np.clip(last, 0, data.shape[-1]), -1)
+    num = (last - first).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (np.take_along_axis(csum, last, -1) - np.take_along_axis(csum, first, -1)) / num
+        mean_sq = (np.take_along_axis(csum_sq, last, -1) - np.take_along_axis(csum_sq, first, -1)) / num
+    var = np.maximum(mean_sq - mean**2, 0)
+    var[num <= 0] = np.nan
+    return var[..., 0]
+
+
+def check_flat_and_count(data, thresh=5, axis=None):
+    """
+    Count minima in smoothed dI/dE data, treating curves which are flat between
+    their first and last minimum as having no minima
+    :param data: 1d numpy array containing smoothed dI/dE data, or n-d array if axis is given
+    :param thresh: variance threshold below which the curve is considered flat
+    :param axis: integer axis along the curves of an n-d array; None for a single 1d curve
+    :return: integer number of minima, or an integer array of counts if axis is given
+    """
+    if axis is None:
         mins = count_mins(data)
         if mins[0] >= 2:
             data_subset = data[mins[1]:mins[2]]
@@ -575,25 +1416,54 @@ def check_flat_and_count(data, thresh=5):
         else:
             return mins[0]
 
+    num, first, last = count_mins(data, axis=axis)
+    flat = (num >= 2) & (range_variance(data, first, last, axis=axis) <= thresh)
+    num[flat] = 0
+    return num
+
 
-# This method is slow because it isn't vectorized
-# Thus numpy can't do much to optimize
-def count_mins(data):
+def sign_change_locations(data, axis=-1):
+    """
+    Locate sign changes from - (or 0) to + along an axis
+    :param data: n-d numpy array
+    :param axis: integer axis along the curves
+    :return mask: boolean array with the shape of data; True at the first positive point after each change
+    """
+    sgn = np.sign(np.moveaxis(np.asarray(data), axis, -1))
+    mask = np.zeros(sgn.shape, dtype=bool)
+    mask[..., 1:] = (sgn[..., 1:] != sgn[..., :-1]) & (sgn[..., 1:] == 1)
+    return mask
+
+
+def mask_summary(mask):
+    """
+    Summarize a boolean mask along its last axis
+    :param mask: boolean n-d numpy array
+    :return (num, first, last): integer arrays of the number of True values and the indices
+                                of the first and last True value; -1 where there are none
+    """
+    num = mask.sum(axis=-1)
+    found = num > 0
+    first = np.where(found, np.argmax(mask, axis=-1), -1)
+    last = np.where(found, mask.shape[-1] - 1 - np.argmax(mask[..., ::-1], axis=-1), -1)
+    return num, first, last
+
+
+def count_mins(data, axis=None):
     """
     Use the intermediate value theorem to find minima in I(E) by counting the number
     of times dI/dE changes sign from - to +
 
-    :param data: 1d smoothed dI/dE signal
+    :param data: 1d smoothed dI/dE signal, or n-d array of signals if axis is given
+    :param axis: integer axis along the signals of an n-d array; None for a single 1d signal
     :return tuple: (num minima, location of first minima, location of last minima)
+                   for an n-d array each element is an integer array with the shape of data without axis
     """
-    num = 0
-    locs = []
-    sgn = np.sign(data[0])
-    for point in data:
-        if np.sign(point) != sgn and np.sign(point) == 1:
-            num += 1
-            locs.append(list(data).index(point))
-        sgn = np.sign(point)
+    if axis is not None:
+        return mask_summary(sign_change_locations(data, axis=axis))
+
+    locs = np.flatnonzero(sign_change_locations(data))
+    num = len(locs)
     if num >= 2:
         return (num, locs[0], locs[-1])
     else:
@@ -602,7 +1472,28 @@ def count_mins(data):
         return (num,  -1,  -1)
 
 
-def count_extrema(x, mins=False, both=False, verbose=False, locs=False):
+def extrema_mask(x, mins=False, both=False, axis=-1):
+    """
+    Locate strict local extrema along an axis
+    :param x: n-d numpy array
+    :param mins: bool if True locate minima, else maxima
+    :param both: bool if True locate both minima and maxima
+    :param axis: integer axis along the curves
+    :return mask: boolean array with the shape of x moved so that axis is last
+    """
+    x = np.moveaxis(np.asarray(x, dtype=np.float64), axis, -1)
+    dx = np.diff(x, axis=-1)
+    mask = np.zeros(x.shape, dtype=bool)
+    rising = dx[..., :-1] > 0
+    falling = dx[..., 1:] < 0
+    if both or not mins:
+        mask[..., 1:-1] |= rising & falling
+    if both or mins:
+        mask[..., 1:-1] |= (dx[..., :-1] < 0) & (dx[..., 1:] > 0)
+    return mask
+
+
+def count_extrema(x, mins=False, both=False, verbose=False, locs=False, axis=None):
     """
     Count num extrema in a 1D signal
     Use vectorized numpy operations where possibel for most speed
@@ -611,38 +1502,58 @@ def count_extrema(x, mins=False, both=False, verbose=False, locs=False):
     :param both: bool, if True return num mins + num max
     :param locs: also output the indicies of the extrema
     :param verbose: bool flag for additional printing info
+    :param axis: integer axis along the signals of an n-d array, ex. 2 for (h, w, E) data;
+                 None for a single 1d signal
     :return: int num_ex
+             if axis is given: tuple (num_ex, first, last) of integer maps with the shape of x without axis;
+                               first and last are the indices of the first and last extremum, -1 if none
     """
+    if axis is not None:
+        return mask_summary(extrema_mask(x, mins=mins, both=both, axis=axis))
+
     x = np.atleast_1d(x).astype('float64')
-    dx = np.diff(x)
     if verbose:
         print("First I(V):")
-        print("    {}".format(dx.shape))
-        print("    {}".format(dx.dtype))
+        print("    {}".format(np.diff(x).shape))
+        print("    {}".format(x.dtype))
+    minima = np.flatnonzero(extrema_mask(x, mins=True))
+    maxima = np.flatnonzero(extrema_mask(x, mins=False))
     if locs:
         if mins and not both:
-            dx = np.diff(-x)
-            minima = np.where((np.hstack((dx, 0)) < 0) & np.hstack((0, dx)) > 0)[0]
             return (len(minima), minima)
         elif both:
-            maxima = np.where((np.hstack((dx, 0)) < 0) & np.hstack((0, dx)) > 0)[0]
-            dx = np.diff(-x)
-            minima = np.where((np.hstack((dx, 0)) < 0) & np.hstack((0, dx)) > 0)[0]
             return (len(minima), minima, len(maxima), maxima)
         else:
-            maxima = np.where((np.hstack((dx, 0)) < 0) & np.hstack((0, dx)) > 0)[0]
             return (len(maxima), maxima)
     else:
         if mins and not both:
-            dx = np.diff(-x)
-            minima = np.where((np.hstack((dx, 0)) < 0) & np.hstack((0, dx)) > 0)[0]
             return len(minima)
         elif both:
-            maxima = np.where((np.hstack((dx, 0)) < 0) & np.hstack((0, dx)) > 0)[0]
-            dx = np.diff(-x)
-            minima = np.where((np.hstack((dx, 0)) < 0) & np.hstack((0, dx)) > 0)[0]
             return len(minima) + len(maxima)
         else:
-            maxima = np.where((np.hstack((dx, 0)) < 0) & np.hstack((0, dx)) > 0)[0]
             return len(maxima)
 
+
+def window_extremum_counts(offsets, positions, lo, hi, shape=None):
+    """
+    Count the extrema of each curve which fall inside an energy window
+    Uses a CSR-style index of extremum positions, see outofcore.extremum_index()
+    As when counting on data cut to [lo, hi), the first and last point of the
+    window are not counted; an extremum at index i is counted if lo < i < hi - 1.
+    Note that smoothing and minimum peak distance were applied over the full energy
+    axis, so near the window edges counts can differ from those of the cut data.
+
+    :param offsets: integer array of length number of curves + 1
+    :param positions: integer array of sorted extremum indices per curve
+    :param lo: integer index of the first energy in the window
+    :param hi: integer index one past the last energy in the window
+    :param shape: optional tuple (h, w) to reshape the counts into an image
+    :return counts: int32 array with one count per curve
+    """
+    inside = (positions > lo) & (positions < hi - 1)
+    csum = np.zeros(len(inside) + 1, dtype=np.int64)
+    np.cumsum(inside, out=csum[1:])
+    counts = (csum[offsets[1:]] - csum[offsets[:-1]]).astype(np.int32)
+    if shape is not None:
+        counts = counts.reshape(shape)
+    return counts
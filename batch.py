@@ -0,0 +1,487 @@
+"""
+Headless batch processing of LEEM and LEED experiments
+
+Runs the analyses of the GUI on experiments described by Experiment YAML
+files, see Experiment-Yaml-Example/Experiment.yaml, without Qt so that data
+can be processed on machines without a display. What is computed is set by
+a recipe YAML file, see Recipe-Yaml-Example/Recipe.yaml:
+    Minima: maps of the number of minima in smoothed I(V) curves in energy windows
+    Curves: I(V) curves of single pixels
+    Spots: LEED I(V) curves of beams with the background subtracted
+
+Experiments are processed in parallel, one per worker process. The output of
+each experiment is written to a directory named after its YAML file:
+    minima_<emin>_<emax>.npy   int32 map of minima counted from emin up to, not including, emax
+    curve_r<row>_c<col>.txt    I(V) curve of a pixel
+    spot_<k>.txt               I(V) curve of beam k
+    *_smooth.txt               smoothed copies of the curves above, if requested
+    spot_<k>_corrected.txt     I(V) curve of beam k with the background subtracted
+    spot_<k>_background.txt    background subtracted from beam k
+    spot_<k>_path.txt          beam position at each energy, when beams are tracked
+    background_average.txt     background averaged over all beams
+    timings.json               time in seconds taken by each step
+Curves are tab separated text with a header line, as written by the GUI.
+A summary of every experiment is written to batch_summary.json in the output directory.
+
+Usage:
+    python batch.py recipe.yaml exp1.yaml exp2.yaml ... -o results -j 4
+
+This module does not depend on Qt.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import yaml
+import LEEMFUNCTIONS as LF
+import outofcore
+import stackcache
+import chunkstore
+import derivedcache
+from data import LeemData, LeedData
+from experiment import Experiment
+
+DEF_OUTPUT_DIR = 'please_batch'
+SUMMARY_NAME = 'batch_summary.json'
+
+
+def recipe_setting(settings, key, default):
+    """
+    :param settings: dict of one recipe section
+    :param key: string setting name
+    :param default: value used when the setting is missing or left blank, as in the template file
+    :return: the setting
+    """
+    value = settings.get(key)
+    return default if value is None else value
+
+
+def read_recipe(path):
+    """
+    Read an analysis recipe from a YAML file
+    :param path: string path to recipe YAML file
+    :return: dict of analysis settings with defaults filled in
+    :raises ValueError: if the recipe is not valid
+    """
+    with open(path, 'r') as f:
+        settings = yaml.safe_load(f)
+    if not isinstance(settings, dict) or not isinstance(settings.get('Recipe'), dict):
+        raise ValueError("Recipe YAML {} must contain a Recipe section".format(path))
+    rcp_settings = settings['Recipe']
+    smth_settings = rcp_settings.get('Smoothing') or {}
+    recipe = {'window_len': recipe_setting(smth_settings, 'Window Length', 10),
+              'window_type': recipe_setting(smth_settings, 'Window Type', 'flat'),
+              'smooth_curves': recipe_setting(smth_settings, 'Smooth Curves', False),
+              'windows': None,
+              'mpd': 10,
+              'fast_index': False,
+              'pixels': [],
+              'spots': [],
+              'radius': 20,
+              'track': True,
+              'background': None}
+    try:
+        recipe['window_len'] = int(recipe['window_len'])
+        if LF.check_smoothing_params(recipe['window_len'], recipe['window_type']) is None:
+            raise ValueError("Invalid Smoothing settings: Window Length {0}, Window Type {1}".format(
+                recipe['window_len'], recipe['window_type']))
+
+        if 'Minima' in rcp_settings:
+            min_settings = rcp_settings['Minima'] or {}
+            recipe['mpd'] = int(recipe_setting(min_settings, 'Peak Distance', 10))
+            recipe['fast_index'] = bool(recipe_setting(min_settings, 'Fast Index', False))
+            # a single window over all energies unless windows are given
+            recipe['windows'] = [tuple(win) for win in recipe_setting(min_settings, 'Energy Windows', [[None, None]])]
+            if any(len(win) != 2 for win in recipe['windows']):
+                raise ValueError("Energy Windows must be a list of [min, max] energies in eV")
+
+        recipe['pixels'] = [tuple(int(val) for val in pix) for pix in recipe_setting(rcp_settings, 'Curves', [])]
+
+        if 'Spots' in rcp_settings:
+            spot_settings = rcp_settings['Spots'] or {}
+            recipe['spots'] = [tuple(spot) for spot in recipe_setting(spot_settings, 'Positions', [])]
+            recipe['radius'] = int(recipe_setting(spot_settings, 'Radius', 20))
+            recipe['track'] = bool(recipe_setting(spot_settings, 'Track', True))
+            # false skips the background subtraction
+            recipe['background'] = recipe_setting(spot_settings, 'Background', 'perimeter') or None
+            if recipe['background'] is not None and recipe['background'] not in LF.BACKGROUND_MODELS:
+                raise ValueError("Unknown background model {0}; valid models are {1}".format(
+                    recipe['background'], LF.BACKGROUND_MODELS))
+    except TypeError as e:
+        # ex. a list where a number is expected
+        raise ValueError("Invalid setting in recipe YAML {0}: {1}".format(path, e))
+    return recipe
+
+
+def load_stack(exp):
+    """
+    Load the data set of an experiment, as the GUI does for an Experiment YAML file
+    :param exp: Experiment filled from a YAML file
+    :return: LeemData or LeedData holding the data set and its energies
+    """
+    stack = LeedData() if exp.exp_type == 'LEED' else LeemData()
+    stack.data_dir = str(exp.path)
+    stack.derived.spill_dir = (os.path.join(stack.data_dir, derivedcache.SPILL_NAME)
+                               if exp.derived_cache else None)
+    stack.ht = exp.imh
+    stack.wd = exp.imw
+    indices, stack.elist = exp.energies()
+    data_type = exp.data_type.lower()
+
+    if data_type == 'raw':
+        def loader():
+            return LF.process_LEEM_Data(dirname=stack.data_dir, ht=exp.imh, wd=exp.imw,
+                                        bits=exp.bit, byte=exp.byte_order, mmap=exp.mmap,
+                                        workers=exp.workers, indices=indices)
+        files = stackcache.stack_files(stack.data_dir, '.dat') if exp.cache else None
+        if files:
+            # same cache parameters as qthreads.WorkerThread.load_raw_data() so caches are shared with the GUI
+            fmt = LF.raw_format_string(exp.bit, exp.byte_order)
+            header = (os.stat(os.path.join(stack.data_dir, files[0])).st_size -
+                      np.dtype(fmt).itemsize * exp.imh * exp.imw)
+            cache_params = {'ht': exp.imh, 'wd': exp.imw, 'bits': exp.bit, 'byte': exp.byte_order,
+                            'header': header, 'indices': indices}
+            dat_3d = stackcache.cached_load(stack.data_dir, '.dat', loader, elist=stack.elist,
+                                            params=cache_params)
+        else:
+            dat_3d = loader()
+    elif data_type == 'image':
+        def loader():
+            return LF.get_img_array(stack.data_dir, ext=exp.ext, workers=exp.workers, indices=indices)
+        if exp.cache:
+            cache_params = {'ext': exp.ext, 'swap': False, 'indices': indices}
+            dat_3d = stackcache.cached_load(stack.data_dir, exp.ext, loader, elist=stack.elist,
+                                            params=cache_params)
+        else:
+            dat_3d = loader()
+    elif data_type == 'chunked':
+        stack_path = chunkstore.find_stack(stack.data_dir)
+        if stack_path is None:
+            raise IOError("No chunked stack file found at {}".format(stack.data_dir))
+        dat_3d = chunkstore.ChunkStack(stack_path)
+    else:
+        raise ValueError("Unknown Data Type {}; valid types are Raw, Image or Chunked".format(exp.data_type))
+
+    if dat_3d is None:
+        raise IOError("No {0} files found in {1}".format(exp.ext, stack.data_dir))
+    if dat_3d.shape[2] != len(stack.elist):
+        raise ValueError("Data has {0} energies but the Energy Parameters give {1}".format(
+            dat_3d.shape[2], len(stack.elist)))
+    stack.dat_3d = dat_3d
+    return stack
+
+
+def write_curve(path, elist, ilist):
+    """
+    Write an I(V) curve as tab separated text, in the format of the GUI's text output
+    :param path: string path to output file
+    :param elist: list of energies in eV
+    :param ilist: list of values, one per energy
+    """
+    with open(path, 'w') as f:
+        f.write('E' + '\t' + 'I' + '\n')
+        for index, item in enumerate(elist):
+            f.write(str(item) + '\t' + str(ilist[index]) + '\n')
+
+
+def window_minima(stack, energies, recipe, budget=None):
+    """
+    Count the minima of every I(V) curve smoothed over one energy window, as by the GUI's Count Layers
+    The data is cut to the window before smoothing, as by scheduler.SmoothJob, so the counts
+    match those of the GUI. Smoothed data held in memory is shared with the GUI through the
+    derived data cache.
+    :param energies: slice of the energy axis
+    :return: int32 array with shape (h, w)
+    """
+    params = {'window_len': recipe['window_len'], 'window_type': recipe['window_type'],
+              'energies': [energies.start, energies.stop]}
+    fingerprint = stack.fingerprint()
+    smoothed = stack.derived.get(fingerprint, 'smooth', params)
+    path = None
+    if smoothed is None:
+        data = stack.view('smooth')[0]
+        # data which is not held in memory is smoothed into a scratch file
+        path = None if outofcore.in_memory(data) else outofcore.scratch_path()
+        smoothed = outofcore.smooth_stack(data, window_len=recipe['window_len'], window_type=recipe['window_type'],
+                                          out_path=path, energies=energies, budget=budget)
+        if path is None:
+            stack.derived.put(fingerprint, 'smooth', params, smoothed)
+    try:
+        return outofcore.minima_count_map(smoothed, mpd=recipe['mpd'], budget=budget)
+    finally:
+        del smoothed
+        if path is not None:
+            os.remove(path)
+
+
+def indexed_minima(stack, recipe, budget=None):
+    """
+    Index the minima of every smoothed I(V) curve over the full energy axis with outofcore.extremum_index()
+    The index is shared with the GUI's Live Layer Map through the derived data cache.
+    :return: tuple (offsets, positions) from outofcore.extremum_index()
+    """
+    params = {'window_len': recipe['window_len'], 'window_type': recipe['window_type'], 'mpd': recipe['mpd']}
+    fingerprint = stack.fingerprint()
+    offsets = stack.derived.get(fingerprint, 'minima_offsets', params)
+    positions = stack.derived.get(fingerprint, 'minima_positions', params)
+    if offsets is None or positions is None:
+        offsets, positions = outofcore.extremum_index(stack.view('smooth')[0], mpd=recipe['mpd'],
+                                                      window_len=recipe['window_len'],
+                                                      window_type=recipe['window_type'],
+                                                      budget=budget)
+        stack.derived.put(fingerprint, 'minima_offsets', params, offsets)
+        stack.derived.put(fingerprint, 'minima_positions', params, positions)
+    return offsets, positions
+
+
+def minima_maps(stack, recipe, outdir, budget=None):
+    """
+    Count the minima of every smoothed I(V) curve in each energy window of the recipe
+    As in the GUI the window runs from its min energy up to, but not including, its max energy.
+    Each window is smoothed and searched separately unless the recipe sets Fast Index; the minima
+    are then indexed once over the full energy axis, which is faster for many windows but
+    smooths across the window edges, so counts near the edges can differ from the GUI's.
+    :return: list of string paths to the .npy maps written
+    """
+    index = indexed_minima(stack, recipe, budget=budget) if recipe['fast_index'] else None
+    paths = []
+    for emin, emax in recipe['windows']:
+        indices = LF.energy_window(stack.elist, emin, emax)[0]
+        if len(indices) < 2:
+            print("Warning: fewer than two energies between {0} and {1} eV; skipping window".format(emin, emax))
+            continue
+        lo, hi = int(indices[0]), int(indices[-1])
+        if index is None:
+            counts = window_minima(stack, slice(lo, hi), recipe, budget=budget)
+        else:
+            counts = LF.window_extremum_counts(index[0], index[1], lo, hi, shape=stack.dat_3d.shape[:2])
+        path = os.path.join(outdir, 'minima_{0}_{1}.npy'.format(stack.elist[lo], stack.elist[hi]))
+        np.save(path, counts)
+        paths.append(path)
+    return paths
+
+
+def pixel_curves(stack, recipe, outdir):
+    """
+    Write the I(V) curve of each pixel in the recipe, and its smoothed copy if requested
+    :return: list of string paths to the files written
+    """
+    paths = []
+    for row, col in recipe['pixels']:
+        if not (0 <= row < stack.dat_3d.shape[0] and 0 <= col < stack.dat_3d.shape[1]):
+            print("Warning: pixel ({0}, {1}) is outside the image; skipping curve".format(row, col))
+            continue
+        ilist = np.asarray(stack.curve(row, col))
+        path = os.path.join(outdir, 'curve_r{0}_c{1}.txt'.format(row, col))
+        write_curve(path, stack.elist, ilist.tolist())
+        paths.append(path)
+        if recipe['smooth_curves']:
+            path = os.path.join(outdir, 'curve_r{0}_c{1}_smooth.txt'.format(row, col))
+            write_curve(path, stack.elist, LF.smooth(ilist, recipe['window_len'], recipe['window_type']).tolist())
+            paths.append(path)
+    return paths
+
+
+def spot_curves(stack, recipe, outdir):
+    """
+    Extract the I(V) curve of each LEED beam in the recipe and subtract its background
+    Beams are tracked through energy with LF.track_beams() as in the GUI's extraction,
+    or integrated over fixed windows when tracking is off. The background of the fixed
+    window around each selected position is subtracted as by the GUI's Subtract Background.
+    :return: list of string paths to the files written
+    """
+    rad = recipe['radius']
+    rows = np.array([spot[0] for spot in recipe['spots']])
+    cols = np.array([spot[1] for spot in recipe['spots']])
+    r0, r1 = LF.window_bounds((rows - rad).astype(int), (rows + rad).astype(int), stack.dat_3d.shape[0])
+    c0, c1 = LF.window_bounds((cols - rad).astype(int), (cols + rad).astype(int), stack.dat_3d.shape[1])
+
+    paths = []
+    if recipe['track']:
+        frames, axis = stack.view('spatial')
+        ilists, beam_paths = LF.track_beams(frames, list(zip(rows, cols)), rad, axis=axis)
+    else:
+        ilists, beam_paths = stack.window_sums(r0, r1, c0, c1), None
+    for idx, ilist in enumerate(ilists):
+        path = os.path.join(outdir, 'spot_{}.txt'.format(idx))
+        write_curve(path, stack.elist, np.asarray(ilist).tolist())
+        paths.append(path)
+        if recipe['smooth_curves']:
+            path = os.path.join(outdir, 'spot_{}_smooth.txt'.format(idx))
+            write_curve(path, stack.elist, LF.smooth(np.asarray(ilist), recipe['window_len'],
+                                                     recipe['window_type']).tolist())
+            paths.append(path)
+        if beam_paths is not None:
+            path = os.path.join(outdir, 'spot_{}_path.txt'.format(idx))
+            np.savetxt(path, np.column_stack((stack.elist, beam_paths[idx])), fmt='%g', delimiter='\t',
+                       header='E\tRow\tCol', comments='')
+            paths.append(path)
+
+    if recipe['background'] is not None:
+        corrected, background, average = stack.window_background(r0, r1, c0, c1, model=recipe['background'])
+        for idx in range(len(corrected)):
+            path = os.path.join(outdir, 'spot_{}_corrected.txt'.format(idx))
+            write_curve(path, stack.elist, corrected[idx].tolist())
+            paths.append(path)
+            path = os.path.join(outdir, 'spot_{}_background.txt'.format(idx))
+            write_curve(path, stack.elist, background[idx].tolist())
+            paths.append(path)
+        path = os.path.join(outdir, 'background_average.txt')
+        write_curve(path, stack.elist, average.tolist())
+        paths.append(path)
+    return paths
+
+
+def failed_summary(config, outdir, error):
+    """
+    Summary of an experiment which run_experiment() did not return one for
+    :param error: string describing the error
+    :return: dict summary as from run_experiment()
+    """
+    return {'experiment': config, 'output': outdir, 'status': 'failed', 'error': error,
+            'timings': {}, 'files': []}
+
+
+def run_experiment(config, recipe, outdir):
+    """
+    Load one experiment and run every analysis of the recipe on it
+    Errors are caught and reported in the summary so that one bad experiment
+    does not stop the rest of a batch.
+    :param config: string path to Experiment YAML file
+    :param recipe: dict from read_recipe()
+    :param outdir: string path to the output directory for this experiment
+    :return: dict summary with keys experiment, output, status, error, timings and files
+    """
+    summary = {'experiment': config, 'output': outdir, 'status': 'done', 'error': None,
+               'timings': {}, 'files': []}
+    timings = summary['timings']
+    start = time.time()
+    try:
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        exp = Experiment()
+        exp.fromFile(config)
+        if exp.exp_type not in ['LEEM', 'LEED']:
+            raise ValueError("Unrecognized Experiment Type {}; valid types are LEEM or LEED".format(exp.exp_type))
+
+        ts = time.time()
+        stack = load_stack(exp)
+        timings['load'] = round(time.time() - ts, 3)
+        print("Loaded {0} with shape {1} in {2} seconds".format(config, stack.dat_3d.shape, timings['load']))
+
+        steps = []
+        if recipe['windows'] is not None:
+            steps.append(('minima', lambda: minima_maps(stack, recipe, outdir, budget=exp.budget)))
+        if recipe['pixels']:
+            steps.append(('curves', lambda: pixel_curves(stack, recipe, outdir)))
+        if recipe['spots']:
+            steps.append(('spots', lambda: spot_curves(stack, recipe, outdir)))
+        for name, step in steps:
+            ts = time.time()
+            summary['files'].extend(step())
+            timings[name] = round(time.time() - ts, 3)
+    except Exception as e:
+        summary['status'] = 'failed'
+        summary['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        print("Error processing {}:".format(config))
+        traceback.print_exc()
+    timings['total'] = round(time.time() - start, 3)
+    if os.path.isdir(outdir):
+        with open(os.path.join(outdir, 'timings.json'), 'w') as f:
+            json.dump(timings, f, indent=4)
+    return summary
+
+
+def output_dirs(configs, root):
+    """
+    One output directory per experiment, named after its YAML file
+    :param configs: list of string paths to Experiment YAML files
+    :param root: string path to the batch output directory
+    :return: list of string paths, unique even when YAML files in different directories share a name
+    """
+    dirs = []
+    for config in configs:
+        name = os.path.splitext(os.path.basename(config))[0]
+        path, num = os.path.join(root, name), 1
+        while path in dirs:
+            num += 1
+            path = os.path.join(root, '{0}_{1}'.format(name, num))
+        dirs.append(path)
+    return dirs
+
+
+def run_batch(configs, recipe, root=DEF_OUTPUT_DIR, jobs=None):
+    """
+    Process experiments in parallel, one per worker process
+    :param configs: list of string paths to Experiment YAML files
+    :param recipe: dict from read_recipe()
+    :param root: string path to the batch output directory
+    :param jobs: integer number of experiments processed at once, or None for one per cpu core
+    :return: list of summary dicts from run_experiment(), in the order of configs
+    """
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    dirs = output_dirs(configs, root)
+    jobs = min(LF.resolve_workers(jobs), len(configs))
+    summaries = [failed_summary(config, dirs[idx], 'Not processed') for idx, config in enumerate(configs)]
+    try:
+        if jobs <= 1:
+            for idx, config in enumerate(configs):
+                summaries[idx] = run_experiment(config, recipe, dirs[idx])
+                print("Finished {0} ({1}/{2})".format(config, idx + 1, len(configs)))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {executor.submit(run_experiment, config, recipe, dirs[idx]): idx
+                           for idx, config in enumerate(configs)}
+                for num, future in enumerate(as_completed(futures), 1):
+                    idx = futures[future]
+                    try:
+                        summaries[idx] = future.result()
+                    except Exception as e:
+                        # ex. BrokenProcessPool if a worker process died; the other experiments carry on
+                        summaries[idx] = failed_summary(configs[idx], dirs[idx],
+                                                        '{0}: {1}'.format(type(e).__name__, e))
+                        print("Error processing {0}: {1}".format(configs[idx], summaries[idx]['error']))
+                    print("Finished {0} ({1}/{2})".format(configs[idx], num, len(configs)))
+    finally:
+        # written even if the batch is interrupted, listing what was done so far
+        with open(os.path.join(root, SUMMARY_NAME), 'w') as f:
+            json.dump(summaries, f, indent=4)
+    return summaries
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: list of string arguments; defaults to sys.argv[1:]
+    :return: integer exit status; 1 if any experiment failed
+    """
+    parser = argparse.ArgumentParser(description="Process LEEM and LEED experiments without the GUI")
+    parser.add_argument('recipe', help="recipe YAML file, see Recipe-Yaml-Example/Recipe.yaml")
+    parser.add_argument('experiments', nargs='+', help="Experiment YAML files")
+    parser.add_argument('-o', '--output', default=DEF_OUTPUT_DIR, help="output directory")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="experiments processed in parallel; defaults to one per cpu core")
+    args = parser.parse_args(argv)
+    try:
+        recipe = read_recipe(args.recipe)
+    except (IOError, ValueError, TypeError, yaml.YAMLError) as e:
+        print("Error in recipe YAML: {}".format(e))
+        return 1
+
+    ts = time.time()
+    summaries = run_batch(args.experiments, recipe, root=args.output, jobs=args.jobs)
+    failed = [summary for summary in summaries if summary['status'] != 'done']
+    print("Processed {0} experiments in {1} seconds; {2} failed".format(len(summaries),
+                                                                      round(time.time() - ts, 2), len(failed)))
+    for summary in failed:
+        print("  {0}: {1}".format(summary['experiment'], summary['error']))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""
+Chunked, compressed on-disk format for 3d image stacks
+
+The stack with shape (ht, wd, num energies) is split into chunks of
+(tile_y, tile_x, energy_block) which are compressed individually with
+zlib or lzma. Reading a single energy slice or a single I(V) curve only
+decompresses the chunks which intersect the request.
+
+File layout:
+    8 byte magic string
+    compressed chunks, one after another
+    JSON index (shape, dtype, chunk shape, codec, energy list, chunk offsets)
+    16 byte trailer: little-endian uint64 offset and uint64 length of the index
+    8 byte magic string
+
+Chunks are written as soon as one energy block of frames has been
+collected, thus a stack can be converted without holding it in memory.
+"""
+import os
+import copy
+import json
+import lzma
+import zlib
+import struct
+import threading
+from collections import OrderedDict
+import numpy as np
+
+EXT = '.pleasechunk'
+MAGIC = b'PLEASECK'
+VERSION = 1
+TRAILER = struct.Struct('<QQ')
+DEFAULT_CHUNKS = (64, 64, 16)
+CODECS = {'zlib': (lambda buf, level: zlib.compress(buf, level), zlib.decompress),
+          'lzma': (lambda buf, level: lzma.compress(buf, preset=level), lzma.decompress)}
+
+
+class ChunkWriter(object):
+    """
+    Stream image frames into a chunked stack file
+    Usage:
+        with ChunkWriter(path, ht, wd, '<u2') as writer:
+            for img in images:
+                writer.append(img)
+    """
+
+    def __init__(self, path, ht, wd, dtype, chunks=DEFAULT_CHUNKS, codec='zlib', level=6, elist=None):
+        """
+        :param path: string path to output file
+        :param ht: integer pixel height of image
+        :param wd: integer pixel width of image
+        :param dtype: numpy dtype of the pixel data
+        :param chunks: tuple (tile_y, tile_x, energy_block) chunk shape
+        :param codec: string name of compression codec, 'zlib' or 'lzma'
+        :param level: integer compression level
+        :param elist: optional list of energy values in eV stored in the index
+        """
+        if codec not in CODECS:
+            raise ValueError("Unknown codec {0}; valid codecs are {1}".format(codec, sorted(CODECS.keys())))
+        self.path = path
+        self.ht = ht
+        self.wd = wd
+        self.dtype = np.dtype(dtype)
+        self.chunks = tuple(int(n) for n in chunks)
+        self.codec = codec
+        self.level = level
+        self.elist = elist
+        self.num_frames = 0
+        self.records = []
+        self._block = np.empty((ht, wd, self.chunks[2]), dtype=self.dtype)
+        self._block_len = 0
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+    def append(self, frame):
+        """
+        Add the next energy slice to the stack
+        :param frame: 2d numpy array of shape (ht, wd)
+        """
+        self._block[:, :, self._block_len] = frame
+        self._block_len += 1
+        self.num_frames += 1
+        if self._block_len == self.chunks[2]:
+            self._flush()
+
+    def _flush(self):
+        if self._block_len == 0:
+            return
+        ty, tx, te = self.chunks
+        ie = (self.num_frames - self._block_len) // te
+        compress = CODECS[self.codec][0]
+        for iy in range(0, -(-self.ht // ty)):
+            for ix in range(0, -(-self.wd // tx)):
+                chunk = np.ascontiguousarray(self._block[iy * ty:(iy + 1) * ty,
+                                                         ix * tx:(ix + 1) * tx,
+                                                         :self._block_len])
+                buf = compress(chunk.tobytes(), self.level)
+                self.records.append([iy, ix, ie, self._file.tell(), len(buf)])
+                self._file.write(buf)
+        self._block_len = 0
+
+    def close(self):
+        """
+        Write any remaining frames and the index, then close the file
+        """
+        if self._file.closed:
+            return
+        self._flush()
+        index = {'version': VERSION,
+                 'shape': [self.ht, self.wd, self.num_frames],
+                 'dtype': self.dtype.str,
+                 'chunks': list(self.chunks),
+                 'codec': self.codec,
+                 'elist': [float(en) for en in self.elist] if self.elist is not None else None,
+                 'records': self.records}
+        index = json.dumps(index).encode('utf-8')
+        offset = self._file.tell()
+        self._file.write(index)
+        self._file.write(TRAILER.pack(offset, len(index)))
+        self._file.write(MAGIC)
+        self._file.close()
+
+
+def write_stack(path, data, chunks=DEFAULT_CHUNKS, codec='zlib', level=6, elist=None):
+    """
+    Write a 3d stack to a chunked stack file
+    :param path: string path to output file
+    :param data: 3d numpy array, np.memmap or LF.MemmapStack with shape (ht, wd, num energies)
+    :param chunks: tuple (tile_y, tile_x, energy_block) chunk shape
+    :param codec: string name of compression codec, 'zlib' or 'lzma'
+    :param level: integer compression level
+    :param elist: optional list of energy values in eV
+    :return none:
+    """
+    with ChunkWriter(path, data.shape[0], data.shape[1], data.dtype,
+                     chunks=chunks, codec=codec, level=level, elist=elist) as writer:
+        for idx in range(data.shape[2]):
+            writer.append(data[:, :, idx])
+
+
+def _axis_groups(key, length, size):
+    """
+    Split an index along one axis into groups falling within the same chunk
+    :return (groups, scalar): list of (chunk number, output positions, positions within chunk)
+                              and boolean True if the axis is indexed by an integer
+    """
+    idx = np.arange(length)[key]
+    scalar = np.ndim(idx) == 0
+    idx = np.atleast_1d(idx)
+    chunk_num = idx // size
+    groups = []
+    for num in np.unique(chunk_num):
+        pos = np.flatnonzero(chunk_num == num)
+        groups.append((int(num), pos, idx[pos] - num * size))
+    return groups, scalar, idx.size
+
+
+class ChunkStack(object):
+    """
+    Read-only 3d stack backed by a chunked stack file
+    Supports the indexing used throughout the GUI on a (h, w, E) array:
+        stack[:, :, idx] -> 2d image
+        stack[r, c, :] -> 1d I(V) curve
+        stack[r0:r1, c0:c1, :] -> 3d sub-stack
+    Only the chunks touched by a request are read and decompressed.
+    Recently used chunks are kept in a small cache.
+    A stack may be read from several threads at once, ex. while images are prefetched for display.
+    """
+
+    def __init__(self, path, cache_chunks=64):
+        """
+        :param path: string path to chunked stack file
+        :param cache_chunks: integer number of decompressed chunks to keep in memory
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{0} is not a chunked stack file".format(path))
+            f.seek(-(TRAILER.size + len(MAGIC)), os.SEEK_END)
+            offset, length = TRAILER.unpack(f.read(TRAILER.size))
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("Chunked stack file {0} is truncated".format(path))
+            f.seek(offset)
+            index = json.loads(f.read(length).decode('utf-8'))
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.ndim = 3
+        self.chunks = tuple(index['chunks'])
+        self.codec = index['codec']
+        self.elist = index['elist']
+        self.records = {(iy, ix, ie): (off, ln) for iy, ix, ie, off, ln in index['records']}
+        self.cache_chunks = cache_chunks
+        self._cache = OrderedDict()
+        # guards the shared file position and the chunk cache
+        self._lock = threading.Lock()
+        self._file = open(path, 'rb')
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1] * self.shape[2]
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._cache.clear()
+
+    def chunk(self, iy, ix, ie):
+        """
+        Read and decompress a single chunk
+        :return: 3d numpy array; chunks on the edges of the stack may be smaller than self.chunks
+        """
+        key = (iy, ix, ie)
+        offset, length = self.records[key]
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            self._file.seek(offset)
+            raw = self._file.read(length)
+        # decompress outside the lock so other threads may read meanwhile
+        buf = CODECS[self.codec][1](raw)
+        shape = tuple(min(size, total - num * size)
+                      for num, size, total in zip(key, self.chunks, self.shape))
+        data = np.frombuffer(buf, dtype=self.dtype).reshape(shape)
+        with self._lock:
+            self._cache[key] = data
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_chunks:
+                self._cache.popitem(last=False)
+        return data
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3 or any(k is Ellipsis for k in key):
+            raise IndexError("ChunkStack supports at most three explicit indices")
+        key = key + (slice(None),) * (3 - len(key))
+
+        axes = [_axis_groups(k, total, size) for k, total, size in zip(key, self.shape, self.chunks)]
+        out = np.empty(tuple(n for _, _, n in axes), dtype=self.dtype)
+        for iy, out_r, loc_r in axes[0][0]:
+            for ix, out_c, loc_c in axes[1][0]:
+                for ie, out_e, loc_e in axes[2][0]:
+                    out[np.ix_(out_r, out_c, out_e)] = self.chunk(iy, ix, ie)[np.ix_(loc_r, loc_c, loc_e)]
+        squeeze = tuple(ax for ax, (_, scalar, _) in enumerate(axes) if scalar)
+        if squeeze:
+            out = out.squeeze(axis=squeeze)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :, :]
+        if dtype is not None:
+            return out.astype(dtype)
+        return out
+
+    def byteswap(self):
+        """
+        Return a new ChunkStack interpreting the same file with the opposite byte order
+        The file handle is shared; no data is copied or read from disk
+        """
+        swapped = copy.copy(self)
+        swapped.dtype = self.dtype.newbyteorder()
+        # cached chunks were decoded with the old byte order
+        swapped._cache = OrderedDict()
+        return swapped
+
+
+def find_stack(path):
+    """
+    Locate a chunked stack file
+    :param path: string path to a chunked stack file or to a directory containing one
+    :return: string path to chunked stack file, or None if not found
+    """
+    if os.path.isfile(path):
+        return path
+    if os.path.isdir(path):
+        files = sorted(name for name in os.listdir(path) if name.endswith(EXT))
+        if files:
+            return os.path.join(path, files[0])
+    return None
@@ -1,107 +1,72 @@
 import sys
 import time
 import numpy as np
-# from genericthread import GenericThread
+import minimacounter
 from PyQt4 import QtCore, QtGui
-from queue import Queue
 
 
-class MinimaCounterMT(QtCore.QObject):
-
-    def __init__(self, data, num_threads):
+class MinimaCounterMT(QtCore.QThread):
+    """
+    Count minima in every I(V) curve of a data set with minimacounter.count_minima()
+    The work is done by separate processes sharing the data set in memory;
+    this thread only waits on them so the GUI stays responsive.
+    """
+
+    # (number of tiles processed, total number of tiles)
+    progress = QtCore.pyqtSignal(int, int)
+    # 2d numpy array of minima counts, or None if cancelled
+    output = QtCore.pyqtSignal(object)
+
+    def __init__(self, data, num_workers=None, mpd=10, energies=slice(None)):
+        """
+        :param data: 3d numpy array of smoothed I(V) data with shape (h, w, E)
+        :param num_workers: number of worker processes; None for one per cpu core
+        :param mpd: minimum peak distance in energy steps
+        :param energies: slice selecting the energy window to process
+        """
         super(MinimaCounterMT, self).__init__()
-        self.data_to_process = Queue()
-        self.maxThreadCount = num_threads
-        self.currentThreadCount = 0
         self.input_data = data
-        self.coords = [(r, c) for r in range(self.input_data.shape[0])
-                       for c in range(self.input_data.shape[1])]
-        self.output_mask = np.zeros((self.input_data.shape[0],
-                                    self.input_data.shape[1]))
-        self.workers = []
+        self.num_workers = num_workers
+        self.mpd = mpd
+        self.energies = energies
+        self.output_mask = None
+        self._cancelled = False
+
+    def cancel(self):
+        """
+        Stop the calculation after the tiles currently being processed
+        """
+        self._cancelled = True
 
-    def start(self):
+    def run(self):
         print("Starting conditions:")
         print("Input Data Shape: {}".format(self.input_data.shape))
-        print("Num Data Points to Process: {}".format(len(self.coords)))
-        print("Placing input data onto Queue for processing ...")
+        print("Num Data Points to Process: {}".format(self.input_data.shape[0] * self.input_data.shape[1]))
         start = time.time()
-
-        for coord in self.coords:
-            self.data_to_process.put(coord)
-
-        while self.currentThreadCount < self.maxThreadCount:
-            self.workers.append(TaskWorker(queue=self.data_to_process,
-                                           task=self.test_count_mins))
-            self.currentThreadCount += 1
-
-        # Threads have been instantiated
-        # begin work
-        for thread in self.workers:
-            thread.start()
-        working = True
-        # wait for work to finish
-        while working:
-            for thread in self.workers:
-                if thread.isFinished():
-                    thread.terminate()
-                    self.currentThreadCount -= 1
-                    if self.currentThreadCount == 0:
-                        working = False
-        self.finish(start)
-
-    def test_count_mins(self, data_point):
-        r = data_point[0]
-        c = data_point[1]
-        self.output_mask[r, c] = -1
-        time.sleep(1)  # simulate longer running calculation
-
-    '''
-    @QtCore.pyqtSlot(str)
-    def decrement_thread_count(self, message):
-        print("Recieved done_signal from thread ... {}".format(message))
-        print("Decrementing Thread count.")
-        self.currentThreadCount -= 1
-    '''
-
-    def finish(self, t):
-        print("All workers have finished processing Data ...")
-        print(self.output_mask)
-        print("Elapsed: {}".format(time.time() - t))
-        sys.exit(0)
-
-
-class TaskWorker(QtCore.QThread):
-
-    # done_signal = QtCore.pyqtSignal(str)
-
-    def __init__(self, queue, task):
-        super(TaskWorker, self).__init__(parent=None)
-        self.work_queue = queue
-        self.running = True
-        self.task = task
-
-    def run(self):
-        while self.running:
-            # check for work
-            if not self.work_queue.empty():
-                # execute task
-                data_point = self.work_queue.get()
-                self.task(data_point)
-            else:
-                # no work to do
-                # print("Work complete - exiting Thread ...")
-                self.running = False
+        self.output_mask = minimacounter.count_minima(self.input_data, mpd=self.mpd,
+                                                      workers=self.num_workers,
+                                                      energies=self.energies,
+                                                      progress=self.progress.emit,
+                                                      cancelled=lambda: self._cancelled)
+        if self.output_mask is None:
+            print("Minima counting cancelled ...")
+        else:
+            print("All workers have finished processing Data ...")
+        print("Elapsed: {}".format(time.time() - start))
+        self.output.emit(self.output_mask)
 
 
 def main():
 
-    # max threads
-    num_threads = 12
+    # max worker processes
+    num_workers = 4
 
     app = QtGui.QApplication(sys.argv)
-    data = np.zeros((5, 5, 5))  # 25 total data points to process
-    cm = MinimaCounterMT(data, num_threads)
+    data = np.cumsum(np.random.randn(256, 256, 50), axis=2)
+    cm = MinimaCounterMT(data, num_workers)
+    cm.progress.connect(lambda num, total: print("Processed {0} of {1} tiles".format(num, total)))
+    cm.output.connect(lambda mask: print(mask))
+    cm.finished.connect(app.quit)
     cm.start()
     sys.exit(app.exec_())
 
@@ -10,18 +10,308 @@ container for energy parameters which corresponds directly to the
 third axis of the numpy array.
 """
 import os
+import json
+import hashlib
+import threading
 import numpy as np
 import LEEMFUNCTIONS as LF
+import stackcache
+import derivedcache
+import framecache
+import chunkstore
 
+# Maximum combined size in bytes of the pixel-major and energy-major copies of a data set
+DEF_LAYOUT_MEMORY = 2 * 1024**3
+# Maximum size in bytes of the summed-area table used for rectangular window sums
+DEF_INTEGRAL_MEMORY = 2 * 1024**3
+# Number of values sampled from an in-memory data set to fingerprint its contents
+FINGERPRINT_SAMPLES = 2**20
+# Number of images sampled to set the fixed intensity range used to display images
+DISPLAY_SAMPLE_FRAMES = 16
 
-class LeedData(object):
+# Operations on a data set and the memory layout in which each one reads contiguous memory
+# 'pixel' = (h, w, E): each I(V) curve is contiguous
+# 'energy' = (E, h, w): each image is contiguous
+LAYOUTS = {'frame': 'energy',
+           'spatial': 'energy',
+           'curve': 'pixel',
+           'smooth': 'pixel'}
+
+
+def source_files(dat):
+    """
+    Files a lazily loaded data set reads its images from
+    :param dat: 3d numpy array, np.memmap, LF.MemmapStack or chunkstore.ChunkStack
+    :return: list of (path, offset) in the order of the energy axis; empty for data held in memory
+    """
+    if isinstance(dat, LF.MemmapStack):
+        return [(fr.filename, fr.offset) for fr in dat.frames]
+    if isinstance(dat, np.memmap):
+        return [(dat.filename, dat.offset)]
+    if isinstance(dat, chunkstore.ChunkStack):
+        return [(dat.path, 0)]
+    return []
+
+
+class StackData(object):
+    """
+    Base container for a 3d data set with shape (h, w, E)
+    dat_3d is stored pixel-major so I(V) curves, dat_3d[r, c, :], are contiguous.
+    Reading a single image, dat_3d[:, :, idx], is then a strided gather over
+    the whole array, so an energy-major copy with shape (E, h, w) is built on
+    demand for image-wise operations as long as both copies fit in max_layout_bytes.
+    Assigning a new array to dat_3d discards the energy-major copy.
+
+    While data is being loaded progressively, loaded_range holds the inclusive
+    range of energy indices (lo, hi) which have been filled so far; otherwise it is None.
+
+    Sums over rectangular windows use a summed-area table of every image, built on
+    first use and kept until dat_3d changes, when use_integral is True and
+    the table fits in max_integral_bytes.
+
+    Arrays computed from the data set, ex. smoothed or derivative cubes, are kept
+    in derived, a derivedcache.DerivedCache, keyed by fingerprint() of the data set.
+
+    Images converted to 8 bits for display are kept in display_frames(), which
+    prefetches images around the one displayed, until dat_3d changes.
+    The copies above are built under a lock since the prefetch thread and the
+    GUI thread may ask for them at the same time.
+    """
+
+    def __init__(self, max_layout_bytes=DEF_LAYOUT_MEMORY, max_integral_bytes=DEF_INTEGRAL_MEMORY,
+                 max_frame_bytes=framecache.DEF_FRAME_MEMORY):
+        self.max_layout_bytes = max_layout_bytes
+        self.max_integral_bytes = max_integral_bytes
+        self.max_frame_bytes = max_frame_bytes
+        self.use_integral = True
+        self._dat_3d = np.zeros((10, 10, 10))  # placeholder for main data
+        self._energy_major = None
+        self._integral = None
+        self._fingerprint = None
+        self._display_range = None
+        self._frames = None
+        # re-entrant since display_range() reads images through energy_major()
+        self._lock = threading.RLock()
+        self.loaded_range = None
+        self.data_dir = ''
+        self.derived = derivedcache.DerivedCache()
+
+    @property
+    def dat_3d(self):
+        return self._dat_3d
+
+    @dat_3d.setter
+    def dat_3d(self, value):
+        self._dat_3d = value
+        self.loaded_range = None
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Discard any data derived from dat_3d
+        Must be called after modifying dat_3d in place
+        """
+        self._energy_major = None
+        self._integral = None
+        self._fingerprint = None
+        self._display_range = None
+        if self._frames is not None:
+            self._frames.stop()
+            self._frames = None
+
+    def energy_major(self):
+        """
+        Energy-major copy of dat_3d with shape (E, h, w), built on first use
+        Lazily loaded stacks (LF.MemmapStack, chunkstore.ChunkStack, np.memmap) are
+        never copied since their images are read from disk on demand.
+        :return: C-contiguous numpy array, or None if the copy would exceed max_layout_bytes
+        """
+        with self._lock:
+            if self._energy_major is not None:
+                return self._energy_major
+            dat = self._dat_3d
+            if not isinstance(dat, np.ndarray) or isinstance(dat, np.memmap):
+                return None
+            if 2 * dat.nbytes > self.max_layout_bytes or self.loaded_range is not None:
+                # don't copy a partially loaded data set
+                return None
+            energy_major = np.ascontiguousarray(np.moveaxis(dat, 2, 0))
+            if dat is self._dat_3d:
+                # keep the copy only if dat_3d was not replaced while copying
+                self._energy_major = energy_major
+            return energy_major
+
+    def integral(self):
+        """
+        Summed-area table of dat_3d from LF.integral_cube(), built on first use
+        :return: 3d numpy array with shape (h+1, w+1, E), or None if disabled, too large
+                 or the data set is still loading
+        """
+        with self._lock:
+            if self._integral is not None:
+                return self._integral
+            dat = self._dat_3d
+            if not self.use_integral or self.loaded_range is not None:
+                return None
+            if (dat.shape[0] + 1) * (dat.shape[1] + 1) * dat.shape[2] * 8 > self.max_integral_bytes:
+                return None
+            integral = LF.integral_cube(dat)
+            if dat is self._dat_3d:
+                self._integral = integral
+            return integral
+
+    def display_range(self):
+        """
+        Fixed intensity range for displaying images of the data set, so that
+        images at different energies are shown on the same scale
+        Taken from up to DISPLAY_SAMPLE_FRAMES images spread over the loaded energies.
+        :return (vmin, vmax): floats
+        """
+        with self._lock:
+            if self._display_range is not None:
+                return self._display_range
+            dat = self._dat_3d
+            lo, hi = self.loaded_bounds()
+            indices = np.unique(np.linspace(lo, hi, DISPLAY_SAMPLE_FRAMES).astype(int))
+            vmin = min(float(np.min(self.frame(idx))) for idx in indices)
+            vmax = max(float(np.max(self.frame(idx))) for idx in indices)
+            if vmax <= vmin:
+                vmax = vmin + 1
+            if self.loaded_range is not None or dat is not self._dat_3d:
+                # more images may widen the range once loading has finished;
+                # a range taken from replaced data is not kept
+                return vmin, vmax
+            self._display_range = (vmin, vmax)
+            return self._display_range
+
+    def display_frames(self):
+        """
+        Cache of 8-bit images for display, scaled to display_range(), built on first use
+        :return: framecache.FrameCache
+        """
+        if self._frames is None:
+            vmin, vmax = self.display_range()
+            self._frames = framecache.FrameCache(self.frame, self.loaded_bounds, vmin, vmax,
+                                                 max_bytes=self.max_frame_bytes)
+        return self._frames
+
+    def fingerprint(self):
+        """
+        Identify the current data set from its shape, dtype, the data files in data_dir,
+        its energies and either the files it is read from, for lazily loaded data,
+        or a sample of its values, for data held in memory
+        Data sets loaded from different energy windows of the same directory differ.
+        :return: hex digest string
+        """
+        if self._fingerprint is None:
+            dat = self._dat_3d
+            sha = hashlib.sha1()
+            sha.update('{0}\0{1}\n'.format(tuple(dat.shape), np.dtype(dat.dtype).str).encode('utf-8'))
+            if self.data_dir and os.path.isdir(self.data_dir):
+                files = [name for name in os.listdir(self.data_dir)
+                         if not name.startswith('.') and os.path.isfile(os.path.join(self.data_dir, name))]
+                sha.update(stackcache.dir_fingerprint(self.data_dir, files).encode('utf-8'))
+            for path, offset in source_files(dat):
+                st = os.stat(path)
+                sha.update('{0}\0{1}\0{2}\0{3}\n'.format(os.path.abspath(path), offset, st.st_size,
+                                                          int(st.st_mtime * 1e6)).encode('utf-8'))
+            if isinstance(dat, np.ndarray) and not isinstance(dat, np.memmap):
+                flat = dat.reshape(-1)
+                sha.update(np.ascontiguousarray(flat[::max(1, flat.size // FINGERPRINT_SAMPLES)]).tobytes())
+            self._fingerprint = sha.hexdigest()
+        # energies are hashed on every call since elist may be set after dat_3d
+        elist = [float(en) for en in getattr(self, 'elist', [])]
+        return hashlib.sha1((self._fingerprint + json.dumps(elist)).encode('utf-8')).hexdigest()
+
+    def derived_data(self, op, params, func):
+        """
+        Get an array derived from dat_3d from the derived data cache, computing it if needed
+        Nothing is cached while the data set is still loading.
+        :param op: string name of the operation, ex. 'smooth'
+        :param params: dict of JSON serializable parameters which determine the result
+        :param func: callable with no arguments computing the array
+        :return: numpy array or read-only np.memmap
+        """
+        if self.loaded_range is not None:
+            return func()
+        return self.derived.get_or_compute(self.fingerprint(), op, params, func)
+
+    def loaded_bounds(self):
+        """
+        :return (lo, hi): inclusive range of energy indices which may be displayed
+        """
+        if self.loaded_range is not None:
+            return self.loaded_range
+        return 0, self._dat_3d.shape[2] - 1
+
+    def view(self, op):
+        """
+        Get the data set in the memory layout suited to an operation
+        :param op: string key of LAYOUTS; 'frame', 'spatial', 'curve' or 'smooth'
+        :return (arr, axis): 3d array and the index of its energy axis
+        """
+        if LAYOUTS[op] == 'energy':
+            frames = self.energy_major()
+            if frames is not None:
+                return frames, 0
+        return self._dat_3d, 2
+
+    def frame(self, idx):
+        """
+        Single image from the data set
+        :param idx: integer index along the energy axis
+        :return: 2d numpy array with shape (h, w)
+        """
+        arr, axis = self.view('frame')
+        if axis == 0:
+            return arr[idx]
+        return arr[:, :, idx]
+
+    def curve(self, row, col):
+        """
+        Single I(V) curve from the data set
+        :param row: integer pixel row
+        :param col: integer pixel column
+        :return: 1d numpy array with length E
+        """
+        return self._dat_3d[row, col, :]
+
+    def window(self, r0, r1, c0, c1, e0=None, e1=None):
+        """
+        Rectangular sub-stack of I(V) curves, dat_3d[r0:r1, c0:c1, e0:e1]
+        :return: 3d array with shape (r1-r0, c1-c0, E')
+        """
+        return self._dat_3d[r0:r1, c0:c1, e0:e1]
+
+    def window_sums(self, r0, r1, c0, c1):
+        """
+        I(V) curves summed over rectangular windows, dat_3d[r0:r1, c0:c1, :].sum(axis=(0, 1))
+        Many windows are extracted at once when the bounds are sequences.
+        :param r0, r1, c0, c1: integer bounds of one window, or equal length sequences of bounds
+        :return: numpy array with shape (E,) for one window or (num windows, E)
+        """
+        sat = self.integral()
+        if sat is not None:
+            return LF.window_sums(sat, r0, r1, c0, c1)
+        return LF.direct_window_sums(self._dat_3d, r0, r1, c0, c1)
+
+    def window_background(self, r0, r1, c0, c1, model='perimeter', width=2):
+        """
+        Background subtracted I(V) curves for rectangular windows, see LF.window_background()
+        :return (corrected, background, average): float64 arrays
+        """
+        return LF.window_background(self._dat_3d, r0, r1, c0, c1, model=model, width=width,
+                                    sat=self.integral())
+
+
+class LeedData(StackData):
     """
     Generic object to hold LEED Data and relevant variables
     Data loading methods
     """
 
     def __init__(self, br=20):
-        self.dat_3d = np.zeros((10, 10, 10))  # placeholder for main data
+        super(LeedData, self).__init__()
         self.elist = []  # list of energy values
         self.ilist = []
         self.data_dir = ''  # placeholder for path to currently stored data
@@ -83,19 +373,19 @@ class LeedData(object):
         return np.array(LF.get_img_array(dirname, ext='.tif'))
 
 
-class LeemData(object):
+class LeemData(StackData):
     """
     Generic object to hold LEEM data and relevant variables
     LEEM loading functions are already contained in LEEMFUNCTIONs.py
     A this point I will not be porting them into the LeemData class
     """
     def __init__(self):
+        super(LeemData, self).__init__()
         # Image Parameters
         self.ht = 0  # image height to be set by User
         self.wd = 0  # image width to be set by User
         self.hdln = 0  # image header length to be set by User
         # Data
-        self.dat_3d = np.zeros((10, 10, 10))  # placeholder for main data
         self.elist = []  # list of energy values
         self.ilist = []
         self.e_step = 0
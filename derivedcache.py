@@ -0,0 +1,153 @@
+"""
+Cache for arrays derived from a data set, ex. smoothed or derivative cubes
+
+Entries are keyed by a fingerprint of the source data set, the name of the
+operation and its parameters, so a result is reused whenever the same
+analysis is repeated on the same data. Recently used entries are held in
+memory up to a budget in bytes; the least recently used are dropped first.
+Memory-mapped entries are read from disk on demand and do not count
+against the budget.
+
+With a spill directory set, every entry is also written to a .npy file in
+that directory. Entries which are no longer held in memory, including
+those written by an earlier session, are then memory mapped from disk
+rather than recomputed.
+"""
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+DEF_RAM_BUDGET = 1024**3
+SPILL_NAME = '.please_derived'
+
+
+def entry_key(fingerprint, op, params=None):
+    """
+    :param fingerprint: string fingerprint of the source data set
+    :param op: string name of the operation, ex. 'smooth'
+    :param params: dict of operation parameters; must be JSON serializable
+    :return: hex digest string identifying the entry
+    """
+    desc = json.dumps([fingerprint, op, params if params is not None else {}], sort_keys=True)
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+
+def ram_bytes(data):
+    """
+    :param data: numpy array or np.memmap
+    :return: integer bytes of data held in memory; 0 for a memory-mapped array
+    """
+    if isinstance(data, np.memmap):
+        return 0
+    return data.nbytes
+
+
+class DerivedCache(object):
+    """
+    LRU cache of derived arrays under a memory budget with optional spill to disk
+    Usage:
+        cache = DerivedCache(spill_dir='/path/to/data/.please_derived')
+        smth = cache.get_or_compute(fingerprint, 'smooth', {'window_len': 10},
+                                    lambda: LF.smooth_cube(data))
+    """
+
+    def __init__(self, ram_budget=DEF_RAM_BUDGET, spill_dir=None):
+        """
+        :param ram_budget: integer memory in bytes for entries held in memory
+        :param spill_dir: optional string path to a directory for .npy copies of entries
+        """
+        self.ram_budget = ram_budget
+        self.spill_dir = spill_dir
+        self._entries = OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _spill_path(self, key):
+        if self.spill_dir is None:
+            return None
+        return os.path.join(self.spill_dir, key + '.npy')
+
+    def get(self, fingerprint, op, params=None):
+        """
+        :return: cached numpy array, read-only np.memmap for an entry on disk, or None if not cached
+        """
+        key = entry_key(fingerprint, op, params)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        path = self._spill_path(key)
+        if path is not None and os.path.isfile(path):
+            try:
+                return np.load(path, mmap_mode='r')
+            except (IOError, OSError, ValueError) as e:
+                print('Error reading derived data cache {0}: {1}'.format(path, e))
+        return None
+
+    def put(self, fingerprint, op, params, data):
+        """
+        Store an array in the cache
+        Arrays larger than the memory budget are only kept on disk, if a spill directory is set.
+        :param data: numpy array
+        :return data:
+        """
+        key = entry_key(fingerprint, op, params)
+        self.discard(key)
+        path = self._spill_path(key)
+        if path is not None and not isinstance(data, np.memmap):
+            try:
+                if not os.path.isdir(self.spill_dir):
+                    os.makedirs(self.spill_dir)
+                # write under a temporary name so a partial file is never read back
+                tmp_path = path + '.tmp.npy'
+                np.save(tmp_path, data)
+                os.replace(tmp_path, path)
+            except (IOError, OSError) as e:
+                print('Unable to write derived data cache to {0}: {1}'.format(self.spill_dir, e))
+        if ram_bytes(data) <= self.ram_budget:
+            self._entries[key] = data
+            self.nbytes += ram_bytes(data)
+            self._evict()
+        return data
+
+    def get_or_compute(self, fingerprint, op, params, func):
+        """
+        :param func: callable with no arguments computing the array when it is not cached
+        :return: numpy array
+        """
+        data = self.get(fingerprint, op, params)
+        if data is None:
+            data = func()
+            if data is not None:
+                self.put(fingerprint, op, params, data)
+        return data
+
+    def discard(self, key):
+        """
+        Remove an entry from memory; copies on disk are kept
+        :param key: string from entry_key()
+        """
+        data = self._entries.pop(key, None)
+        if data is not None:
+            self.nbytes -= ram_bytes(data)
+
+    def clear(self, disk=False):
+        """
+        Remove all entries from memory
+        :param disk: boolean; if True also delete the .npy files in the spill directory
+        """
+        self._entries.clear()
+        self.nbytes = 0
+        if disk and self.spill_dir is not None and os.path.isdir(self.spill_dir):
+            for name in os.listdir(self.spill_dir):
+                if name.endswith('.npy'):
+                    os.remove(os.path.join(self.spill_dir, name))
+
+    def _evict(self):
+        # drop least recently used entries until within budget
+        while self.nbytes > self.ram_budget and self._entries:
+            key, data = self._entries.popitem(last=False)
+            self.nbytes -= ram_bytes(data)
@@ -145,6 +145,168 @@ def detect_peaks(x, mph=None, mpd=1, threshold=0, edge='rising',
     return ind
 
 
+def detect_peaks_batch(x, mph=None, mpd=1, threshold=0, edge='rising', kpsh=False,
+                       valley=False, axis=-1, output='padded', block_size=2**16):
+
+    """Detect peaks in many signals at once.
+
+    Applies the same candidate detection, NaN handling, `mph`, `threshold`
+    and `mpd` suppression as `detect_peaks` to every signal along `axis`
+    of an n-d array. Results are identical to calling `detect_peaks` on
+    each signal separately.
+
+    The `mpd` suppression keeps peaks in order of decreasing height. This
+    is done for all signals together in rounds: a peak is kept once every
+    higher peak within `mpd` has been removed, and removed once a higher
+    peak within `mpd` has been kept. When two candidate peaks within `mpd`
+    of each other have exactly the same height, the order in which
+    `detect_peaks` visits them depends on its sort, so those signals are
+    passed to `detect_peaks` directly.
+
+    Parameters
+    ----------
+    x : n-d array_like
+        data; each 1d slice along `axis` is one signal.
+    mph, mpd, threshold, edge, kpsh, valley :
+        see `detect_peaks`.
+    axis : integer, optional (default = -1)
+        axis along the signals, ex. 2 for (h, w, E) LEEM data.
+    output : {'padded', 'csr'}, optional (default = 'padded')
+        format of the returned peak indices.
+    block_size : integer, optional (default = 65536)
+        number of signals processed at a time to bound temporary memory.
+
+    Returns
+    -------
+    output = 'padded' : (counts, ind)
+        counts : integer array with the shape of `x` without `axis`;
+            the number of peaks in each signal.
+        ind : integer array with shape counts.shape + (max count,);
+            indeces of the peaks in each signal padded with -1.
+    output = 'csr' : (offsets, ind)
+        offsets : 1D integer array of length number of signals + 1.
+        ind : 1D integer array; the peaks of signal k, in C order of the
+            signals, are ind[offsets[k]:offsets[k+1]].
+
+    Examples
+    --------
+    >>> x = np.random.randn(600, 592, 50)
+    >>> counts, ind = detect_peaks_batch(x, mpd=10, valley=True, axis=2)
+    """
+
+    x = np.moveaxis(np.asarray(x), axis, -1)
+    shape = x.shape[:-1]
+    signals = x.reshape((-1, x.shape[-1]))
+    counts = np.zeros(signals.shape[0], dtype=int)
+    cols = []
+    for b0 in range(0, signals.shape[0], block_size):
+        found = _batch_peak_mask(signals[b0:b0 + block_size], mph, mpd, threshold,
+                                 edge, kpsh, valley)
+        counts[b0:b0 + block_size] = found.sum(axis=1)
+        cols.append(np.nonzero(found)[1])
+    cols = np.concatenate(cols) if cols else np.array([], dtype=int)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    if output == 'csr':
+        return offsets, cols
+    ind = -np.ones((signals.shape[0], counts.max() if counts.size else 0), dtype=int)
+    rows = np.repeat(np.arange(signals.shape[0]), counts)
+    ind[rows, np.arange(cols.size) - offsets[rows]] = cols
+    return counts.reshape(shape), ind.reshape(shape + (ind.shape[1],))
+
+
+def _batch_peak_mask(signals, mph, mpd, threshold, edge, kpsh, valley):
+    """Boolean mask of the peaks in each row of a 2D array, see detect_peaks_batch."""
+
+    x = signals.astype('float64')
+    found = np.zeros(x.shape, dtype=bool)
+    if x.shape[1] < 3:
+        return found
+    if valley:
+        x = -x
+    # find indices of all peaks
+    dx = x[:, 1:] - x[:, :-1]
+    # handle NaN's
+    isnan = np.isnan(x)
+    rownan = isnan.any(axis=1)
+    x[isnan] = np.inf
+    dx[np.isnan(dx) & rownan[:, None]] = np.inf
+    zero = np.zeros((x.shape[0], 1))
+    before = np.hstack((zero, dx))  # np.hstack((0, dx))
+    after = np.hstack((dx, zero))   # np.hstack((dx, 0))
+    if not edge:
+        cand = (after < 0) & (before > 0)
+    else:
+        cand = np.zeros(x.shape, dtype=bool)
+        if edge.lower() in ['rising', 'both']:
+            cand |= (after <= 0) & (before > 0)
+        if edge.lower() in ['falling', 'both']:
+            cand |= (after < 0) & (before >= 0)
+    # NaN's and values close to NaN's cannot be peaks
+    near_nan = isnan.copy()
+    near_nan[:, 1:] |= isnan[:, :-1]
+    near_nan[:, :-1] |= isnan[:, 1:]
+    cand &= ~near_nan
+    # first and last values of x cannot be peaks
+    cand[:, 0] = False
+    cand[:, -1] = False
+    # remove peaks < minimum peak height
+    if mph is not None:
+        cand &= x >= mph
+    # remove peaks - neighbors < threshold
+    if threshold > 0:
+        dmin = np.full(x.shape, np.inf)
+        dmin[:, 1:-1] = np.minimum(x[:, 1:-1] - x[:, :-2], x[:, 1:-1] - x[:, 2:])
+        cand &= ~(dmin < threshold)
+    if mpd <= 1:
+        return cand
+
+    # detect small peaks closer than minimum peak distance
+    rows, pos = np.nonzero(cand)
+    if not rows.size:
+        return cand
+    height = x[rows, pos]
+    # pairs of candidates in the same row within mpd of each other
+    # candidates are sorted by row then position, so neighbors are adjacent in this list
+    hi, lo = [], []
+    ties = np.zeros(x.shape[0], dtype=bool)
+    for d in range(1, rows.size):
+        a = np.arange(rows.size - d)
+        b = a + d
+        near = (rows[a] == rows[b]) & (pos[b] - pos[a] <= mpd)
+        if not near.any():
+            break
+        a, b = a[near], b[near]
+        ties[rows[a[height[a] == height[b]]]] = True
+        a_higher = height[a] > height[b]
+        hi.append(np.where(a_higher, a, b))
+        lo.append(np.where(a_higher, b, a))
+    found = cand
+    if hi:
+        hi = np.concatenate(hi)
+        lo = np.concatenate(lo)
+        kept = np.zeros(rows.size, dtype=bool)
+        deleted = np.zeros(rows.size, dtype=bool)
+        while not (kept | deleted).all():
+            undecided = ~(kept | deleted)
+            # keep peaks with no higher neighbor left which may still be kept
+            blocked = np.zeros(rows.size, dtype=bool)
+            blocked[lo[~deleted[hi]]] = True
+            kept |= undecided & ~blocked
+            # remove peaks with a higher neighbor which has been kept
+            removed = np.zeros(rows.size, dtype=bool)
+            removed[lo[kept[hi]]] = True
+            deleted |= undecided & ~kept & removed
+        found = np.zeros(x.shape, dtype=bool)
+        found[rows[kept], pos[kept]] = True
+    # peaks with the same height are resolved in the order of detect_peaks
+    for row in np.flatnonzero(ties):
+        found[row] = False
+        found[row, detect_peaks(signals[row], mph=mph, mpd=mpd, threshold=threshold,
+                                edge=edge, kpsh=kpsh, valley=valley)] = True
+    return found
+
+
 def _plot(x, mph, mpd, threshold, edge, valley, ax, ind):
     """Plot results of the detect_peaks function, see its help."""
     try:
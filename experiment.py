@@ -8,6 +8,7 @@ Date: March 2016
 """
 import yaml
 import pprint
+import LEEMFUNCTIONS as LF
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -33,6 +34,16 @@ class Experiment(object):
         self.num_files = ''
         self.imw = ''
         self.imh = ''
+        self.mmap = False
+        self.workers = 1
+        self.cache = False
+        self.derived_cache = False
+        self.stream = False
+        self.budget = None
+        # Optional energy window and stride for partial loading
+        self.load_mine = None
+        self.load_maxe = None
+        self.stride = 1
 
         self.loaded_settings = None
 
@@ -50,7 +61,7 @@ class Experiment(object):
         :return:
         """
         with open(fl, 'r') as f:
-            self.loaded_settings = yaml.load(f)
+            self.loaded_settings = yaml.safe_load(f)
         try:
             # Parse Settings into sub groups
             exp_settings = self.loaded_settings['Experiment']
@@ -72,6 +83,23 @@ class Experiment(object):
             self.imw = img_settings['Width']
             self.imh = img_settings['Height']
 
+            # Optional Settings
+            self.mmap = exp_settings.get('Memory Map', False)
+            self.workers = exp_settings.get('Workers') or 1
+            self.cache = exp_settings.get('Cache', False)
+            self.derived_cache = exp_settings.get('Derived Cache', False)
+            self.stream = exp_settings.get('Progressive Load', False)
+            self.load_mine = eng_settings.get('Load Min', None)
+            self.load_maxe = eng_settings.get('Load Max', None)
+            # blank optional settings, as in the template file, are read as None
+            self.stride = eng_settings.get('Stride') or 1
+            if not isinstance(self.stride, int) or self.stride < 1:
+                print("Error in Experiment YAML - Stride must be an integer of 1 or more; loading every energy")
+                self.stride = 1
+            budget = exp_settings.get('Memory Budget')
+            if budget is not None:
+                self.budget = int(budget * 1024**2)  # MB to bytes
+
             # self.loaded_settings = None
             # pp.pprint(vars(self))
 
@@ -82,6 +110,21 @@ class Experiment(object):
             print("Valid Experiment Parameters are: name, path, type, ext, bits, byteo, mine, maxe, stepe, and numf")
             print("Please refer to experiment.py docstrings for explanation of valid YAML parameter files.")
 
+    def energies(self):
+        """
+        Generate the energy list for the data files which are to be loaded
+        The optional Load Min, Load Max, and Stride settings select a
+        sub-range of the energies, sampled every Stride energies
+        :return (indices, elist): list of file indices to load, or None to load every file,
+                                  and the list of energies in eV for the loaded files
+        """
+        energy_list = [self.mine]
+        while energy_list[-1] != self.maxe:
+            energy_list.append(round(energy_list[-1] + self.stepe, 2))
+        if self.load_mine is None and self.load_maxe is None and self.stride == 1:
+            return None, energy_list
+        return LF.energy_window(energy_list, self.load_mine, self.load_maxe, self.stride)
+
     def test_load(self):
         """
         Test Loading a pre-made file with hard coded path
@@ -89,7 +132,7 @@ class Experiment(object):
         """
         test_file = '/Users/Maxwell/Desktop/141020_03_LEEM-IV_50FOV.yaml'
         with open(test_file, 'r') as f:
-            self.loaded_settings = yaml.load(f)
+            self.loaded_settings = yaml.safe_load(f)
         self._Test = True
 
     def test_fill(self):
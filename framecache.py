@@ -0,0 +1,245 @@
+"""
+Cache of display-ready 8-bit images for scrubbing through a data set
+
+Images are converted to uint8 with a fixed contrast range, through a
+lookup table for 8 and 16 bit integer data, so they can be drawn without
+matplotlib normalizing them again. Converted images are kept in an LRU
+cache under a memory cap.
+
+A background thread converts images near the one last displayed before
+they are asked for: its neighbours on either side first, then images at
+increasing strides so that fast slider moves also land on cached images.
+A new request replaces the pending one, so the thread always works around
+the latest position.
+
+For large images, coarser copies binned by 2, 4 and 8 in each direction
+(the mean of each block of pixels) are built from the full image on first
+use, so a viewer can draw the level which matches its screen resolution.
+
+This module does not depend on Qt.
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+
+DEF_FRAME_MEMORY = 256 * 1024**2
+# images on either side of the current one which are converted first
+PREFETCH_RADIUS = 4
+# further images converted on either side at each stride
+PREFETCH_STRIDES = (2, 4, 8, 16)
+PREFETCH_STEPS = 4
+# number of binned levels below the full image; level k is binned by 2**k
+PYRAMID_LEVELS = 3
+
+
+def contrast_lut(dtype, vmin, vmax):
+    """
+    Lookup table mapping every value of an unsigned 8 or 16 bit integer type to uint8
+    :param dtype: numpy dtype of the images
+    :param vmin: value mapped to 0
+    :param vmax: value mapped to 255
+    :return: uint8 numpy array indexed by image value, or None for other dtypes
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'u' or dtype.itemsize > 2:
+        return None
+    return to_display(np.arange(2**(8 * dtype.itemsize)), vmin, vmax)
+
+
+def to_display(img, vmin, vmax, lut=None):
+    """
+    Convert an image to uint8 with a linear contrast range
+    :param img: numpy array
+    :param vmin: value mapped to 0
+    :param vmax: value mapped to 255
+    :param lut: optional lookup table from contrast_lut() for the dtype of img
+    :return: uint8 numpy array with the shape of img
+    """
+    if lut is not None:
+        return lut[img]
+    scale = 255.0 / (vmax - vmin) if vmax > vmin else 0.0
+    out = (np.asarray(img, dtype=np.float32) - vmin) * scale
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+def bin_mean(img, factor=2):
+    """
+    Downsample an image by the mean of each factor x factor block of pixels
+    Rows and columns which do not fill a complete block are dropped.
+    :param img: 2d numpy array
+    :param factor: integer block size
+    :return: array of the same dtype with shape (h // factor, w // factor)
+    """
+    ht, wd = img.shape[0] // factor, img.shape[1] // factor
+    blocks = img[:ht * factor, :wd * factor].reshape(ht, factor, wd, factor)
+    if img.dtype.kind in 'ui':
+        # integer sum with rounding half up, exact for 8 and 16 bit images
+        total = blocks.sum(axis=(1, 3), dtype=np.int64)
+        return ((total + factor * factor // 2) // (factor * factor)).astype(img.dtype)
+    return blocks.mean(axis=(1, 3)).astype(img.dtype)
+
+
+def prefetch_order(center, lo, hi, radius=PREFETCH_RADIUS, strides=PREFETCH_STRIDES, steps=PREFETCH_STEPS):
+    """
+    Indices of images to convert around the current image, in order of priority
+    :param center: integer index of the current image
+    :param lo: integer index of the first image which may be converted
+    :param hi: integer index of the last image which may be converted
+    :return: list of integer indices within [lo, hi], excluding center
+    """
+    offsets = [d for k in range(1, radius + 1) for d in (k, -k)]
+    for stride in strides:
+        offsets.extend(d for k in range(1, steps + 1) for d in (k * stride, -k * stride))
+    order = []
+    seen = set([center])
+    for offset in offsets:
+        idx = center + offset
+        if lo <= idx <= hi and idx not in seen:
+            seen.add(idx)
+            order.append(idx)
+    return order
+
+
+class FrameCache(object):
+    """
+    LRU cache of 8-bit images and their binned levels with a background prefetching thread
+    Usage:
+        frames = FrameCache(leemdat.frame, leemdat.loaded_bounds, *leemdat.display_range())
+        img = frames.get(idx)
+        small = frames.get(idx, level=2)  # binned by 4
+        frames.prefetch(idx, level=2)
+    """
+
+    def __init__(self, frame, bounds, vmin, vmax, max_bytes=DEF_FRAME_MEMORY):
+        """
+        :param frame: callable frame(idx) returning a 2d numpy array
+        :param bounds: callable returning the inclusive range (lo, hi) of indices which may be read
+        :param vmin: value shown as black
+        :param vmax: value shown as white
+        :param max_bytes: integer memory cap in bytes for the cached images
+        """
+        self.frame = frame
+        self.bounds = bounds
+        self.vmin = vmin
+        self.vmax = vmax
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._lut = None  # (dtype, lookup table) of the last converted image
+        self._frames = OrderedDict()
+        self._cond = threading.Condition()
+        self._wanted = None
+        self._stopped = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def cached(self, idx, level=0):
+        """
+        :return: True if the image at this index and level is in the cache
+        """
+        return (idx, level) in self._frames
+
+    def convert(self, idx):
+        """
+        Read and convert a single image without caching it
+        :param idx: integer image index
+        :return: uint8 numpy array
+        """
+        img = np.asarray(self.frame(idx))
+        lut = self._lut
+        if lut is None or lut[0] != img.dtype:
+            # replaced as a single tuple so the prefetching thread never pairs a table with the wrong dtype
+            lut = (img.dtype, contrast_lut(img.dtype, self.vmin, self.vmax))
+            self._lut = lut
+        return to_display(img, self.vmin, self.vmax, lut[1])
+
+    def get(self, idx, level=0):
+        """
+        :param idx: integer image index
+        :param level: integer pyramid level from 0 (full image) to PYRAMID_LEVELS
+        :return: uint8 numpy array, converted or binned now if not cached
+        """
+        key = (idx, level)
+        with self._cond:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                return self._frames[key]
+        if level == 0:
+            return self._put(key, self.convert(idx))
+        return self._put(key, bin_mean(self.get(idx, level - 1)))
+
+    def _put(self, key, buf):
+        with self._cond:
+            if key not in self._frames:
+                self._frames[key] = buf
+                self.nbytes += buf.nbytes
+            self._frames.move_to_end(key)
+            # drop least recently used images, always keeping the newest
+            while self.nbytes > self.max_bytes and len(self._frames) > 1:
+                old_idx, old_buf = self._frames.popitem(last=False)
+                self.nbytes -= old_buf.nbytes
+        return buf
+
+    def prefetch(self, center, level=0):
+        """
+        Convert images around center in the background, replacing any pending request
+        :param center: integer index of the image being displayed
+        :param level: integer pyramid level being displayed
+        :return none:
+        """
+        with self._cond:
+            if self._stopped:
+                return
+            self._wanted = (center, level)
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='FramePrefetch')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        """
+        Stop the prefetching thread and drop all images
+        :return none:
+        """
+        with self._cond:
+            self._stopped = True
+            self._wanted = None
+            self._frames.clear()
+            self.nbytes = 0
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._wanted is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                center, level = self._wanted
+                self._wanted = None
+            try:
+                self._prefetch(center, level)
+            except Exception as e:
+                # a failed read only skips this request; the thread keeps serving later ones
+                print('Error prefetching images around index {0}: {1}'.format(center, e))
+
+    def _prefetch(self, center, level):
+        lo, hi = self.bounds()
+        # no more images than fit beside the current one, or they would push out each other
+        per_frame = sum(self.get(center, lev).nbytes for lev in range(level + 1))
+        order = prefetch_order(center, lo, hi)[:max(0, self.max_bytes // max(1, per_frame) - 1)]
+        for idx in order:
+            with self._cond:
+                if self._stopped or self._wanted is not None:
+                    break
+                cached = (idx, level) in self._frames
+            if not cached:
+                self.get(idx, level)
+        with self._cond:
+            # the most wanted images are used most recently so they are evicted last
+            for idx in reversed([center] + order):
+                if (idx, level) in self._frames:
+                    self._frames.move_to_end((idx, level))
@@ -70,6 +70,15 @@ class GenDatWindow(QtGui.QWidget):
         setting_hbox.addWidget(self.depth_menu)
         main_vbox.addLayout(setting_hbox)
 
+        output_type_hbox = QtGui.QHBoxLayout()
+        self.output_type_menu = QtGui.QComboBox(self)
+        self.output_type_menu.addItem("Raw .dat Files")
+        self.output_type_menu.addItem("Chunked Stack File")
+        self.output_type_label = QtGui.QLabel("Select Output Format")
+        output_type_hbox.addWidget(self.output_type_menu)
+        output_type_hbox.addWidget(self.output_type_label)
+        main_vbox.addLayout(output_type_hbox)
+
         main_vbox.addWidget(self.h_line())
 
         button_box = QtGui.QHBoxLayout()
@@ -137,6 +146,11 @@ class GenDatWindow(QtGui.QWidget):
 
         self.bit_depth = self.depth_menu.currentText()
 
+        if self.output_type_menu.currentText() == "Chunked Stack File":
+            self.output_format = 'chunked'
+        else:
+            self.output_format = 'dat'
+
     def processInputFiles(self):
         if self.image_type == "TIFF":
             exts = [".tiff", ".TIFF", ".tif", ".TIF"]
@@ -193,7 +207,8 @@ class GenDatWindow(QtGui.QWidget):
                     "image_type:": self.image_type,
                     "height:": self.height,
                     "width": self.width,
-                    "depth": self.bit_depth}
+                    "depth": self.bit_depth,
+                    "format": self.output_format}
         pp = pprint.PrettyPrinter(indent=4)
         pp.pprint(settings)
 
@@ -208,7 +223,8 @@ class GenDatWindow(QtGui.QWidget):
                                        imht=self.height,
                                        imwd=self.width,
                                        bits=self.bytes_per_pixel,
-                                       byte=self.byte_order
+                                       byte=self.byte_order,
+                                       fmt=self.output_format
                                        )
             self.thread.done.connect(self.outputFinished)
             print("Beginning File Output ...")
@@ -13,14 +13,24 @@ class GenericThread(QtCore.QThread):
     # custom class level signals possibly implemented in future
     # may be useful to have a generic finished signal override
 
+    # threads which have been started and not yet finished
+    # a reference is kept here so a running QThread is never garbage collected,
+    # rather than blocking in __del__ until it finishes
+    _running = set()
+
     def __init__(self, func, *args, **kwargs):
         super(QtCore.QThread, self).__init__()
         self.function = func
         self.args = args
         self.kwargs = kwargs
+        self.finished.connect(self._release)
+
+    def start(self, *args):
+        GenericThread._running.add(self)
+        super(GenericThread, self).start(*args)
 
-    def __del__(self):
-        self.wait()
+    def _release(self):
+        GenericThread._running.discard(self)
 
     def run(self):
         # print("self.args = " + str(self.args))
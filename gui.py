@@ -5,7 +5,12 @@ analysis suite
 Maxwell Grady 2015
 """
 # local project imports
+import chunkstore
 import data
+import outofcore
+import derivedcache
+import imagedisplay
+import scheduler
 import terminal
 import LEEMFUNCTIONS as LF
 import styles as pls
@@ -15,7 +20,6 @@ from experiment import Experiment
 from externalwindow import ExternalWindow
 from gendatwidget import GenDatWindow
 from ipyembed import embed_ipy
-from qthreads import WorkerThread
 
 # stdlib imports
 import os
@@ -42,6 +46,10 @@ from PyQt4.Qt import PYQT_VERSION_STR
 from scipy.stats import linregress as lreg  # this should likely be in another file and not part of GUI
 
 
+# Delay in ms before drawing the image for the latest slider position; slider moves within it are drawn once
+SLIDER_REFRESH_MS = 15
+
+
 # TODO: search code for '= []' and look for areas where this code could be modified to use iterators/generators
 
 class Viewer(QtGui.QWidget):
@@ -145,6 +153,9 @@ class Viewer(QtGui.QWidget):
         self.hasplotted_leed = False
         self.hasdisplayed_leed = False
         self.hasdisplayed_leem = False
+        # True while data is being displayed as it is progressively loaded
+        self.streaming_leed = False
+        self.streaming_leem = False
         self.border_color = (58 / 255., 83 / 255., 155 / 255.)  # unused
 
         self.current_leed_index = 0  # index of third axis for self.leeddat.dat3d
@@ -176,6 +187,13 @@ class Viewer(QtGui.QWidget):
 
         self.background = []
         self.background_curves = []
+        self.background_model = 'perimeter'  # one of LF.BACKGROUND_MODELS
+        self.beam_paths = {}  # LEED beam trajectories from new_leed_extract()
+        self.minima_index = None  # (offsets, positions) of I(V) minima over the full energy axis
+        self.minima_shape = None  # (h, w) of the data set indexed in minima_index
+        # long running analyses are queued as jobs on a bounded thread pool
+        self.scheduler = scheduler.Scheduler(parent=self)
+        self.job_queue_window = None
         self.use_avg = False
         self.last_avg = []
 
@@ -345,6 +363,8 @@ class Viewer(QtGui.QWidget):
         """
         self.LEED_IV_fig, (self.LEED_img_ax, self.LEED_IV_ax) = plt.subplots(1, 2, figsize=(6,6), dpi=100)
         self.LEED_IV_canvas = FigureCanvas(self.LEED_IV_fig)
+        # LEED images are redrawn with blitting while the energy slider moves
+        self.LEED_display = imagedisplay.BlittedImage(self.LEED_img_ax, self.LEED_IV_canvas, cmap=cm.Greys_r)
         self.LEED_IV_canvas.setSizePolicy(QtGui.QSizePolicy.Expanding,
                                           QtGui.QSizePolicy.Expanding)
         self.LEED_IV_canvas.setParent(self.LEED_Tab)
@@ -360,6 +380,10 @@ class Viewer(QtGui.QWidget):
         self.LEED_slider.setTickInterval(1)
         self.LEED_slider.setTickPosition(QtGui.QSlider.TicksAbove)
         self.LEED_slider.valueChanged[int].connect(self.update_LEED_slider)
+        self.LEED_slider_timer = QtCore.QTimer(self)
+        self.LEED_slider_timer.setSingleShot(True)
+        self.LEED_slider_timer.timeout.connect(self.draw_pending_LEED)
+        self.pending_leed_index = None
 
         self.LEED_slider_label = QtGui.QLabel(self)
         self.LEED_slider_label.setText("Electron Energy [eV]")
@@ -387,6 +411,8 @@ class Viewer(QtGui.QWidget):
         """
         self.LEEM_fig, (self.LEEM_ax, self.LEEM_IV_ax) = plt.subplots(1, 2, figsize=(6,6), dpi=100)
         self.LEEM_canvas = FigureCanvas(self.LEEM_fig)
+        # LEEM images are redrawn with blitting while the energy slider moves
+        self.LEEM_display = imagedisplay.BlittedImage(self.LEEM_ax, self.LEEM_canvas, cmap=cm.Greys_r)
         self.LEEM_canvas.setSizePolicy(QtGui.QSizePolicy.Expanding,
                                        QtGui.QSizePolicy.Expanding)
         self.LEEM_canvas.setParent(self.LEEM_Tab)
@@ -404,6 +430,10 @@ class Viewer(QtGui.QWidget):
         self.image_slider = QtGui.QSlider(QtCore.Qt.Horizontal, self.LEEM_Tab)
         self.image_slider.setMaximumHeight(200)
         self.image_slider.valueChanged[int].connect(self.update_image_slider)
+        self.image_slider_timer = QtCore.QTimer(self)
+        self.image_slider_timer.setSingleShot(True)
+        self.image_slider_timer.timeout.connect(self.draw_pending_LEEM)
+        self.pending_leem_index = None
         self.image_slider.setTickInterval(10)
         self.image_slider.setTickPosition(QtGui.QSlider.TicksAbove)
 
@@ -644,6 +674,10 @@ class Viewer(QtGui.QWidget):
         subtractStoredBackgroundAction.triggered.connect(self.subtract_stored_background)
         backgroundMenu.addAction(subtractStoredBackgroundAction)
 
+        backgroundModelAction = QtGui.QAction('Set Background Model', self)
+        backgroundModelAction.triggered.connect(self.set_background_model)
+        backgroundMenu.addAction(backgroundModelAction)
+
         # Add submenu for functiosn related to averaging I(V)
         averageMenu = LEEDMenu.addMenu('Averaging')
 
@@ -721,6 +755,10 @@ class Viewer(QtGui.QWidget):
         countAction.triggered.connect(self.count_extrema_optimized)
         extremaMenu.addAction(countAction)
 
+        liveCountAction = QtGui.QAction("Live Layer Map", self)
+        liveCountAction.triggered.connect(self.live_layer_map)
+        extremaMenu.addAction(liveCountAction)
+
         countCurrentAction = QtGui.QAction("Count Layers - Current Curves", self)
         countCurrentAction.triggered.connect(self.count_current_curves)
         extremaMenu.addAction(countCurrentAction)
@@ -758,6 +796,11 @@ class Viewer(QtGui.QWidget):
         setLEEDEnergyAction.triggered.connect(lambda: self.set_energy_parameters(dat='LEED'))
         settingsMenu.addAction(setLEEDEnergyAction)
 
+        jobQueueAction = QtGui.QAction('Show Job Queue', self)
+        jobQueueAction.setStatusTip('Show progress of running analyses and cancel them')
+        jobQueueAction.triggered.connect(self.show_job_queue)
+        settingsMenu.addAction(jobQueueAction)
+
         debugConsoleAction = QtGui.QAction('IPython', self)
         debugConsoleAction.triggered.connect(self.debug_console)
         settingsMenu.addAction(debugConsoleAction)
@@ -787,8 +830,20 @@ class Viewer(QtGui.QWidget):
             receive a close event from main QWidget along with any additional args.
         :return none:
         """
+        # stop running jobs so no pool thread outlives the application
+        self.scheduler.wait(5000)
         self.Quit()
 
+    def show_job_queue(self):
+        """
+        Open a window listing queued, running and finished analysis jobs
+        :return none:
+        """
+        if self.job_queue_window is None:
+            self.job_queue_window = scheduler.JobQueueWidget(self.scheduler)
+        self.job_queue_window.show()
+        self.job_queue_window.raise_()
+
     def debug_console(self):
         """
         Open a new window with an embedded IPython REPL
@@ -946,10 +1001,9 @@ class Viewer(QtGui.QWidget):
     @staticmethod
     def output_complete():
         """
-        This function executes when receiving a finished() SIGNAL from a QThread object
+        This function executes when a job writing I(V) data to text is done
         :return: none
         """
-        # signals QThread has emitted a 'finished()' SIGNAL
         print('File output successfully')
         return
 
@@ -1425,6 +1479,8 @@ class Viewer(QtGui.QWidget):
 
 
         self.leemdat.data_dir = str(self.exp.path)  # manually cast from QString to String
+        self.leemdat.derived.spill_dir = (os.path.join(self.leemdat.data_dir, derivedcache.SPILL_NAME)
+                                          if self.exp.derived_cache else None)
         self.leemdat.img_mask_count_dir = os.path.join(self.exp.path, 'img_mask_count')
         self.leemdat.ht = self.exp.imh
         self.leemdat.wd = self.exp.imw
@@ -1439,19 +1495,21 @@ class Viewer(QtGui.QWidget):
         if self.exp.data_type.lower() == 'raw':
 
             try:
-                self.thread = WorkerThread(task='LOAD_LEEM',
-                                           path=self.leemdat.data_dir,
-                                           imht=self.leemdat.ht,
-                                           imwd=self.leemdat.wd,
-                                           bits=self.exp.bit,
-                                           byte=self.exp.byte_order)
-                # disconnect any previously connected Signals/Slots
-                self.disconnect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEEM_data)
-                self.disconnect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEEM_img)
-                # connect appropriate signals for loading LEED data
-                self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEEM_data)
-                self.connect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEEM_img)
-                self.thread.start()
+                job = scheduler.WorkerJob('LOAD_LEEM',
+                                          path=self.leemdat.data_dir,
+                                          imht=self.leemdat.ht,
+                                          imwd=self.leemdat.wd,
+                                          bits=self.exp.bit,
+                                          byte=self.exp.byte_order,
+                                          mmap=self.exp.mmap,
+                                          workers=self.exp.workers,
+                                          cache=self.exp.cache,
+                                          elist=self.leemdat.elist,
+                                          stream=self.exp.stream,
+                                          indices=self.exp.energies()[0],
+                                          first=self.leemdat.curimg if self.hasdisplayed_leem else -1)
+                self.submit_load('LEEM', job, self.retrieve_LEEM_data,
+                                 retrieve_batch=self.retrieve_LEEM_batch, update=self.update_LEEM_img)
 
                 #self.leemdat.dat_3d = LF.process_LEEM_Data(self.leemdat.data_dir,
                 #                                           self.leemdat.ht,
@@ -1464,21 +1522,36 @@ class Viewer(QtGui.QWidget):
         # elif self.exp.data_type == 'Image' or self.exp.data_type == 'image' or self.exp.data_type == 'IMAGE':
         elif self.exp.data_type.lower() == 'image':
             try:
-                self.thread = WorkerThread(task='LOAD_LEEM_IMAGES',
-                                           path=self.exp.path,
-                                           ext=self.exp.ext)
-                # disconnect any previously connected Signals/Slots
-                self.disconnect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEEM_data)
-                self.disconnect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEEM_img)
-                # connect appropriate signals for loading LEED data
-                self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEEM_data)
-                self.connect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEEM_img)
-                self.thread.start()
+                job = scheduler.WorkerJob('LOAD_LEEM_IMAGES',
+                                          path=self.exp.path,
+                                          ext=self.exp.ext,
+                                          workers=self.exp.workers,
+                                          cache=self.exp.cache,
+                                          elist=self.leemdat.elist,
+                                          stream=self.exp.stream,
+                                          indices=self.exp.energies()[0],
+                                          first=self.leemdat.curimg if self.hasdisplayed_leem else -1)
+                self.submit_load('LEEM', job, self.retrieve_LEEM_data,
+                                 retrieve_batch=self.retrieve_LEEM_batch, update=self.update_LEEM_img)
             except ValueError:
                 print('Error loading LEEM data from images. Please check YAML experiment config file')
                 print('Required parameters to load images from YAML config: path, ext')
                 print('Check for valid data path and valid file extensions: \'.tif\' and \'.png\'.')
 
+        elif self.exp.data_type.lower() == 'chunked':
+            # only the chunk index is read here; image data is decompressed on demand
+            stack_path = chunkstore.find_stack(self.exp.path)
+            if stack_path is None:
+                print('Error: No chunked stack file found at {}'.format(self.exp.path))
+                return
+            try:
+                self.retrieve_LEEM_data(chunkstore.ChunkStack(stack_path))
+            except (IOError, ValueError) as e:
+                print(e)
+                print('Error loading LEEM data from chunked stack file {}'.format(stack_path))
+                return
+            self.update_LEEM_img()
+
     def load_LEED_experiment(self):
         """
         :return:
@@ -1493,6 +1566,8 @@ class Viewer(QtGui.QWidget):
         self.LEED_IV_ax.clear()
         self.LEED_img_ax.clear()
         self.leeddat.data_dir = self.exp.path
+        self.leeddat.derived.spill_dir = (os.path.join(self.leeddat.data_dir, derivedcache.SPILL_NAME)
+                                          if self.exp.derived_cache else None)
         self.leeddat.ht = self.exp.imh
         self.leeddat.wd = self.exp.imw
 
@@ -1504,20 +1579,21 @@ class Viewer(QtGui.QWidget):
 
         if self.exp.data_type.lower() == 'raw':
             try:
-                self.thread = WorkerThread(task='LOAD_LEED',
-                                           path=self.leeddat.data_dir,
-                                           imht=self.leeddat.ht,
-                                           imwd=self.leeddat.wd,
-                                           bits=self.exp.bit,
-                                           byte=self.exp.byte_order)
-
-                # disconnect any previously connected Signals/Slots
-                self.disconnect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                self.disconnect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEED_img)
-                # connect appropriate signals for loading LEED data
-                self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                self.connect(self.thread, QtCore.SIGNAL('finished()'), lambda: self.update_LEED_img(index=self.current_leed_index))
-                self.thread.start()
+                job = scheduler.WorkerJob('LOAD_LEED',
+                                          path=self.leeddat.data_dir,
+                                          imht=self.leeddat.ht,
+                                          imwd=self.leeddat.wd,
+                                          bits=self.exp.bit,
+                                          byte=self.exp.byte_order,
+                                          mmap=self.exp.mmap,
+                                          workers=self.exp.workers,
+                                          cache=self.exp.cache,
+                                          elist=self.leeddat.elist,
+                                          stream=self.exp.stream,
+                                          indices=self.exp.energies()[0],
+                                          first=self.current_leed_index if self.hasdisplayed_leed else -1)
+                self.submit_load('LEED', job, self.retrieve_LEED_data, retrieve_batch=self.retrieve_LEED_batch,
+                                 update=lambda: self.update_LEED_img(index=self.current_leed_index))
 
             except ValueError:
                 print('Error Loading LEED Experiment: Please Recheck YAML Settings')
@@ -1525,21 +1601,36 @@ class Viewer(QtGui.QWidget):
 
         elif self.exp.data_type.lower() == 'image':
             try:
-                self.thread = WorkerThread(task='LOAD_LEED_IMAGES',
-                                           ext=self.exp.ext,
-                                           path=self.exp.path, byte=self.exp.byte_order)
-                self.disconnect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                self.disconnect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEED_img)
-                # connect appropriate signals for loading LEED data
-                self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                self.connect(self.thread, QtCore.SIGNAL('finished()'),
-                             lambda: self.update_LEED_img(index=self.current_leed_index))
-                self.thread.start()
+                job = scheduler.WorkerJob('LOAD_LEED_IMAGES',
+                                          ext=self.exp.ext,
+                                          path=self.exp.path, byte=self.exp.byte_order,
+                                          workers=self.exp.workers,
+                                          cache=self.exp.cache,
+                                          elist=self.leeddat.elist,
+                                          stream=self.exp.stream,
+                                          indices=self.exp.energies()[0],
+                                          first=self.current_leed_index if self.hasdisplayed_leed else -1)
+                self.submit_load('LEED', job, self.retrieve_LEED_data, retrieve_batch=self.retrieve_LEED_batch,
+                                 update=lambda: self.update_LEED_img(index=self.current_leed_index))
             except ValueError:
                 print('Error Loading LEED Experiment from image files.')
                 print('Please Check YAML settings in experiment config file')
                 print('Required parameters: data path and data extension.')
                 print('Valid data extenstions: \'.tif\', \'.png\', \'.jpg\'')
+
+        elif self.exp.data_type.lower() == 'chunked':
+            # only the chunk index is read here; image data is decompressed on demand
+            stack_path = chunkstore.find_stack(self.exp.path)
+            if stack_path is None:
+                print('Error: No chunked stack file found at {}'.format(self.exp.path))
+                return
+            try:
+                self.retrieve_LEED_data(chunkstore.ChunkStack(stack_path))
+            except (IOError, ValueError) as e:
+                print(e)
+                print('Error loading LEED data from chunked stack file {}'.format(stack_path))
+                return
+            self.update_LEED_img(index=self.current_leed_index)
         # Ensure labels are redrawn correctly
         self.LEED_IV_ax.set_ylabel('Intensity [arb. units]', fontsize=18)
         self.LEED_IV_ax.set_xlabel('Energy [eV]', fontsize=18)
@@ -1589,16 +1680,9 @@ class Viewer(QtGui.QWidget):
                         return
                     print('New Data Directory set to {}'.format(new_dir))
 
-                    self.thread = WorkerThread(task='LOAD_LEED_IMAGES', path=new_dir, ext='.tif')
-
-                    # disconnect any previously connected Signals/Slots
-                    self.disconnect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                    self.disconnect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEED_img)
-                    # connect appropriate signals for loading LEED data
-                    self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                    self.connect(self.thread, QtCore.SIGNAL('finished()'),
-                                 lambda: self.update_LEED_img(index=self.current_leed_index))
-                    self.thread.start()
+                    job = scheduler.WorkerJob('LOAD_LEED_IMAGES', path=new_dir, ext='.tif')
+                    self.submit_load('LEED', job, self.retrieve_LEED_data,
+                                     update=lambda: self.update_LEED_img(index=self.current_leed_index))
 
                     # self.leeddat.dat_3d = self.leeddat.load_LEED_TIFF(new_dir)
                     # print('New Data shape: {}'.format(self.leeddat.dat_3d.shape))
@@ -1615,15 +1699,9 @@ class Viewer(QtGui.QWidget):
                         print('Loading Canceled ...')
                         return
                     print('New Data Directory set to {}'.format(new_dir))
-                    self.thread = WorkerThread(task='LOAD_LEED_IMAGES', path=new_dir, ext='.png')
-                    # disconnect any previously connected Signals/Slots
-                    self.disconnect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                    self.disconnect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEED_img)
-                    # connect appropriate signals for loading LEED data
-                    self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                    self.connect(self.thread, QtCore.SIGNAL('finished()'),
-                                 lambda: self.update_LEED_img(index=self.current_leed_index))
-                    self.thread.start()
+                    job = scheduler.WorkerJob('LOAD_LEED_IMAGES', path=new_dir, ext='.png')
+                    self.submit_load('LEED', job, self.retrieve_LEED_data,
+                                     update=lambda: self.update_LEED_img(index=self.current_leed_index))
 
                     # self.leeddat.dat_3d = self.leeddat.load_LEED_PNG(new_dir)
                     # print('New Data shape: {}'.format(self.leeddat.dat_3d.shape))
@@ -1658,18 +1736,65 @@ class Viewer(QtGui.QWidget):
                     # redundant code is redundant
                     # self.leeddat.dat_3d = self.leeddat.load_LEED_RAW(new_dir)
 
-                    self.thread = WorkerThread(task='LOAD_LEED', path=new_dir, imht=self.leeddat.ht, imwd=self.leeddat.wd)
-
-                    # disconnect any previously connected Signals/Slots
-                    self.disconnect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                    self.disconnect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEED_img)
-                    # connect appropriate signals for loading LEED data
-                    self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEED_data)
-                    self.connect(self.thread, QtCore.SIGNAL('finished()'), lambda: self.update_LEED_img(index=self.current_leed_index))
-                    self.thread.start()
+                    job = scheduler.WorkerJob('LOAD_LEED', path=new_dir, imht=self.leeddat.ht, imwd=self.leeddat.wd)
+                    self.submit_load('LEED', job, self.retrieve_LEED_data,
+                                     update=lambda: self.update_LEED_img(index=self.current_leed_index))
 
             return
 
+    @staticmethod
+    def report_load_progress(num_loaded, num_files):
+        """
+        PYQT SLOT
+        Print loading progress in steps of 10% as files are read by a WorkerThread
+        :param num_loaded: int number of files loaded so far
+        :param num_files: int total number of files to load
+        :return none:
+        """
+        step = max(1, num_files // 10)
+        if num_loaded % step == 0 or num_loaded == num_files:
+            print('Loaded {0} of {1} files ...'.format(num_loaded, num_files))
+
+    def submit_load(self, tab, job, retrieve, retrieve_batch=None, update=None):
+        """
+        Run a data loading job on the scheduler
+        A load still running for the same tab is cancelled and anything it emits later is ignored,
+        so only the latest load sets the data of a tab
+        :param tab: string 'LEEM' or 'LEED'
+        :param job: scheduler.WorkerJob running a load task
+        :param retrieve: slot receiving the loaded 3d array
+        :param retrieve_batch: slot receiving partially loaded data while streaming
+        :param update: callable drawing the data once the load is done
+        :return none:
+        """
+        previous = self.load_jobs[tab]
+        if previous is not None and previous.status not in scheduler.FINISHED:
+            print('Cancelling previous {} data load ...'.format(tab))
+            previous.cancel()
+        self.load_jobs[tab] = job
+
+        def current():
+            return self.load_jobs[tab] is job
+
+        def on_output(dat):
+            if current():
+                retrieve(dat)
+
+        def on_batch(dat, lo, hi):
+            if current():
+                retrieve_batch(dat, lo, hi)
+
+        def on_status(status):
+            if status == scheduler.DONE and current() and update is not None:
+                update()
+
+        self.connect(job.worker, QtCore.SIGNAL('output(PyQt_PyObject)'), on_output)
+        job.worker.progress.connect(self.report_load_progress)
+        if retrieve_batch is not None:
+            job.worker.loaded.connect(on_batch)
+        job.status_changed.connect(on_status)
+        self.scheduler.submit(job)
+
     def retrieve_LEED_data(self, dat):
         """
         Custom Slot to recieve data from a QThread object upon thread exit
@@ -1678,7 +1803,31 @@ class Viewer(QtGui.QWidget):
         :return:
         """
         self.leeddat.dat_3d = dat
-        self.current_leed_index = self.leeddat.dat_3d.shape[2]-1
+        if not self.streaming_leed:
+            self.current_leed_index = self.leeddat.dat_3d.shape[2]-1
+        self.streaming_leed = False
+        return
+
+    def retrieve_LEED_batch(self, dat, lo, hi):
+        """
+        Custom Slot to recieve partially loaded data from a QThread while streaming
+        :param dat:
+            numpy ndarray being filled by WorkerThread
+        :param lo:
+            int index of first loaded image
+        :param hi:
+            int index of last loaded image
+        :return:
+        """
+        first_batch = not self.streaming_leed
+        self.streaming_leed = True
+        self.leeddat.dat_3d = dat
+        self.leeddat.loaded_range = (lo, hi)
+        if first_batch:
+            # the first batch contains only the selected image
+            self.update_LEED_img(index=lo)
+        else:
+            self.format_LEED_slider()
         return
 
     def update_LEED_slider(self, value):
@@ -1695,14 +1844,28 @@ class Viewer(QtGui.QWidget):
         self.LEED_slider_value.setText(str(LF.filenumber_to_energy(self.leeddat.elist, value)) + " eV")
         # set slider to value
         self.LEED_slider.setValue(value)
-        self.update_LEED_img(value)
+        # only the latest position is drawn when the slider moves faster than images are drawn
+        self.pending_leed_index = value
+        if not self.LEED_slider_timer.isActive():
+            self.LEED_slider_timer.start(SLIDER_REFRESH_MS)
+
+    def draw_pending_LEED(self):
+        """
+        PYQT SLOT
+        Draw the LEED image for the latest slider position
+        :return none:
+        """
+        if self.pending_leed_index is None:
+            return
+        index, self.pending_leed_index = self.pending_leed_index, None
+        self.update_LEED_img(index)
 
     def format_LEED_slider(self):
         """
         Reset the bounds on the LEEM image slider
         :return none
         """
-        self.LEED_slider.setRange(0, self.leeddat.dat_3d.shape[2] - 1)
+        self.LEED_slider.setRange(*self.leeddat.loaded_bounds())
 
     def update_LEED_img(self, index=0):
         """
@@ -1717,23 +1880,23 @@ class Viewer(QtGui.QWidget):
             print('Updating Energy parameters ...')
             self.set_energy_parameters(dat='LEED')
         self.LEED_IV_ax.set_aspect('auto')
-        if index <= self.leeddat.dat_3d.shape[2]:
-            self.LEED_img_ax.imshow(self.leeddat.dat_3d[:, :, index], cmap=cm.Greys_r)
-        else:
+        frame_index = index
+        if index > self.leeddat.dat_3d.shape[2]:
             print('Image index out of bounds - displaying last image in stack ...')
-            self.LEED_img_ax.imshow(self.leeddat.dat_3d[:, :, -1], cmap=cm.Greys_r)
+            frame_index = self.leeddat.dat_3d.shape[2] - 1
 
         # format LEED_slider so that its values match with the third axis of self.leeddat.dat_3d
         self.format_LEED_slider()
 
+        title = 'LEED Image: E= {} eV'.format(LF.filenumber_to_energy(self.leeddat.elist, index))
+        self.LEED_display.set_range(0, 255)
+        # drawn from the binned level of the display frames which matches the axes size and zoom
         if not self.Style:
-            self.LEED_img_ax.set_title('LEED Image: E= {} eV'.format(LF.filenumber_to_energy(self.leeddat.elist, index)),
-                                   fontsize=18)
+            self.LEED_display.show_frame(self.leeddat.display_frames(), frame_index, title=title, fontsize=18)
         else:
-            self.LEED_img_ax.set_title('LEED Image: E= {} eV'.format(LF.filenumber_to_energy(self.leeddat.elist, index)),
-                                   fontsize=18, color='white')
+            self.LEED_display.show_frame(self.leeddat.display_frames(), frame_index, title=title,
+                                         fontsize=18, color='white')
 
-        self.LEED_IV_canvas.draw()
         self.has_loaded_data = True
         self.hasdisplayed_leed = True
         self.current_leed_index = index
@@ -1786,9 +1949,7 @@ class Viewer(QtGui.QWidget):
             # get energy params from loaded config file
 
             if dat == 'LEEM' and self.exp.exp_type == 'LEEM':
-                energy_list = [self.exp.mine]
-                while energy_list[-1] != self.exp.maxe:
-                    energy_list.append(round(energy_list[-1] + self.exp.stepe, 2))
+                energy_list = self.exp.energies()[1]
                 self.leemdat.elist = energy_list
                 if self._DEBUG:
                     print("Length of leemdat.elist = {}".format(len(self.leemdat.elist)))
@@ -1797,17 +1958,13 @@ class Viewer(QtGui.QWidget):
                 # dat = LEEM but most current exp is not a LEEM exp
                 # check if another exp has been loaded and is a LEEM exp
                 if self.prev_exp.exp_type == 'LEEM':
-                    energy_list = [self.prev_exp.mine]
-                    while energy_list[-1] != self.prev_exp.maxe:
-                        energy_list.append(round(energy_list[-1] + self.prev_exp.stepe, 2))
+                    energy_list = self.prev_exp.energies()[1]
                     self.leemdat.elist = energy_list
                     if self._DEBUG:
                         print("Length of leemdat.elist = {}".format(len(self.leemdat.elist)))
 
             elif dat == 'LEED' and self.exp.exp_type == 'LEED':
-                energy_list = [self.exp.mine]
-                while energy_list[-1] != self.exp.maxe:
-                    energy_list.append(round(energy_list[-1] + self.exp.stepe, 2))
+                energy_list = self.exp.energies()[1]
                 self.leeddat.elist = energy_list
                 if self._DEBUG:
                     print("Length of leeddat.elist = {}".format(len(self.leeddat.elist)))
@@ -1816,9 +1973,7 @@ class Viewer(QtGui.QWidget):
                 # dat = LEED but most current exp is not a LEED exp
                 # check if another exp has been loaded and is a LEED exp
                 if self.prev_exp.exp_type == 'LEED':
-                    energy_list = [self.prev_exp.mine]
-                    while energy_list[-1] != self.prev_exp.maxe:
-                        energy_list.append(round(energy_list[-1] + self.prev_exp.stepe, 2))
+                    energy_list = self.prev_exp.energies()[1]
                     self.leeddat.elist = energy_list
                     if self._DEBUG:
                         print("Length of leeddat.elist = {}".format(len(self.leeddat.elist)))
@@ -2036,21 +2191,16 @@ class Viewer(QtGui.QWidget):
             print("Can not plot data due to mismatch ...")
             return
         tot_pix = (2*self.leeddat.box_rad)**2
+        # sum each integration window projected along the third array axis
+        curves = self.leeddat.window_sums(*self.leed_window_bounds())
         for idx, lst in enumerate(self.rect_coords):
 
             if lst[2] is False:
                 # Data has not been plotted
-
-                # generate 3d slice of main data array
-                # this represents the integration window projected along the third array axis
-                stored_rad = lst[3]  # get value of leeddat.box_rad when selection was made
-                int_win = self.leeddat.dat_3d[int(lst[0]-stored_rad):int(lst[0]+stored_rad),
-                                              int(lst[1]-stored_rad):int(lst[1]+stored_rad),
-                                              :]
                 # plot unaveraged intensity 3/30/2016
                 # ilist = [img.sum()/tot_pix for img in np.rollaxis(int_win, 2)]
 
-                ilist = [img.sum() for img in np.rollaxis(int_win, 2)]
+                ilist = curves[idx].tolist()
 
                 if self.smooth_leed_plot:
                     print('Plotting and Storing Smoothed Data ...')
@@ -2068,11 +2218,25 @@ class Viewer(QtGui.QWidget):
         self.LEED_IV_canvas.draw()
         return
 
+    def leed_window_bounds(self):
+        """
+        Bounds of the current LEED integration windows
+        Each window covers dat_3d[r0:r1, c0:c1, :] clipped to the image
+        :return (r0, r1, c0, c1): integer arrays with one entry per element of self.rect_coords
+        """
+        rows = np.array([lst[0] for lst in self.rect_coords])
+        cols = np.array([lst[1] for lst in self.rect_coords])
+        rads = np.array([lst[3] for lst in self.rect_coords])  # value of leeddat.box_rad when selection was made
+        r0, r1 = LF.window_bounds((rows - rads).astype(int), (rows + rads).astype(int), self.leeddat.dat_3d.shape[0])
+        c0, c1 = LF.window_bounds((cols - rads).astype(int), (cols + rads).astype(int), self.leeddat.dat_3d.shape[1])
+        return r0, r1, c0, c1
+
     def new_leed_extract(self):
         """
         extract I(V) data from currently selected areas in self.leeddat.dat3d
         For each step through energy space,
           attempt to re-center the user selection on the electron beam maximum
+        The beam trajectories are stored in self.beam_paths
         :return none:
         """
         if (self.rect_count == 0) or (not self.rects) or (not self.rect_coords):
@@ -2088,25 +2252,18 @@ class Viewer(QtGui.QWidget):
         self.hasplotted_leed = True
 
         # Loop for each user selection
+        self.beam_paths = {}  # (row, col) beam position at each energy keyed by selection index
         for idx, lst in enumerate(self.rect_coords):
 
             if lst[2] is False:
-                # Loop for each image in stack to generate ilist
-                ilist = []
                 stored_rad = lst[3]  # get value of leeddat.box_rad when selection was made
-                for img in np.rollaxis(self.leeddat.dat_3d, 2):
-
-                    # generate window based on user selection coordinates
-                    r_u = lst[0]
-                    c_u = lst[1]
-                    win = img[int(r_u - stored_rad):int(r_u + stored_rad),
-                              int(c_u - stored_rad):int(c_u + stored_rad)]
-                    # tup = (r_u, c_u)
-                    new_win = self.get_beam_max_update_slice(int_win=win, win_coords=(r_u, c_u, stored_rad), img=img)
-                    # average
-                    # ilist.append(new_win.sum()/((2*self.leeddat.box_rad)**2))
-                    # no average
-                    ilist.append(new_win.sum())
+                # follow the beam through the stack starting from the user selection coordinates
+                # the integration window is re-centered on the beam maximum at each energy
+                frames, axis = self.leeddat.view('spatial')
+                ilists, paths = LF.track_beams(frames, [(lst[0], lst[1])], stored_rad, axis=axis)
+                # no average
+                ilist = ilists[0].tolist()
+                self.beam_paths[idx] = paths[0]
 
                 if self.smooth_leed_plot:
                     print('Plotting and Storing Smoothed Data ...')
@@ -2132,13 +2289,7 @@ class Viewer(QtGui.QWidget):
         if (self.rect_count == 0) or (not self.rects) or (not self.rect_coords):
             print('Not Data Selected to Plot')
             return
-        current_curves = []
-        for idx, lst in enumerate(self.rect_coords):
-            stored_rad = lst[3]
-            int_win = self.leeddat.dat_3d[lst[0] - stored_rad:lst[0] + stored_rad,
-                                          lst[1] - stored_rad:lst[1] + stored_rad,
-                                          :]
-            current_curves.append([img.sum() for img in np.rollaxis(int_win, 2)])
+        current_curves = self.leeddat.window_sums(*self.leed_window_bounds()).tolist()
 
         # calculate average intensity at each point given all entries in current_curves
         # this creates a single list of intensity values to be plotted against energy
@@ -2349,13 +2500,29 @@ class Viewer(QtGui.QWidget):
             self.LEED_IV_ax.set_xlabel('Energy [eV]', fontsize=18)
         self.LEED_IV_canvas.draw()
 
+    def set_background_model(self):
+        """
+        Query user for the background model used by subtract_background()
+        :return none:
+        """
+        models = LF.BACKGROUND_MODELS
+        item, ok = QtGui.QInputDialog.getItem(self, "Set Background Model",
+                                              "Estimate the background of each integration window from:\n" +
+                                              "perimeter - mean of the window edge pixels\n" +
+                                              "plane - plane fit to the window edge pixels\n" +
+                                              "annulus - mean of a ring of pixels around the window",
+                                              models, models.index(self.background_model), False)
+        if ok:
+            self.background_model = str(item)
+            print("Background model set to {}".format(self.background_model))
+
     def subtract_background(self):
         """
         For all curves currently selected, perform a background subtraction
-        This is accomplished by calculating the average intensity of the perimeter
-        of each integration window and subtracting this value from each pixel in the
-        integration window. This is repeated for each energy value so that the background
-        subtracted can change as a function of energy.
+        The background of each integration window is estimated with the model in
+        self.background_model, by default the average intensity of the perimeter of the
+        window, and subtracted from each pixel in the integration window. This is done
+        for each energy value so that the background subtracted can change as a function of energy.
         It may be useful to analyze the function I_back(V) at a later time thus for each curve
         the background which was subtracted is stored as a list of intensities so they can be
         plotted against Energy.
@@ -2364,52 +2531,14 @@ class Viewer(QtGui.QWidget):
         if not self.hasplotted_leed:
             return
 
-        self.background_curves = []
         print('Starting Background Subtraction Procedure ...')
-        for idx, lst in enumerate(self.rect_coords):
-            stored_rad = lst[3]
-            data_subset = self.leeddat.dat_3d[int(lst[0]-stored_rad):int(lst[0]+stored_rad),
-                                              int(lst[1]-stored_rad):int(lst[1]+stored_rad),
-                                              :]
-            adj_ilist = []  # create list to hold adjusted intensities
-            # iterate over each image in the data subset
-
-            # manually cast to int16 to prevent integer overflow when subtracting from an array of unsigned integers!!!
-
-            bkgnd = []
-            for img in np.rollaxis(data_subset, 2).astype(np.int16):
-                """
-                # perimeter sum
-                ps = (img[0, 0:] + img[0:, -1] + img[-1, :] + img[0:, 0]).sum()  # sum edges
-                ps -= (img[0,0] + img[0, -1] + img[-1, -1] + img[-1, 0])  # subtract corners for double counting
-                num_pixels = 2*(2*(2*self.leeddat.box_rad)-2)
-                ps /= num_pixels
-                bkgnd.append(ps)  # store average perimeter pixel value
-                if self.Debug:
-                    print("Average Background calculated as {}".format(ps))
-                    print("Raw Sum: {}".format(img.sum()))
-                img -= int(ps)  # subtract background from each pixel
-                if self.Debug:
-                    print("Adjusted Sum: {}".format(img[img >= 0].sum()))
-                    print(img)
-                # calculate new total intensity of the integration window counting only positive values
-                # there should be no negatives but we discard them just incase
-                adj_ilist.append(img[img >= 0].sum())
-                """
-                total_int = img.sum()
-                per_sum = (img[0, :] + img[0:, -1] + img[-1, :] + img[:, 0]).sum()  # sum edges
-                per_sum -= (img[0, 0] + img[0, -1] + img[-1, -1] + img[-1, 0])  # subtract corners for double counting
-                per_sum = (per_sum / float(8*stored_rad - 4))*(2*stored_rad)**2
-
-                corrected_int = total_int - per_sum
-                bkgnd.append(per_sum)
-                adj_ilist.append(corrected_int)
-
-            self.background_curves.append(bkgnd)
-
+        corrected, background, average = self.leeddat.window_background(*self.leed_window_bounds(),
+                                                                         model=self.background_model)
+        self.background_curves = background.tolist()
+        for idx, adj_ilist in enumerate(corrected.tolist()):
             self.current_selections.append((adj_ilist, self.colors[idx]))
 
-        avg_background = [sum(l)/len(l) for l in zip(*self.background_curves)]
+        avg_background = average.tolist()
         print("Finished Subtracting Background ...")
         print("Re-plotting original data and corrected data")
 
@@ -2609,11 +2738,11 @@ class Viewer(QtGui.QWidget):
                     ilist = LF.smooth(ilist, window_len=self.smooth_LEEM_window_len,
                                       window_type=self.smooth_LEEM_window_type)
 
-                self.thread = WorkerThread(task='OUTPUT_TO_TEXT',
-                                           elist=elist, ilist=ilist,
-                                           name=outfile)
-                self.connect(self.thread, QtCore.SIGNAL('finished()'), self.output_complete)
-                self.thread.start()
+                job = scheduler.WorkerJob('OUTPUT_TO_TEXT',
+                                          elist=elist, ilist=ilist,
+                                          name=outfile)
+                job.result_ready.connect(lambda result: self.output_complete())
+                self.scheduler.submit(job)
                 count += 1
             return
 
@@ -2660,15 +2789,12 @@ class Viewer(QtGui.QWidget):
 
         if data is None:
             # Output data from main window
+            # generate raw data to pass to new threads to be output
+            curves = self.leeddat.window_sums(*self.leed_window_bounds())
             # for each element in rect_coords - spin up a qthread to output the data to file
             for idx, lst in enumerate(self.rect_coords):
 
-                # generate raw data to pass to new thread to be output
-                stored_rad = lst[3]
-                int_win = self.leeddat.dat_3d[int(lst[0]-stored_rad):int(lst[0]+stored_rad),
-                                              int(lst[1]-stored_rad):int(lst[1]+stored_rad),
-                                              :]
-                ilist = [img.sum() for img in np.rollaxis(int_win, 2)]
+                ilist = curves[idx].tolist()
                 elist = self.leeddat.elist
 
                 # check if smoothing is enabled
@@ -2685,12 +2811,11 @@ class Viewer(QtGui.QWidget):
                     # full_path = out_dir + '/' + entry + '_' + str(idx+1)  + '.txt'
                 print('Starting thread {0} of {1} ...'.format(idx, len(self.rect_coords)))
 
-                self.thread = WorkerThread(task='OUTPUT_TO_TEXT',
-                                           ilist=ilist, elist=elist,
-                                           name=full_path)
-
-                self.connect(self.thread, QtCore.SIGNAL('finished()'), self.output_complete)
-                self.thread.start()
+                job = scheduler.WorkerJob('OUTPUT_TO_TEXT',
+                                          ilist=ilist, elist=elist,
+                                          name=full_path)
+                job.result_ready.connect(lambda result: self.output_complete())
+                self.scheduler.submit(job)
             print('Done Writing Files ...')
             return
         else:
@@ -2702,11 +2827,11 @@ class Viewer(QtGui.QWidget):
                 ilist = LF.smooth(ilist, window_len=self.smooth_window_len, window_type=self.smooth_window_type)
             full_path = os.path.join(out_dir, entry+'.txt')
             print('Starting thread 0 of 1 ...')
-            self.thread = WorkerThread(task='OUTPUT_TO_TEXT',
-                                       ilist=ilist, elist=elist,
-                                       name=full_path)
-            self.connect(self.thread, QtCore.SIGNAL('finished()'), self.output_complete)
-            self.thread.start()
+            job = scheduler.WorkerJob('OUTPUT_TO_TEXT',
+                                      ilist=ilist, elist=elist,
+                                      name=full_path)
+            job.result_ready.connect(lambda result: self.output_complete())
+            self.scheduler.submit(job)
             print('Done Writing Files ...')
             return
 
@@ -2821,6 +2946,7 @@ class Viewer(QtGui.QWidget):
             print('Error Loading LEEM Data ...')
             return
         self.leemdat.data_dir = str(ddir)  # manually cast from QString to String
+        self.leemdat.derived.spill_dir = None
         self.leemdat.img_mask_count_dir = os.path.join(str(ddir), 'img_mask_count')
         if not os.path.exists(self.leemdat.img_mask_count_dir):
             os.mkdir(self.leemdat.img_mask_count_dir)
@@ -2860,26 +2986,25 @@ class Viewer(QtGui.QWidget):
         else:
             self.leemdat.wd = entry
 
-        try:
-            self.thread = WorkerThread(task='LOAD_LEEM',
-                                       path=self.leemdat.data_dir,
-                                       imht=self.leemdat.ht,
-                                       imwd=self.leemdat.wd)
-            # disconnect any previously connected Signals/Slots
-            self.disconnect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEEM_data)
-            self.disconnect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEEM_img)
-            # connect appropriate signals for loading LEED data
-            self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_LEEM_data)
-            self.connect(self.thread, QtCore.SIGNAL('finished()'), self.update_LEEM_img)
-            self.thread.start()
-
-            #self.leemdat.dat_3d = LF.process_LEEM_Data(self.leemdat.data_dir,
-            #                                           self.leemdat.ht,
-            #                                           self.leemdat.wd)
-        except ValueError:
+        job = scheduler.LoadRawJob(path=self.leemdat.data_dir, ht=self.leemdat.ht, wd=self.leemdat.wd)
+        job.progress.connect(self.report_load_progress)
+        job.result_ready.connect(self.retrieve_loaded_LEEM)
+
+        def load_failed(msg):
             print('Error Loading LEEM Data: Please Recheck Image Settings')
             print('Resetting data directory to previous setting, {}'.format(prev_ddir))
-            return
+            self.leemdat.data_dir = prev_ddir
+        job.failed.connect(load_failed)
+        self.scheduler.submit(job)
+
+    def retrieve_loaded_LEEM(self, dat):
+        """
+        PYQT SLOT
+        Store data loaded by a LoadRawJob and display it
+        :return none:
+        """
+        self.retrieve_LEEM_data(dat)
+        self.update_LEEM_img()
 
     def retrieve_LEEM_data(self, dat):
         """
@@ -2889,6 +3014,30 @@ class Viewer(QtGui.QWidget):
         self.leemdat.dat_3d = dat
         return
 
+    def retrieve_LEEM_batch(self, dat, lo, hi):
+        """
+        Catch partially loaded data emitted from QThread while streaming
+        The image slider range grows as further images are loaded
+        :param dat:
+            numpy ndarray being filled by WorkerThread
+        :param lo:
+            int index of first loaded image
+        :param hi:
+            int index of last loaded image
+        :return none:
+        """
+        first_batch = not self.streaming_leem
+        self.streaming_leem = True
+        self.leemdat.dat_3d = dat
+        self.leemdat.loaded_range = (lo, hi)
+        self.format_slider()
+        if first_batch:
+            # the first batch contains only the selected image
+            self.set_energy_parameters(dat='LEEM')
+            self.hasdisplayed_leem = True
+            self.update_image_slider(lo)
+        return
+
     def update_LEEM_img(self):
         """
         After loading data, format necessary LEEM plots and slider which in turn updates plot
@@ -2901,7 +3050,12 @@ class Viewer(QtGui.QWidget):
         self.format_slider()
         self.hasdisplayed_leem = True
         self.has_loaded_data = True
-        self.update_image_slider(self.leemdat.dat_3d.shape[2]-1)
+        if self.streaming_leem:
+            # keep displaying the image selected while loading
+            self.streaming_leem = False
+            self.update_image_slider(self.leemdat.curimg)
+        else:
+            self.update_image_slider(self.leemdat.dat_3d.shape[2]-1)
 
         # if not self.has_loaded_data:
         #    self.update_image_slider(self.leemdat.dat_3d.shape[2]-1)
@@ -2915,7 +3069,7 @@ class Viewer(QtGui.QWidget):
         Reset the bounds on the LEEM image slider
         :return none
         """
-        self.image_slider.setRange(0, self.leemdat.dat_3d.shape[2]-1)
+        self.image_slider.setRange(*self.leemdat.loaded_bounds())
 
     def update_image_slider(self, value):
         """
@@ -2933,7 +3087,21 @@ class Viewer(QtGui.QWidget):
                                                             value)) + " eV")
         # set slider to value
         self.image_slider.setValue(value)
-        self.show_LEEM_Data(self.leemdat.dat_3d, value)
+        # only the latest position is drawn when the slider moves faster than images are drawn
+        self.pending_leem_index = value
+        if not self.image_slider_timer.isActive():
+            self.image_slider_timer.start(SLIDER_REFRESH_MS)
+
+    def draw_pending_LEEM(self):
+        """
+        PYQT SLOT
+        Draw the LEEM image for the latest slider position
+        :return none:
+        """
+        if self.pending_leem_index is None:
+            return
+        index, self.pending_leem_index = self.pending_leem_index, None
+        self.show_LEEM_Data(self.leemdat.dat_3d, index)
 
     def clear_LEEM_IV(self):
         """
@@ -2970,16 +3138,22 @@ class Viewer(QtGui.QWidget):
         :return none:
         """
         self.leemdat.curimg = imgnum
-        img = data[0:, 0:, self.leemdat.curimg]
         self.current_LEEM_eV = LF.filenumber_to_energy(self.leemdat.elist, self.leemdat.curimg)
-
+        title = 'LEEM Image: E= ' + str(self.current_LEEM_eV) + ' eV'
         if self.Style:
-            self.LEEM_ax.set_title('LEEM Image: E= ' + str(LF.filenumber_to_energy(self.leemdat.elist, self.leemdat.curimg)) +' eV', fontsize=18, color='white')
+            title_kw = {'fontsize': 18, 'color': 'white'}
         else:
-            self.LEEM_ax.set_title('LEEM Image: E= ' + str(LF.filenumber_to_energy(self.leemdat.elist, self.leemdat.curimg)) +' eV', fontsize=18)
+            title_kw = {'fontsize': 18}
 
-        self.LEEM_ax.imshow(img, cmap=cm.Greys_r)
-        self.LEEM_canvas.draw()
+        if data is self.leemdat.dat_3d:
+            # display-ready 8-bit images, prefetched around the current image and drawn
+            # from the binned level which matches the axes size and zoom
+            self.LEEM_display.set_range(0, 255)
+            self.LEEM_display.show_frame(self.leemdat.display_frames(), self.leemdat.curimg, title=title, **title_kw)
+        else:
+            img = data[0:, 0:, self.leemdat.curimg]
+            self.LEEM_display.set_range(float(np.min(img)), float(np.max(img)))
+            self.LEEM_display.show(img, title=title, **title_kw)
         return
 
     def leem_click(self, event):
@@ -3038,10 +3212,7 @@ class Viewer(QtGui.QWidget):
         #                            self.leemdat.curX, :]:
         #   self.leemdat.ilist.append(i)
 
-        self.leemdat.ilist = list(self.leemdat.dat_3d[
-                                  self.leemdat.curY,
-                                  self.leemdat.curX, :
-                                  ])
+        self.leemdat.ilist = list(self.leemdat.curve(self.leemdat.curY, self.leemdat.curX))
 
 
         if len(self.leemdat.elist) != len(self.leemdat.ilist):
@@ -3261,7 +3432,7 @@ class Viewer(QtGui.QWidget):
 
 
 
-        img = self.leemdat.dat_3d[0:, 0:, self.leemdat.curimg]
+        img = self.leemdat.frame(self.leemdat.curimg)
         self.nplot_ax_leem.imshow(img, cmap=cm.Greys_r)
         self.ncanvas_leem.draw()
         self.new_window_leem.show()
@@ -3355,12 +3526,12 @@ class Viewer(QtGui.QWidget):
                 h = int(rect.get_height())
                 origin_x = int(rect.get_xy()[0])
                 origin_y = int(rect.get_xy()[1])
-                data_slice = self.leemdat.dat_3d[origin_y:origin_y + h + 1,
-                                                 origin_x:origin_x + w + 1, :]
-                ilist = [img.sum() for img in np.rollaxis(data_slice, 2)]
+                ilist = self.leemdat.window_sums(origin_y, origin_y + h + 1,
+                                                 origin_x, origin_x + w + 1)
                 self.leem_rect_iv_ax.plot(self.leemdat.elist, ilist, color=self.colors[idx+1])
                 if self._DEBUG:
-                    print(data_slice.shape)
+                    print(self.leemdat.window(origin_y, origin_y + h + 1,
+                                              origin_x, origin_x + w + 1).shape)
 
             plt.grid(False)
             if self._Style:
@@ -3394,9 +3565,8 @@ class Viewer(QtGui.QWidget):
             h = int(rect.get_height())
             origin_x = int(rect.get_xy()[0])
             origin_y = int(rect.get_xy()[1])
-            data_slice = self.leemdat.dat_3d[origin_y:origin_y + h + 1,
-                         origin_x:origin_x + w + 1, :]
-            ilist = [img.sum() for img in np.rollaxis(data_slice, 2)]
+            ilist = self.leemdat.window_sums(origin_y, origin_y + h + 1,
+                                             origin_x, origin_x + w + 1)
             self.leem_rect_iv_ax.plot(self.leemdat.elist, LF.smooth(ilist), color=self.colors[idx + 1])
         if self._Style:
             self.leem_rect_iv_ax.set_title("LEEM-I(V) Selection Average", fontsize=18, color='w')
@@ -3428,24 +3598,20 @@ class Viewer(QtGui.QWidget):
         self.leem_didv_can = FigureCanvas(self.leem_didv_fig)
 
         self.LEEM_IV_ax.clear()
-        for tuple in self.leem_IV_list:
-            data = tuple[1]
+        # Smooth data before taking derivative:
+        if self.smooth_leem_plot:
+            # use user settings and smooth the derivative as well
+            window_len, window_type = self.smooth_LEEM_window_len, self.smooth_LEEM_window_type
+        else:
+            # use default settings
+            window_len, window_type = 10, 'flat'
+        # calculate derivative of every curve at once; note this reduces the length by 1
+        curves = np.array([tuple[1] for tuple in self.leem_IV_list], dtype=np.float64)
+        derivs = LF.derivative_cube(curves, self.leemdat.elist, window_len=window_len, window_type=window_type,
+                                    smooth_after=self.smooth_leem_plot, axis=1)
+        for tuple, data in zip(self.leem_IV_list, derivs):
             color_idx = tuple[4]
-
-            # Smooth data before taking derivative:
-            if self.smooth_leem_plot:
-                # use user settings
-                data = LF.smooth(data, self.smooth_LEEM_window_len, self.smooth_LEEM_window_type)
-            else:
-                # use default settings
-                data = LF.smooth(data)
-            # calculate derivative; note this reduces the length by 1
-            data = np.diff(data)/np.diff(self.leemdat.elist)
-
-            if self.smooth_leem_plot:
-                self.LEEM_IV_ax.plot(self.leemdat.elist[:-1], LF.smooth(data, self.smooth_LEEM_window_len, self.smooth_LEEM_window_type), color=self.colors[color_idx])
-            else:
-                self.LEEM_IV_ax.plot(self.leemdat.elist[:-1], data, color=self.colors[color_idx])
+            self.LEEM_IV_ax.plot(self.leemdat.elist[:-1], data, color=self.colors[color_idx])
         self.LEEM_IV_ax.set_title("LEEM dI/dV")
         self.LEEM_canvas.draw()
 
@@ -3676,9 +3842,10 @@ class Viewer(QtGui.QWidget):
         max_index = self.leemdat.elist.index(max_e)
 
         self.count_layers_new(data=self.leemdat.dat_3d[:, :, min_index:max_index],
-                              ecut=self.leemdat.elist[min_index:max_index])
+                              ecut=self.leemdat.elist[min_index:max_index],
+                              energies=(min_index, max_index))
 
-    def count_layers_new(self, data, ecut):
+    def count_layers_new(self, data, ecut, energies=None):
         '''
         DEPRECATED
         Method for counting the number of minima in a LEEM-I(V) curve
@@ -3686,26 +3853,19 @@ class Viewer(QtGui.QWidget):
             3d numpy array of smooth data cut to specific data range
         :param ecut:
             1d list of energy values cut to specific data range
+        :param energies:
+            tuple of (min index, max index) of the energy range in self.leemdat.dat_3d;
+            if given the smoothed derivative is kept in the derived data cache
         :return none:
         '''
-
-        # calculate the derivative of input data
-        diff_data = np.diff(data, axis=2) / np.diff(ecut)
-
-        # smooth the derivative data
-        smooth_diff_data = np.apply_along_axis(LF.smooth, 2, diff_data)
-
-        # process pool
-        pool = mp.Pool(2*mp.cpu_count())
-
-        # create list of 1-d arrays as input to count_mins()
-        ins = [smooth_diff_data[r,c, :] for r in range(data.shape[0])
-                                        for c in range(data.shape[1])]
-        # list of outputs from check_flat using pool.map()
-        outs = pool.map(self.check_flat, ins)
-
-        # convert back to np array and reshape
-        outs = np.array(outs).reshape((data.shape[0], data.shape[1]))
+        if energies is None:
+            outs = LF.count_layers_new(data, ecut)
+        else:
+            params = {'window_len': 10, 'window_type': 'flat', 'smooth_before': False,
+                      'energies': list(energies)}
+            deriv = self.leemdat.derived_data('derivative', params,
+                                              lambda: LF.derivative_cube(data, ecut, smooth_before=False))
+            outs = LF.check_flat_and_count(deriv, thresh=5, axis=2)
         self.discrete_imshow(outs)
         return
 
@@ -3740,8 +3900,23 @@ class Viewer(QtGui.QWidget):
 
         print("Beginning calculation of I(V) minima - WARNING: this may take a few moments ...")
         self.ts = time.time()
-        self.smooth_data_for_count(data=self.leemdat.dat_3d[:, :, min_index:max_index],
-                                   elist=self.leemdat.elist[min_index:max_index])
+        # smoothing settings used by the SmoothJob; repeated windows are taken from the derived data cache
+        self.smooth_params = {'window_len': 10, 'window_type': 'flat', 'energies': [min_index, max_index]}
+        cached = None
+        if self.leemdat.loaded_range is None:
+            # nothing is cached for a partially loaded data set
+            cached = self.leemdat.derived.get(self.leemdat.fingerprint(), 'smooth', self.smooth_params)
+        if cached is not None:
+            print("Using cached smoothed I(V) data")
+            self.smoothed_data = cached
+            self.count_extrema()
+        else:
+            # data which is memory mapped is processed tile by tile without reading it all into memory
+            smooth_job = self.smooth_data_for_count(data=self.leemdat.view('smooth')[0],
+                                                    elist=self.leemdat.elist[min_index:max_index],
+                                                    energies=slice(min_index, max_index))
+            smooth_job.then(self.count_minima_job())
+            self.scheduler.submit(smooth_job)
 
     def retrieve_smoothed_data(self, data):
         """
@@ -3750,69 +3925,196 @@ class Viewer(QtGui.QWidget):
         :return none:
         """
         print("Done computing smoothed I(V) data")
+        if not outofcore.in_memory(data):
+            # a memory-mapped scratch file owned by the job; it is deleted once the minima are counted
+            self.smoothed_data = None
+            return
         self.smoothed_data = data
+        if self.leemdat.loaded_range is None:
+            # don't cache smoothed data of a partially loaded data set
+            self.leemdat.derived.put(self.leemdat.fingerprint(), 'smooth', self.smooth_params, data)
 
-    def smooth_data_for_count(self, data, elist):
+    def smooth_data_for_count(self, data, elist, energies=slice(None)):
         """
         Called from count_extrema_optimized
-        :param data: slice of main data set through user selected energy window
+        :param data: main data set
         :param elist: slice of main energy list to user selected points
-        :return none:
+        :param energies: slice of the energy axis of data to smooth
+        :return job: scheduler.SmoothJob, not yet submitted
         """
         self.smoothed_data = None
-        self.thread = WorkerThread(task='SMOOTH', data=data)
-        try:
-            self.thread.disconnect()
-        except:
-            pass
-        self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_smoothed_data)
-        self.connect(self.thread, QtCore.SIGNAL('finished()'), self.count_extrema)
-        print("Starting Thread to compute smoothed I(V) data ...")
-        self.thread.start()
+        job = scheduler.SmoothJob(data=data, energies=energies,
+                                  budget=self.exp.budget if self.exp is not None else None)
+        job.result_ready.connect(self.retrieve_smoothed_data)
+        return job
 
-    def retrieve_image_mask(self, mask):
+    def count_minima_job(self, data=None):
         """
-        PYQT SLOT
-        :param mask: output from separate thread stored to local variable in GUI thread
-        :return none:
+        :param data: smoothed I(V) data; None to count the result of a preceding SmoothJob
+        :return job: scheduler.CountMinimaJob, not yet submitted
         """
-        self.image_mask = mask
+        job = scheduler.CountMinimaJob(data=data,
+                                       budget=self.exp.budget if self.exp is not None else None,
+                                       workers=self.exp.workers if self.exp is not None else None)
+        job.result_ready.connect(self.finished_counting)
+        return job
 
     def count_extrema(self):
         """
-        Use a separate thread to process the smoothed I(V) data cut to a user selected energy window
+        Count minima in the smoothed I(V) data cut to a user selected energy window as a scheduled job
         Make an image map of the surface that is color coded to the number of minima counted in
         the I(V) curve extracted from each pixel
         :return:
         """
         if self.smoothed_data is None:
-            print("ERROR: Data has not yet been smoothed - possibly thread has not finished")
+            print("ERROR: Data has not yet been smoothed - possibly job has not finished")
             return
         self.image_mask = None
-        self.thread = WorkerThread(task='COUNT_MINIMA', data=self.smoothed_data)
-        try:
-            self.thread.disconnect()
-        except:
-            pass
-        self.connect(self.thread, QtCore.SIGNAL('output(PyQt_PyObject)'), self.retrieve_image_mask)
-        self.connect(self.thread, QtCore.SIGNAL('finished()'), self.finished_counting)
-        print("Starting thread to count  minima in I(V) data ...")
-        self.thread.start()
+        print("Starting job to count minima in I(V) data ...")
+        self.scheduler.submit(self.count_minima_job(self.smoothed_data))
 
-    def finished_counting(self):
+    def finished_counting(self, mask):
         """
         PYQT SLOT
+        :param mask: 2d numpy array of minima counts from a CountMinimaJob
         :return none:
         """
         print("Done counting minima in LEEM-I(V) ...")
         self.tf = time.time() - self.ts
         fmt = divmod(self.tf, 60)  # Decompose time into minutes and seconds
         print("Elapsed time: {0} minutes and {1} seconds.".format(fmt[0], fmt[1]))
-        if self.image_mask is None:
-            print("Error: image mask data not received from thread ...")
+        if mask is None:
+            print("Error: image mask data not received from job ...")
             return
+        self.image_mask = mask
         self.discrete_imshow(data=self.image_mask)
 
+    def live_layer_map(self):
+        """
+        Called from LEEM Menu
+        Index the minima of every smoothed I(V) curve over the full energy axis once,
+        then show a layer map whose energy window is set with sliders.
+        Moving a slider only queries the index, so the map updates as the slider is dragged.
+        :return none:
+        """
+        if not self.hasdisplayed_leem:
+            return
+        self.minima_index = None
+        # image shape of the indexed data; the YAML image parameters are not set for image or chunked data
+        self.minima_shape = tuple(self.leemdat.dat_3d.shape[:2])
+        self.index_params = {'window_len': 10, 'window_type': 'flat', 'mpd': 10}
+        offsets = positions = None
+        if self.leemdat.loaded_range is None:
+            fingerprint = self.leemdat.fingerprint()
+            offsets = self.leemdat.derived.get(fingerprint, 'minima_offsets', self.index_params)
+            positions = self.leemdat.derived.get(fingerprint, 'minima_positions', self.index_params)
+        if offsets is not None and positions is not None:
+            print("Using cached I(V) minima index")
+            self.minima_index = (offsets, positions)
+            self.show_live_layer_map()
+            return
+
+        print("Indexing I(V) minima over the full energy range - WARNING: this may take a few moments ...")
+        self.ts = time.time()
+        job = scheduler.ExtremumIndexJob(data=self.leemdat.view('smooth')[0],
+                                         budget=self.exp.budget if self.exp is not None else None)
+        job.result_ready.connect(self.retrieve_minima_index)
+        self.scheduler.submit(job)
+
+    def retrieve_minima_index(self, index):
+        """
+        PYQT SLOT
+        :param index: tuple (offsets, positions) from outofcore.extremum_index()
+        :return none:
+        """
+        self.tf = time.time() - self.ts
+        print("Done indexing I(V) minima in {} seconds".format(round(self.tf, 2)))
+        self.minima_index = index
+        if self.leemdat.loaded_range is None:
+            # don't cache an index of a partially loaded data set
+            fingerprint = self.leemdat.fingerprint()
+            self.leemdat.derived.put(fingerprint, 'minima_offsets', self.index_params, index[0])
+            self.leemdat.derived.put(fingerprint, 'minima_positions', self.index_params, index[1])
+        self.show_live_layer_map()
+
+    def show_live_layer_map(self):
+        """
+        Display the layer map with sliders for the minimum and maximum energy of the window
+        :return none:
+        """
+        if self.minima_index is None:
+            print("Error: minima index not received from thread ...")
+            return
+        num_e = len(self.leemdat.elist)
+        # color scale is fixed by the widest window so colors are comparable while dragging
+        max_count = max(1, int(LF.window_extremum_counts(*self.minima_index, lo=0, hi=num_e).max()))
+
+        self.live_count_window = QtGui.QWidget()
+        self.live_count_window.setWindowTitle("Live Layer Map")
+        self.lfig, self.lplot_ax = plt.subplots(1, 1, figsize=(8, 8), dpi=100)
+        self.lcanvas = FigureCanvas(self.lfig)
+        self.lcanvas.setParent(self.live_count_window)
+        self.lcanvas.setSizePolicy(QtGui.QSizePolicy.Expanding,
+                                   QtGui.QSizePolicy.Expanding)
+        self.lmpl_toolbar = NavigationToolbar(self.lcanvas, self.live_count_window)
+
+        self.live_min_slider = QtGui.QSlider(QtCore.Qt.Horizontal, self.live_count_window)
+        self.live_max_slider = QtGui.QSlider(QtCore.Qt.Horizontal, self.live_count_window)
+        self.live_min_label = QtGui.QLabel(self.live_count_window)
+        self.live_max_label = QtGui.QLabel(self.live_count_window)
+        for slider, value in ((self.live_min_slider, 0), (self.live_max_slider, num_e)):
+            slider.setRange(0, num_e)
+            slider.setValue(value)
+            slider.setTickPosition(QtGui.QSlider.TicksAbove)
+            slider.valueChanged[int].connect(self.update_live_layer_map)
+
+        cvbox = QtGui.QVBoxLayout()
+        cvbox.addWidget(self.lcanvas)
+        cvbox.addWidget(self.lmpl_toolbar)
+        for label, slider in ((self.live_min_label, self.live_min_slider),
+                              (self.live_max_label, self.live_max_slider)):
+            hbox = QtGui.QHBoxLayout()
+            hbox.addWidget(label)
+            hbox.addWidget(slider)
+            cvbox.addLayout(hbox)
+        self.live_count_window.setLayout(cvbox)
+
+        cmap_list = [cm.Spectral(i) for i in range(cm.Spectral.N)]
+        cmap_list[0] = (0, 0, 0, 1.0)  # custom 0 value color
+        cmap = cm.Spectral.from_list('Custom Colors', cmap_list, max_count + 1)
+        self.live_count_img = self.lplot_ax.imshow(np.zeros(self.minima_shape),
+                                                   interpolation='none', cmap=cmap,
+                                                   vmin=-0.5, vmax=max_count + 0.5)
+        cb = self.lfig.colorbar(self.live_count_img, ticks=range(max_count + 1), format='%1i')
+        cb.set_label("# minima")
+        plt.grid(False)
+
+        self.update_live_layer_map()
+        self.live_count_window.show()
+
+    def update_live_layer_map(self, value=None):
+        """
+        PYQT SLOT
+        Recount minima inside the energy window set by the sliders and redraw the map
+        :param value: slider value; unused, both sliders are read
+        :return none:
+        """
+        if self.minima_index is None:
+            return
+        lo = self.live_min_slider.value()
+        hi = self.live_max_slider.value()
+        elist = self.leemdat.elist
+        self.live_min_label.setText("Min Energy: {} eV".format(elist[min(lo, len(elist) - 1)]))
+        self.live_max_label.setText("Max Energy: {} eV".format(elist[hi - 1] if hi > 0 else elist[0]))
+        counts = LF.window_extremum_counts(*self.minima_index, lo=lo, hi=hi,
+                                           shape=self.minima_shape)
+        self.live_count_img.set_data(counts)
+        if hi > lo:
+            self.lplot_ax.set_title("# minima in LEEM-I(V) for [{0}, {1}] eV".format(elist[lo], elist[hi - 1]))
+        else:
+            self.lplot_ax.set_title("Empty energy window")
+        self.lcanvas.draw_idle()
+
     def count_current_curves(self):
         if not self.hasplotted_leem:
             return
@@ -3828,7 +4130,7 @@ class Viewer(QtGui.QWidget):
         for circ in self.circs:
             r = int(circ.center[1])
             c = int(circ.center[0])
-            iv = self.leemdat.dat_3d[r, c, :]
+            iv = self.leemdat.curve(r, c)
             if self.smooth_window_len and self.smooth_window_type:
                 siv = LF.smooth(iv, window_len=self.smooth_window_len, window_type=self.smooth_window_type)
             else:
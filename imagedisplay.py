@@ -0,0 +1,263 @@
+"""
+Redraw an image which is replaced many times, ex. while scrubbing an energy slider
+
+The image artist is created once and updated with set_data() under a fixed
+normalization. The image and the axes title are animated artists: a full
+canvas draw renders everything else, the region of the axes and its title is
+saved, and each update restores that region, draws the image, any patches,
+lines or text on top of it and the title, then blits only that region.
+A full draw of the canvas for any other reason, ex. a resize or a click
+adding a patch, saves the region again.
+
+Images from a framecache.FrameCache are drawn at the pyramid level which
+matches the screen: a large image in a small axes is drawn from a binned
+copy, and when zoomed in only the visible part of the full image is drawn.
+The image extent stays in full image pixel coordinates, so the level in use
+does not change the coordinates of clicks or patches. The level is picked
+again whenever the axes limits change, ex. on zoom or pan.
+"""
+import numpy as np
+from matplotlib.transforms import Bbox
+import framecache
+
+
+def pick_level(visible, pixels, max_level=framecache.PYRAMID_LEVELS):
+    """
+    Coarsest pyramid level which still has at least one image pixel per screen pixel
+    :param visible: tuple (width, height) of the visible region in full image pixels
+    :param pixels: tuple (width, height) of the axes on screen in pixels
+    :param max_level: integer coarsest level available
+    :return: integer level; the image is binned by 2**level
+    """
+    ratio = min(visible[0] / max(1.0, pixels[0]), visible[1] / max(1.0, pixels[1]))
+    level = 0
+    while level < max_level and 2**(level + 1) <= ratio:
+        level += 1
+    return level
+
+
+def visible_bounds(xlim, ylim, shape):
+    """
+    Range of image pixels inside the axes limits
+    :param xlim: tuple axes x limits in image pixel coordinates
+    :param ylim: tuple axes y limits in image pixel coordinates
+    :param shape: tuple (h, w) of the full image
+    :return (r0, r1, c0, c1): integer bounds, clipped to the image
+    """
+    c0 = int(np.clip(np.floor(min(xlim) + 0.5), 0, shape[1] - 1))
+    c1 = int(np.clip(np.ceil(max(xlim) + 0.5), c0 + 1, shape[1]))
+    r0 = int(np.clip(np.floor(min(ylim) + 0.5), 0, shape[0] - 1))
+    r1 = int(np.clip(np.ceil(max(ylim) + 0.5), r0 + 1, shape[0]))
+    return r0, r1, c0, c1
+
+
+def full_extent(shape):
+    """
+    :param shape: tuple (h, w) of image pixels covered
+    :return: extent (left, right, bottom, top) as used by imshow for an image of this shape
+    """
+    return (-0.5, shape[1] - 0.5, shape[0] - 0.5, -0.5)
+
+
+class BlittedImage(object):
+    """
+    Image on a matplotlib axes updated with blitting
+    Usage:
+        display = BlittedImage(ax, canvas, cmap=cm.Greys_r)
+        display.set_range(vmin, vmax)
+        display.show(img, title='LEEM Image: E= 10.0 eV', fontsize=18)
+        display.show_frame(leemdat.display_frames(), idx, title='LEEM Image: E= 10.0 eV')
+    """
+
+    def __init__(self, ax, canvas, cmap=None):
+        """
+        :param ax: matplotlib axes to show the image in
+        :param canvas: FigureCanvas containing ax
+        :param cmap: matplotlib color map
+        """
+        self.ax = ax
+        self.canvas = canvas
+        self.cmap = cmap
+        self.image = None
+        self.clim = None
+        self.background = None
+        self.frames = None
+        self.index = None
+        self.level = 0
+        self._shape = None  # shape of the full image, which may be drawn binned or cropped
+        self._drawn_shape = None  # shape of the full image the artist was created for
+        self._updating = False
+        self._cid = canvas.mpl_connect('draw_event', self._on_draw)
+        ax.callbacks.connect('xlim_changed', self._on_limits)
+        ax.callbacks.connect('ylim_changed', self._on_limits)
+
+    def set_range(self, vmin, vmax):
+        """
+        Fix the intensity range mapped onto the color map
+        :param vmin: intensity shown as the lowest color
+        :param vmax: intensity shown as the highest color
+        """
+        self.clim = (vmin, vmax)
+        if self.image is not None:
+            self.image.set_clim(vmin, vmax)
+
+    def has_image(self, shape=None):
+        """
+        :param shape: optional tuple shape the full image must have
+        :return: True if the image artist is still on the axes, ex. the axes has not been cleared
+        """
+        if self.image is None or self.image not in self.ax.images:
+            return False
+        return shape is None or self._drawn_shape == tuple(shape[:2])
+
+    def show(self, img, title=None, extent=None, **kwargs):
+        """
+        Display an image, creating the image artist if needed
+        :param img: 2d numpy array
+        :param title: optional string axes title
+        :param extent: optional (left, right, bottom, top) of img in full image pixel coordinates
+                       when img is a binned or cropped copy; see full_extent()
+        :param kwargs: text properties for the title, ex. fontsize and color
+        :return none:
+        """
+        if title is not None:
+            self.ax.set_title(title, **kwargs)
+        if extent is None:
+            # a complete image which is not from a FrameCache
+            self.frames = None
+            self._shape = img.shape[:2]
+            extent = full_extent(self._shape)
+        if self.has_image(self._shape):
+            self.image.set_data(img)
+            self._set_extent(extent)
+            self.blit()
+            return
+
+        if self.image is not None and self.image.axes is not None:
+            self.image.remove()
+        vmin, vmax = self.clim if self.clim is not None else (img.min(), img.max())
+        self._updating = True
+        try:
+            self.image = self.ax.imshow(img, cmap=self.cmap, vmin=vmin, vmax=vmax, extent=extent,
+                                        animated=True)
+        finally:
+            self._updating = False
+        self._drawn_shape = tuple(self._shape)
+        self.ax.title.set_animated(True)
+        # the background is saved by _on_draw()
+        self.canvas.draw()
+
+    def show_frame(self, frames, idx, title=None, **kwargs):
+        """
+        Display an image from a framecache.FrameCache at the pyramid level matching the axes
+        :param frames: framecache.FrameCache
+        :param idx: integer image index
+        :param title: optional string axes title
+        :param kwargs: text properties for the title, ex. fontsize and color
+        :return none:
+        """
+        self.frames = frames
+        self.index = idx
+        self._shape = frames.get(idx).shape[:2]
+        img, extent = self.view_image()
+        self.show(img, title=title, extent=extent, **kwargs)
+        frames.prefetch(idx, self.level)
+
+    def view_image(self):
+        """
+        Pick the pyramid level for the current axes limits and size
+        :return (img, extent): 2d numpy array and its extent in full image pixel coordinates
+        """
+        shape = self._shape
+        if not self.has_image(shape):
+            # limits are set when the image is first drawn; start from the whole image
+            r0, r1, c0, c1 = 0, shape[0], 0, shape[1]
+        else:
+            r0, r1, c0, c1 = visible_bounds(self.ax.get_xlim(), self.ax.get_ylim(), shape)
+        self.level = pick_level((c1 - c0, r1 - r0), (self.ax.bbox.width, self.ax.bbox.height))
+        if self.level > 0:
+            img = self.frames.get(self.index, self.level)
+            step = 2**self.level
+            return img, full_extent((img.shape[0] * step, img.shape[1] * step))
+        # full resolution, cropped to the visible region
+        img = self.frames.get(self.index)
+        return img[r0:r1, c0:c1], (c0 - 0.5, c1 - 0.5, r1 - 0.5, r0 - 0.5)
+
+    def _set_extent(self, extent):
+        """
+        Change the image extent without changing the axes limits
+        """
+        if extent is None or tuple(self.image.get_extent()) == tuple(extent):
+            return
+        xlim, ylim = self.ax.get_xlim(), self.ax.get_ylim()
+        self._updating = True
+        try:
+            self.image.set_extent(extent)
+            self.ax.set_xlim(xlim, emit=False, auto=None)
+            self.ax.set_ylim(ylim, emit=False, auto=None)
+        finally:
+            self._updating = False
+
+    def _on_limits(self, ax):
+        """
+        MPL xlim_changed/ylim_changed callback; redraw from the level matching the new limits
+        The canvas is drawn by whatever changed the limits.
+        """
+        if self._updating:
+            return
+        self._refresh_view()
+
+    def _refresh_view(self):
+        if self.frames is None or not self.has_image(self._shape):
+            return
+        level = self.level
+        img, extent = self.view_image()
+        self.image.set_data(img)
+        self._set_extent(extent)
+        if self.level != level:
+            self.frames.prefetch(self.index, self.level)
+
+    def region(self):
+        """
+        :return: Bbox in display coordinates covering the axes and the space above it for the title
+        """
+        box = self.ax.bbox
+        return Bbox.from_extents(box.x0, box.y0, box.x1, self.ax.figure.bbox.y1)
+
+    def blit(self):
+        """
+        Redraw the image and title over the saved background
+        :return none:
+        """
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_animated()
+        self.canvas.blit(self.region())
+
+    def _draw_animated(self):
+        self.ax.draw_artist(self.image)
+        # artists above the image were drawn into the background underneath it
+        overlays = (list(self.ax.patches) + list(self.ax.lines) + list(self.ax.collections) +
+                    list(self.ax.texts) + list(self.ax.spines.values()))
+        for artist in overlays:
+            if artist.get_visible() and not artist.get_animated() and artist.get_zorder() >= self.image.get_zorder():
+                self.ax.draw_artist(artist)
+        self.ax.draw_artist(self.ax.title)
+
+    def _on_draw(self, event):
+        """
+        MPL draw_event callback; save the background and draw the animated artists
+        """
+        if not self.has_image():
+            # axes was cleared; the title is no longer drawn by this object
+            self.background = None
+            if self.ax.title.get_animated():
+                self.ax.title.set_animated(False)
+                self.ax.draw_artist(self.ax.title)
+            return
+        # the axes may have been resized since the pyramid level was picked
+        self._refresh_view()
+        self.background = self.canvas.copy_from_bbox(self.region())
+        self._draw_animated()
@@ -0,0 +1,129 @@
+"""
+Parallel minima counting with the I(V) stack held in shared memory
+
+The stack is copied once into a multiprocessing.shared_memory block.
+Worker processes attach to that block by name and each counts the minima
+of a band of image rows in place with detect_peaks_batch(), writing the
+counts into a shared output mask. Only the row range of a tile is sent to
+a worker, so no I(V) curves are pickled.
+
+This module does not depend on Qt. Progress is reported through a
+callable and the calculation is stopped early through a second callable,
+so it can be driven from a QThread or from a plain script.
+"""
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+import LEEMFUNCTIONS as LF
+from detect_peaks import detect_peaks_batch as dp_batch
+
+# number of tiles handed out per worker; more tiles give finer progress and load balancing
+TILES_PER_WORKER = 8
+# number of image rows copied into shared memory at a time from a memory-mapped stack
+COPY_ROWS = 64
+
+# shared arrays attached in each worker process by _attach()
+_shared = {}
+
+
+def shared_array(shape, dtype):
+    """
+    Allocate a numpy array backed by a new shared memory block
+    The caller owns the block and must close() and unlink() it when done
+    :param shape: tuple shape of array
+    :param dtype: numpy dtype of array
+    :return (shm, arr): SharedMemory block and numpy array viewing it
+    """
+    nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _attach(specs):
+    """
+    Worker process initializer; map the shared input and output arrays
+    :param specs: dict of name -> (shared memory name, shape, dtype string)
+    """
+    for key, (name, shape, dtype) in specs.items():
+        # keep a reference to the SharedMemory object so its buffer stays mapped
+        shm = shared_memory.SharedMemory(name=name)
+        _shared[key] = (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+
+
+def _count_tile(r0, r1, mpd):
+    """
+    Count minima for image rows r0 to r1 of the shared stack
+    :return (r0, r1): row range which has been written to the output mask
+    """
+    data = _shared['data'][1]
+    out = _shared['out'][1]
+    out[r0:r1] = dp_batch(data[r0:r1], valley=True, mpd=mpd, axis=2)[0]
+    return r0, r1
+
+
+def tile_rows(ht, workers):
+    """
+    :param ht: integer image height
+    :param workers: integer number of worker processes
+    :return: list of (r0, r1) row ranges covering the image
+    """
+    step = max(1, -(-ht // (workers * TILES_PER_WORKER)))
+    return [(r0, min(r0 + step, ht)) for r0 in range(0, ht, step)]
+
+
+def count_minima(data, mpd=10, workers=None, energies=slice(None), progress=None, cancelled=None):
+    """
+    Count the minima in every I(V) curve of a data set using worker processes
+    Data should be smoothed beforehand
+
+    :param data: 3d numpy array, np.memmap or lazy stack with shape (h, w, E)
+    :param mpd: minimum peak distance in energy steps passed to detect_peaks_batch()
+    :param workers: number of worker processes; None for one per cpu core
+    :param energies: slice selecting the energy window to process
+    :param progress: optional callable progress(num_done, num_total) called after each tile
+    :param cancelled: optional callable returning True when the calculation should stop
+    :return mask: int32 array with shape (h, w), or None if cancelled
+    """
+    workers = LF.resolve_workers(workers)
+    ht, wd = data.shape[0], data.shape[1]
+    num_e = len(range(data.shape[2])[energies])
+    tiles = tile_rows(ht, workers)
+
+    if workers == 1:
+        # no benefit from shared memory in a single process
+        mask = np.empty((ht, wd), dtype=np.int32)
+        for num, (r0, r1) in enumerate(tiles, 1):
+            if cancelled is not None and cancelled():
+                return None
+            mask[r0:r1] = dp_batch(np.asarray(data[r0:r1, :, energies]), valley=True, mpd=mpd, axis=2)[0]
+            if progress is not None:
+                progress(num, len(tiles))
+        return mask
+
+    data_shm, shared_data = shared_array((ht, wd, num_e), data.dtype)
+    out_shm, shared_out = shared_array((ht, wd), np.int32)
+    try:
+        for r0 in range(0, ht, COPY_ROWS):
+            shared_data[r0:r0 + COPY_ROWS] = data[r0:r0 + COPY_ROWS, :, energies]
+        specs = {'data': (data_shm.name, shared_data.shape, shared_data.dtype.str),
+                 'out': (out_shm.name, shared_out.shape, shared_out.dtype.str)}
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach, initargs=(specs,)) as pool:
+            pending = set(pool.submit(_count_tile, r0, r1, mpd) for r0, r1 in tiles)
+            num_done = 0
+            while pending:
+                finished, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()  # raise any exception from the worker
+                    num_done += 1
+                    if progress is not None:
+                        progress(num_done, len(tiles))
+                if cancelled is not None and cancelled():
+                    for future in pending:
+                        future.cancel()
+                    return None
+        return shared_out.copy()
+    finally:
+        del shared_data, shared_out
+        for shm in (data_shm, out_shm):
+            shm.close()
+            shm.unlink()
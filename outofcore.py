@@ -0,0 +1,221 @@
+"""
+Out-of-core processing of 3d stacks which do not fit in memory
+
+A stack with shape (h, w, E) is processed in spatial tiles. Each tile
+holds the complete I(V) curves for a block of pixels, so any operation
+which works on one curve at a time (smoothing, derivatives, counting
+extrema, per-pixel feature maps) gives the same result as on the full
+array. Tiles are read from a memory-mapped or lazily loaded stack and
+results are written into memory-mapped .npy files. Peak memory use is
+set by a budget in bytes rather than by the image size.
+
+Tiles are bands of complete image rows where possible, since these are
+contiguous in a C-ordered (h, w, E) array on disk.
+"""
+import tempfile
+import numpy as np
+import LEEMFUNCTIONS as LF
+from detect_peaks import detect_peaks_batch as dp_batch
+
+DEF_MEMORY_BUDGET = 512 * 1024**2
+# number of float64 working copies of a tile assumed to be alive during an operation
+WORK_COPIES = 4
+
+
+def in_memory(data):
+    """
+    :param data: 3d array-like data set
+    :return: True if data is a numpy array held in RAM
+    """
+    return isinstance(data, np.ndarray) and not isinstance(data, np.memmap)
+
+
+def scratch_path(prefix='please_'):
+    """
+    Create an empty temporary .npy file to hold a memory-mapped result
+    :return: string path to file
+    """
+    with tempfile.NamedTemporaryFile(prefix=prefix, suffix='.npy', delete=False) as f:
+        return f.name
+
+
+def tile_shape(shape, bytes_per_pixel, budget=DEF_MEMORY_BUDGET):
+    """
+    Largest tile of pixels which fits within a memory budget
+    Complete image rows are preferred; a single row is split only if it does not fit
+    :param shape: tuple (h, w, ...) of data set
+    :param bytes_per_pixel: integer memory needed per pixel of a tile
+    :param budget: integer memory budget in bytes
+    :return (rows, cols): integer tile size
+    """
+    ht, wd = shape[0], shape[1]
+    pixels = max(1, int(budget // bytes_per_pixel))
+    if pixels >= wd:
+        return min(ht, pixels // wd), wd
+    return 1, pixels
+
+
+def iter_tiles(shape, tile):
+    """
+    :param shape: tuple (h, w, ...) of data set
+    :param tile: tuple (rows, cols) from tile_shape()
+    :return: yields tuples (row slice, column slice)
+    """
+    for r0 in range(0, shape[0], tile[0]):
+        for c0 in range(0, shape[1], tile[1]):
+            yield slice(r0, r0 + tile[0]), slice(c0, c0 + tile[1])
+
+
+def open_output(shape, dtype, path=None):
+    """
+    Allocate an output array
+    :param path: string path to .npy file; if None the output is held in memory
+    :return: numpy array or np.memmap
+    """
+    if path is None:
+        return np.empty(shape, dtype=dtype)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def map_tiles(data, func, out_tail=(), out_dtype=np.float32, out_path=None,
+              energies=slice(None), budget=DEF_MEMORY_BUDGET, progress=None):
+    """
+    Apply a function to each spatial tile of a 3d data set and collect the results
+
+    :param data: 3d numpy array, np.memmap, LF.MemmapStack or chunkstore.ChunkStack with shape (h, w, E)
+    :param func: callable taking a 3d array (rows, cols, E') of complete I(V) curves and
+                 returning an array with shape (rows, cols) + out_tail
+    :param out_tail: tuple of trailing output dimensions per pixel, ex. (E',) for a smoothed stack
+    :param out_dtype: numpy dtype of output
+    :param out_path: string path to .npy output file; if None the output is held in memory
+    :param energies: slice selecting the energy window to process
+    :param budget: integer memory budget in bytes for a single tile including working copies
+    :param progress: optional callable progress(num_done, num_total) called after each tile
+    :return out: numpy array or np.memmap with shape (h, w) + out_tail
+    """
+    if budget is None:
+        budget = DEF_MEMORY_BUDGET
+    num_e = len(range(data.shape[2])[energies])
+    out_tail = tuple(out_tail)
+    bytes_per_pixel = (num_e * (np.dtype(data.dtype).itemsize + WORK_COPIES * 8) +
+                       int(np.prod(out_tail)) * np.dtype(out_dtype).itemsize)
+    tile = tile_shape(data.shape, bytes_per_pixel, budget)
+    tiles = list(iter_tiles(data.shape, tile))
+
+    out = open_output(data.shape[:2] + out_tail, out_dtype, out_path)
+    for num, (rows, cols) in enumerate(tiles, 1):
+        out[rows, cols] = func(np.asarray(data[rows, cols, energies]))
+        if progress is not None:
+            progress(num, len(tiles))
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def smooth_stack(data, window_len=10, window_type='flat', **kwargs):
+    """
+    Smooth every I(V) curve in a data set with LF.smooth_cube()
+    :param kwargs: out_path, energies, budget and progress passed to map_tiles()
+    :return: float32 array with the same shape as the processed energy window
+    """
+    num_e = len(range(data.shape[2])[kwargs.get('energies', slice(None))])
+
+    def func(block):
+        return LF.smooth_cube(block, axis=2, window_len=window_len, window_type=window_type)
+    return map_tiles(data, func, out_tail=(num_e,), out_dtype=np.float32, **kwargs)
+
+
+def derivative_stack(data, elist, smooth_after=True, window_len=10, window_type='flat', **kwargs):
+    """
+    dI/dE of every I(V) curve in a data set, optionally smoothed afterwards
+    :param elist: list of energy values for the processed energy window
+    :param smooth_after: boolean; if True smooth the derivative, see LF.derivative_cube()
+    :param kwargs: out_path, energies, budget and progress passed to map_tiles()
+    :return: float32 array with shape (h, w, E'-1)
+    """
+    num_e = len(range(data.shape[2])[kwargs.get('energies', slice(None))])
+
+    def func(block):
+        return LF.derivative_cube(block, elist, window_len=window_len, window_type=window_type,
+                                  smooth_before=False, smooth_after=smooth_after, axis=2)
+    return map_tiles(data, func, out_tail=(num_e - 1,), out_dtype=np.float32, **kwargs)
+
+
+def minima_count_map(data, mpd=10, **kwargs):
+    """
+    Number of minima in every I(V) curve of a data set found with detect_peaks_batch()
+    Data should be smoothed beforehand, see smooth_stack()
+    :param mpd: minimum peak distance in energy steps
+    :param kwargs: out_path, energies, budget and progress passed to map_tiles()
+    :return: int32 array with shape (h, w)
+    """
+    def func(block):
+        return dp_batch(block, valley=True, mpd=mpd, axis=2)[0]
+    return map_tiles(data, func, out_dtype=np.int32, **kwargs)
+
+
+def layer_count_map(data, elist, thresh=5, **kwargs):
+    """
+    Out-of-core version of LF.count_layers_new()
+    Count minima in the smoothed derivative of every I(V) curve,
+    ignoring curves which are flat between their first and last minimum
+    :param elist: list of energy values for the processed energy window
+    :param thresh: variance threshold passed to LF.check_flat_and_count()
+    :param kwargs: out_path, energies, budget and progress passed to map_tiles()
+    :return: int32 array with shape (h, w)
+    """
+    def func(block):
+        return LF.count_layers_new(block, elist, thresh=thresh)
+    return map_tiles(data, func, out_dtype=np.int32, **kwargs)
+
+
+def feature_map(data, reducer, out_dtype=np.float32, **kwargs):
+    """
+    Reduce every I(V) curve of a data set to a single value
+    ex. feature_map(data, np.argmax) gives a map of the energy index of maximum intensity
+    :param reducer: callable accepting an array and an axis keyword, ex. np.mean, np.argmax, np.std
+    :param kwargs: out_path, energies, budget and progress passed to map_tiles()
+    :return: array with shape (h, w)
+    """
+    return map_tiles(data, lambda block: reducer(block, axis=2), out_dtype=out_dtype, **kwargs)
+
+
+def extremum_index(data, valley=True, mpd=10, window_len=10, window_type='flat',
+                   budget=DEF_MEMORY_BUDGET, progress=None):
+    """
+    Locate the extrema of every smoothed I(V) curve over the full energy axis
+    The result is a CSR-style index: the extrema of the pixel with flat index k = r*w + c
+    are positions[offsets[k]:offsets[k+1]], sorted by energy index.
+    Counts in any energy window are then found with LF.window_extremum_counts()
+    without smoothing or searching the data again.
+
+    :param data: 3d numpy array, np.memmap or lazy stack of raw I(V) data with shape (h, w, E)
+    :param valley: boolean; if True locate minima, else maxima
+    :param mpd: minimum peak distance in energy steps passed to detect_peaks_batch()
+    :param window_len: smoothing window length passed to LF.smooth_cube()
+    :param window_type: smoothing window type passed to LF.smooth_cube()
+    :param budget: integer memory budget in bytes for a single tile including working copies
+    :param progress: optional callable progress(num_done, num_total) called after each tile
+    :return (offsets, positions): int64 array of length h*w + 1 and int32 array of energy indices
+    """
+    if budget is None:
+        budget = DEF_MEMORY_BUDGET
+    bytes_per_pixel = data.shape[2] * (np.dtype(data.dtype).itemsize + WORK_COPIES * 8)
+    tile = tile_shape(data.shape, bytes_per_pixel, budget)
+    tiles = list(iter_tiles(data.shape, tile))
+
+    # tiles are either bands of complete rows or pieces of a single row in order,
+    # so concatenating the per tile results keeps the pixels in C order
+    counts = []
+    positions = []
+    for num, (rows, cols) in enumerate(tiles, 1):
+        smth = LF.smooth_cube(np.asarray(data[rows, cols]), axis=2,
+                              window_len=window_len, window_type=window_type)
+        offsets, ind = dp_batch(smth, valley=valley, mpd=mpd, axis=2, output='csr')
+        counts.append(np.diff(offsets))
+        positions.append(ind.astype(np.int32))
+        if progress is not None:
+            progress(num, len(tiles))
+    offsets = np.zeros(data.shape[0] * data.shape[1] + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(counts), out=offsets[1:])
+    return offsets, np.concatenate(positions)
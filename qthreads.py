@@ -11,14 +11,27 @@ Common tasks for the worker thread will be:
     memory
     Outputting IV-data to text files(s)
 
+Analyses such as smoothing and counting minima are run as
+jobs by scheduler.Scheduler instead. The GUI runs loading
+and text output tasks as scheduler.WorkerJob objects so they
+are listed and cancelled with the other jobs.
+
 """
 import os
 import LEEMFUNCTIONS as LF
+import stackcache
+import chunkstore
 import numpy as np
-from detect_peaks import detect_peaks as dp
 from PyQt4 import QtGui, QtCore
 
 
+class TaskCancelled(Exception):
+    """
+    Raised by WorkerThread.report() when a task has been cancelled
+    """
+    pass
+
+
 # TODO: Consider splitting to multiple classes for separate tasks
 class WorkerThread(QtCore.QThread):
     """
@@ -41,25 +54,70 @@ class WorkerThread(QtCore.QThread):
         byte: string 'L or 'B' denoting endian-ness of data
         outpath: string path to directory in which to output .dat files
         files: list of strings of file names to be output as raw data to outpath
+        mmap: boolean; if True raw data is memory mapped rather than read into memory
+        workers: int number of parallel workers used to read files; None for one per cpu core
+        cache: boolean; if True the assembled stack is cached to a single file in the data directory
+        fmt: string output format for GEN_DAT_FILES; 'dat' (default) or 'chunked'
+        stream: boolean; if True data is loaded progressively and emitted in batches via the loaded signal
+        first: int index of the image to load first when streaming; negative values count from the end
+        indices: list of int file indices to load, from LF.energy_window(); defaults to all files
     """
 
     done = QtCore.pyqtSignal()
+    # (number of files loaded, total number of files)
+    progress = QtCore.pyqtSignal(int, int)
+    # (partially loaded 3d array, first loaded index, last loaded index)
+    loaded = QtCore.pyqtSignal(object, int, int)
 
     def __init__(self, task=None, **kwargs):
         super(WorkerThread, self).__init__()
         self.task = task
         # Get parameters as dictionary and validate against keys
         self.params = kwargs
+        if 'workers' not in self.params.keys():
+            self.params['workers'] = 1  # default to serial file loading
+        if 'cache' not in self.params.keys():
+            self.params['cache'] = False  # default to no stack cache
+        if 'stream' not in self.params.keys():
+            self.params['stream'] = False  # default to emitting data once fully loaded
+        if 'first' not in self.params.keys():
+            self.params['first'] = -1  # default to streaming from the last image
+        if 'indices' not in self.params.keys():
+            self.params['indices'] = None  # default to loading all files
         # path refers top input data path
         # output data path is labeled as outpath
         self.valid_keys = ['path', 'data', 'ilist', 'elist',
-                           'imht', 'imwd', 'name', 'bits', 'ext', 'byte', 'outpath', 'files']
+                           'imht', 'imwd', 'name', 'bits', 'ext', 'byte', 'outpath', 'files',
+                           'mmap', 'workers', 'cache', 'fmt', 'stream', 'first',
+                           'indices']
         for key in self.params.keys():
             if key not in self.valid_keys:
                 print('Terminating - ERROR Invalid Task Parameter: {}'.format(key))
                 print('Valid Parameters are: {}'.format(self.params.keys()))
                 self.quit()
                 self.exit()
+        self._cancelled = False
+
+    def cancel(self):
+        """
+        Ask a long running task to stop; tasks which support this check is_cancelled() between steps
+        """
+        self._cancelled = True
+
+    def is_cancelled(self):
+        """
+        :return: True if cancel() has been called
+        """
+        return self._cancelled
+
+    def report(self, num, total):
+        """
+        Progress callback of long running tasks; emit the progress signal
+        :raises TaskCancelled: if cancel() has been called
+        """
+        if self._cancelled:
+            raise TaskCancelled()
+        self.progress.emit(num, total)
 
     # TODO: better method to implement thread tasks instead of overloading run()
     # Work has been started in git branch dev_updateThreading
@@ -68,6 +126,16 @@ class WorkerThread(QtCore.QThread):
         # Overload the QThread run() method to do specific tasks
         :return none:
         """
+        try:
+            self.run_task()
+        except TaskCancelled:
+            print('Task {} cancelled ...'.format(self.task))
+
+    def run_task(self):
+        """
+        Execute the task in the calling thread
+        :raises TaskCancelled: if the task is stopped by cancel()
+        """
         if self.task is None:
             print('Terminating - No task to execute ...')
             self.quit()
@@ -98,16 +166,6 @@ class WorkerThread(QtCore.QThread):
             self.quit()
             self.exit()  # restrict action to one task
 
-        elif self.task == 'COUNT_MINIMA':
-            self.count_Minima()
-            self.quit()
-            self.exit()  # restrict action to one task
-
-        elif self.task == 'SMOOTH':
-            self.smooth()
-            self.quit()
-            self.exit()  # restrict action to one task
-
         elif self.task == 'GEN_DAT_FILES':
             self.gen_Dat_Files()
             self.quit()
@@ -141,16 +199,97 @@ class WorkerThread(QtCore.QThread):
         if 'byte' not in self.params.keys():
             self.params['byte'] = 'L'  # default to Little Endian
 
+        if 'mmap' not in self.params.keys():
+            self.params['mmap'] = False  # default to reading all data into memory
+
         # load raw data
-        dat_3d = LF.process_LEEM_Data(dirname=self.params['path'],
-                                      ht=self.params['imht'],
-                                      wd=self.params['imwd'],
-                                      bits=self.params['bits'],
-                                      byte=self.params['byte'])
+        dat_3d = self.load_raw_data()
 
         # emit output signal with np array as generic pyobject type
         self.emit(QtCore.SIGNAL('output(PyQt_PyObject)'), dat_3d)
 
+    def load_raw_data(self):
+        """
+        Load raw binary data using the current parameters
+        If the 'cache' parameter is set, the assembled stack is read from
+        or written to a consolidated cache file in the data directory
+        :return: 3d numpy array, np.memmap or LF.MemmapStack
+        """
+        def loader():
+            if self.params['stream'] and not self.params['mmap']:
+                return self.emit_batches(LF.stream_LEEM_Data(dirname=self.params['path'],
+                                                             ht=self.params['imht'],
+                                                             wd=self.params['imwd'],
+                                                             bits=self.params['bits'],
+                                                             byte=self.params['byte'],
+                                                             first=self.params['first'],
+                                                             workers=self.params['workers'],
+                                                             indices=self.params['indices']))
+            return LF.process_LEEM_Data(dirname=self.params['path'],
+                                        ht=self.params['imht'],
+                                        wd=self.params['imwd'],
+                                        bits=self.params['bits'],
+                                        byte=self.params['byte'],
+                                        mmap=self.params['mmap'],
+                                        progress=self.report,
+                                        workers=self.params['workers'],
+                                        indices=self.params['indices'])
+
+        if not self.params['cache']:
+            return loader()
+        files = stackcache.stack_files(self.params['path'], '.dat')
+        if not files:
+            return loader()
+        # header length of the raw files is recorded in the cache so a change is detected
+        fmt = LF.raw_format_string(self.params['bits'], self.params['byte'])
+        header = (os.stat(os.path.join(self.params['path'], files[0])).st_size -
+                  np.dtype(fmt).itemsize * self.params['imht'] * self.params['imwd'])
+        cache_params = {'ht': self.params['imht'], 'wd': self.params['imwd'],
+                        'bits': self.params['bits'], 'byte': self.params['byte'],
+                        'header': header, 'indices': self.params['indices']}
+        return stackcache.cached_load(self.params['path'], '.dat', loader,
+                                      elist=self.params.get('elist'), params=cache_params)
+
+    def load_image_data(self, swap=False):
+        """
+        Load image files using the current parameters
+        If the 'cache' parameter is set, the assembled stack is read from
+        or written to a consolidated cache file in the data directory
+        :param swap: boolean to swap the byte order of the array
+        :return: 3d numpy array or np.memmap; None if no images were found
+        """
+        def loader():
+            if self.params['stream'] and not swap:
+                return self.emit_batches(LF.stream_img_array(self.params['path'],
+                                                             self.params['ext'],
+                                                             first=self.params['first'],
+                                                             workers=self.params['workers'],
+                                                             indices=self.params['indices']))
+            return LF.get_img_array(self.params['path'],
+                                    ext=self.params['ext'],
+                                    swap=swap,
+                                    progress=self.report,
+                                    workers=self.params['workers'],
+                                    indices=self.params['indices'])
+
+        if not self.params['cache']:
+            return loader()
+        cache_params = {'ext': self.params['ext'], 'swap': swap, 'indices': self.params['indices']}
+        return stackcache.cached_load(self.params['path'], self.params['ext'], loader,
+                                      elist=self.params.get('elist'), params=cache_params)
+
+    def emit_batches(self, batches):
+        """
+        Emit each partially loaded stack from a generator via the loaded signal
+        :param batches: iterable of (dat_3d, lo, hi) from LF.stream_stack()
+        :return: fully loaded 3d numpy array, or None if nothing was loaded
+        """
+        dat_3d = None
+        for dat_3d, lo, hi in batches:
+            self.loaded.emit(dat_3d, lo, hi)
+            self.report(hi - lo + 1, dat_3d.shape[2])
+        return dat_3d
+
     def load_LEED_Images(self):
         """
         Load LEED data from image files
@@ -174,7 +313,7 @@ class WorkerThread(QtCore.QThread):
                 swap = False
                 print("Error reading byte order from experimental config ...")
         """
-        data = LF.get_img_array(self.params['path'], ext=self.params['ext'], swap=False)
+        data = self.load_image_data(swap=False)
         if data is None:
             self.quit()
             self.exit()
@@ -204,12 +343,11 @@ class WorkerThread(QtCore.QThread):
         if 'byte' not in self.params.keys():
             self.params['byte'] = 'L'  # default to Little Endian
 
+        if 'mmap' not in self.params.keys():
+            self.params['mmap'] = False  # default to reading all data into memory
+
         # load raw data
-        dat_3d = LF.process_LEEM_Data(dirname=self.params['path'],
-                                      ht=self.params['imht'],
-                                      wd=self.params['imwd'],
-                                      bits=self.params['bits'],
-                                      byte=self.params['byte'])
+        dat_3d = self.load_raw_data()
 
         # emit output signal with np array as generic pyobject type
         self.emit(QtCore.SIGNAL('output(PyQt_PyObject)'), dat_3d)
@@ -223,8 +361,7 @@ class WorkerThread(QtCore.QThread):
             print('Required Parameters: path, ext')
         print('Loading LEEM Data from Images via QThread ...')
         try:
-            data = LF.get_img_array(self.params['path'],
-                                    ext=self.params['ext'])
+            data = self.load_image_data()
         except IOError as e:
             print(e)
             print('Error occurred while loading LEEM data from images using a QThread')
@@ -252,48 +389,6 @@ class WorkerThread(QtCore.QThread):
             for index, item in enumerate(elist):
                 f.write(str(item) + '\t' + str(ilist[index]) + '\n')
 
-    def count_Minima(self):
-        """
-        Count number of minima in each I(V) curve
-        Store number of minima from curve at data[r,c, :] in image mask[r,c]
-        emit image_mask as pyqtSignal to return the result to main GUI Thread
-
-        :return:
-        """
-        # requires params: data
-        # :param data: 3D numpy array containing I(V) data cut to specified energy window
-        if 'data' not in self.params.keys():
-            print('Terminating - ERROR: incorrect parameters for COUNT_MINIMA task')
-            print('Required Parameters: data - 3d numpy array')
-            return
-        top_image = self.params['data'][:, :, 0]
-        it = np.nditer(top_image, flags=['multi_index'])
-        mask = np.zeros((self.params['data'].shape[0],
-                         self.params['data'].shape[1]))
-
-        print("Minima Counting:")
-        print("    input_data shape: {}".format(self.params['data'].shape))
-        print("    input_data type:  {}".format(self.params['data'].dtype))
-        print("    number of curves to process:  {}".format(top_image.size))
-        while not it.finished:
-            r = it.multi_index[0]
-            c = it.multi_index[1]
-            # dp() method returns coordinates of extrema found
-            # dp( valley=True) returns only the minima
-            # len(dp()) then gives the number of minima
-            mask[r, c] = len(dp(self.params['data'][r, c, :], valley=True, mpd=10))
-            it.iternext()
-        self.emit(QtCore.SIGNAL('output(PyQt_PyObject)'), mask)
-
-    def smooth(self):
-
-        if 'data' not in self.params.keys():
-            print('Terminating - ERROR: incorrect parameters for smooth task')
-            print('Required Parameters: data - 3d numpy array')
-            return
-        smth = np.apply_along_axis(LF.smooth, 2, self.params['data'], window_len=10, window_type='flat')
-        self.emit(QtCore.SIGNAL('output(PyQt_PyObject)'), smth)
-
     def gen_Dat_Files(self):
         """
 
@@ -325,12 +420,12 @@ class WorkerThread(QtCore.QThread):
         elif bits == 8 or bits == 1:
             bytes_per_pixel = 1
 
-        for file in files:
-            with open(os.path.join(indir, file), 'rb') as infile:
-                header = len(infile.read()) - bytes_per_pixel * w * h
-                infile.seek(0)
-                fmtstr = byte_order + 'u' + str(bytes_per_pixel)
-                data = np.fromstring(infile.read()[header:], fmtstr).reshape((h, w))
-                with open(os.path.join(outdir, file.split('.')[0]+'.dat'), 'wb') as outfile:
-                    data.tofile(outfile)
+        fmtstr = byte_order + 'u' + str(bytes_per_pixel)
+        if self.params.get('fmt', 'dat') == 'chunked':
+            outpath = os.path.join(outdir, os.path.basename(os.path.normpath(indir)) + chunkstore.EXT)
+            LF.write_chunked_stack(indir, outpath, sorted(files), w, h, fmtstr,
+                                   progress=self.report)
+        else:
+            LF.write_dat_files(indir, outdir, files, w, h, fmtstr,
+                               workers=self.params['workers'], progress=self.report)
         self.done.emit()
@@ -0,0 +1,632 @@
+"""
+Job scheduler for long running analyses
+
+Each analysis is a Job object run on a bounded QThreadPool, so starting
+a second job queues it rather than replacing the first. Jobs report
+progress and an estimated time remaining through Qt signals and are
+cancelled cooperatively: a job checks its CancellationToken whenever it
+reports progress and stops by raising JobCancelled.
+
+Jobs can be chained with then(); the result of a job is handed to the
+next one as its source, ex. smoothed data to a minima count:
+    job = SmoothJob(data)
+    job.then(CountMinimaJob())
+    scheduler.submit(job)
+
+Memory-mapped results are written to scratch files owned by the job which
+creates them. The Scheduler deletes them once that job and every job chained
+after it have finished, failed or been cancelled.
+
+JobQueueWidget lists queued, running and finished jobs with their progress
+and lets the user cancel them.
+"""
+import os
+import time
+import traceback
+import numpy as np
+from PyQt4 import QtCore, QtGui
+import LEEMFUNCTIONS as LF
+import minimacounter
+import outofcore
+import qthreads
+
+# maximum number of jobs run at the same time; jobs such as counting minima use worker processes of their own
+DEF_MAX_JOBS = 2
+
+# job priorities; QThreadPool starts higher values first
+LOW = 0
+NORMAL = 5
+HIGH = 10
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job to stop it once its CancellationToken has been cancelled
+    """
+    pass
+
+
+class CancellationToken(object):
+    """
+    Flag shared between the GUI thread, which sets it, and a running job, which polls it
+    """
+
+    def __init__(self):
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def check(self):
+        """
+        :raises JobCancelled: if cancel() has been called
+        """
+        if self._cancelled:
+            raise JobCancelled()
+
+
+class Job(QtCore.QObject):
+    """
+    Base class of a unit of work run by a Scheduler
+    Subclasses implement run(source) and call report(num, total) as work is done.
+    """
+
+    # (steps done, total steps)
+    progress = QtCore.pyqtSignal(int, int)
+    # estimated seconds remaining
+    eta = QtCore.pyqtSignal(float)
+    # new status string; one of QUEUED, RUNNING, DONE, FAILED or CANCELLED
+    status_changed = QtCore.pyqtSignal(str)
+    # result of run()
+    result_ready = QtCore.pyqtSignal(object)
+    # error message
+    failed = QtCore.pyqtSignal(str)
+
+    name = 'Job'
+
+    def __init__(self, priority=NORMAL, source=None):
+        """
+        :param priority: integer priority; LOW, NORMAL or HIGH
+        :param source: optional input to run(); set from the previous result for chained jobs
+        """
+        super(Job, self).__init__()
+        self.priority = priority
+        self.source = source
+        self.token = CancellationToken()
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.next_jobs = []
+        self.started_at = None
+        self.finished_at = None
+        self.done_steps = 0
+        self.total_steps = 0
+        self.scratch = []
+
+    def then(self, job):
+        """
+        Run another job with the result of this one as its source once this job is done
+        :param job: Job
+        :return job: the chained job, so calls can be strung together
+        """
+        self.next_jobs.append(job)
+        return job
+
+    def chain(self):
+        """
+        :return: list of this job and every job chained after it
+        """
+        jobs = [self]
+        for job in self.next_jobs:
+            jobs.extend(job.chain())
+        return jobs
+
+    def cancel(self):
+        """
+        Ask the job and the jobs chained after it to stop
+        A queued job is cancelled before it starts; a running job stops at its next report()
+        """
+        for job in self.chain():
+            job.token.cancel()
+            if job.status == QUEUED:
+                job.set_status(CANCELLED)
+
+    def scratch_file(self):
+        """
+        Create a temporary .npy file for a memory-mapped result of this job
+        The file is deleted by the Scheduler once this job and the jobs chained after it are finished;
+        a result needed for longer must be copied, ex. into the derived data cache.
+        :return: string path to file
+        """
+        path = outofcore.scratch_path()
+        self.scratch.append(path)
+        return path
+
+    def release_scratch(self):
+        """
+        Delete the scratch files of this job
+        """
+        for path in self.scratch:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print('Unable to remove scratch file {0}: {1}'.format(path, e))
+        self.scratch = []
+
+    def set_status(self, status):
+        self.status = status
+        self.status_changed.emit(status)
+
+    def report(self, num, total, check=True):
+        """
+        Called from run() as work is done; emit progress and ETA and stop if cancelled
+        :param num: integer steps done
+        :param total: integer total steps
+        :param check: boolean; if False only report, for code which polls the token itself
+        :raises JobCancelled: if the job has been cancelled
+        """
+        if check:
+            self.token.check()
+        self.done_steps, self.total_steps = num, total
+        self.progress.emit(num, total)
+        if num > 0 and self.started_at is not None:
+            elapsed = time.time() - self.started_at
+            self.eta.emit(elapsed * (total - num) / float(num))
+
+    def run(self, source):
+        """
+        Do the work of the job in a pool thread; implemented by subclasses
+        :param source: input of the job, ex. the result of the previous job in a chain
+        :return: result of the job
+        """
+        raise NotImplementedError
+
+    def execute(self):
+        """
+        Run the job and emit its result or error; called by the Scheduler in a pool thread
+        """
+        if self.token.cancelled:
+            self.set_status(CANCELLED)
+            return
+        self.started_at = time.time()
+        self.set_status(RUNNING)
+        try:
+            result = self.run(self.source)
+        except JobCancelled:
+            self.finished_at = time.time()
+            self.set_status(CANCELLED)
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.error = '{0}: {1}'.format(type(e).__name__, e)
+            self.finished_at = time.time()
+            self.failed.emit(self.error)
+            self.set_status(FAILED)
+            return
+        finally:
+            # don't keep the input, often a large array, alive in the job list
+            self.source = None
+        self.result = result
+        self.finished_at = time.time()
+        self.result_ready.emit(result)
+        self.set_status(DONE)
+
+
+class FunctionJob(Job):
+    """
+    Job running an arbitrary function
+    The function is called as func(source, job, *args, **kwargs) and may call job.report()
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        """
+        :param func: callable
+        :param kwargs: name, priority and source are used by the job; the rest are passed to func
+        """
+        name = kwargs.pop('name', getattr(func, '__name__', 'Function'))
+        super(FunctionJob, self).__init__(priority=kwargs.pop('priority', NORMAL),
+                                          source=kwargs.pop('source', None))
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def run(self, source):
+        return self.func(source, self, *self.args, **self.kwargs)
+
+
+class LoadRawJob(Job):
+    """
+    Load a directory of raw binary LEEM data with LF.process_LEEM_Data()
+    """
+    name = 'Load LEEM data'
+
+    def __init__(self, path, ht, wd, bits=None, byte='L', mmap=False, workers=1, indices=None, **kwargs):
+        """
+        :param path: string path to data directory
+        :param ht: integer image height
+        :param wd: integer image width
+        :param kwargs: priority passed to Job
+        other parameters are passed to LF.process_LEEM_Data()
+        """
+        super(LoadRawJob, self).__init__(**kwargs)
+        self.params = dict(dirname=path, ht=ht, wd=wd, bits=bits, byte=byte, mmap=mmap,
+                           workers=workers, indices=indices)
+
+    def run(self, source):
+        return LF.process_LEEM_Data(progress=self.report, **self.params)
+
+
+class WorkerJob(Job):
+    """
+    Run a qthreads.WorkerThread task, ex. loading an experiment or writing I(V) data to text, as a job
+    The signals of the task (output, progress, loaded) are emitted from the pool thread; slots
+    connected to job.worker receive them as they would from a started WorkerThread.
+    The data emitted through output is the result of the job.
+    """
+    names = {'LOAD_LEEM': 'Load LEEM data',
+             'LOAD_LEEM_IMAGES': 'Load LEEM images',
+             'LOAD_LEED': 'Load LEED data',
+             'LOAD_LEED_IMAGES': 'Load LEED images',
+             'OUTPUT_TO_TEXT': 'Output I(V) to text',
+             'GEN_DAT_FILES': 'Generate .dat files'}
+
+    def __init__(self, task, priority=NORMAL, **params):
+        """
+        :param task: string WorkerThread task
+        :param priority: job priority
+        :param params: task parameters passed to WorkerThread
+        """
+        super(WorkerJob, self).__init__(priority=priority)
+        self.name = self.names.get(task, task)
+        self.output = None
+        self.worker = qthreads.WorkerThread(task=task, **params)
+        # direct connections run in the pool thread, before the queued slots of the GUI
+        self.connect(self.worker, QtCore.SIGNAL('output(PyQt_PyObject)'), self._store_output,
+                     QtCore.Qt.DirectConnection)
+        self.worker.progress.connect(self._relay_progress, QtCore.Qt.DirectConnection)
+
+    def _store_output(self, data):
+        self.output = data
+
+    def _relay_progress(self, num, total):
+        # the worker stops itself once cancelled
+        self.report(num, total, check=False)
+
+    def cancel(self):
+        self.worker.cancel()
+        super(WorkerJob, self).cancel()
+
+    def run(self, source):
+        try:
+            self.worker.run_task()
+        except qthreads.TaskCancelled:
+            raise JobCancelled()
+        output, self.output = self.output, None
+        return output
+
+
+class SmoothJob(Job):
+    """
+    Smooth every I(V) curve in a data set over an energy window
+    Data which is not held in memory is smoothed tile by tile into a memory-mapped file.
+    """
+    name = 'Smooth I(V)'
+
+    def __init__(self, data=None, energies=slice(None), window_len=10, window_type='flat',
+                 budget=None, **kwargs):
+        """
+        :param data: 3d array-like data set with shape (h, w, E); None for the result of the previous job
+        :param energies: slice selecting the energy window to smooth
+        :param budget: integer memory budget in bytes per tile for data not held in memory
+        :param kwargs: priority passed to Job
+        """
+        super(SmoothJob, self).__init__(source=data, **kwargs)
+        self.energies = energies
+        self.window_len = window_len
+        self.window_type = window_type
+        self.budget = budget
+
+    def run(self, data):
+        if not outofcore.in_memory(data):
+            return outofcore.smooth_stack(data, window_len=self.window_len, window_type=self.window_type,
+                                          out_path=self.scratch_file(), energies=self.energies,
+                                          budget=self.budget, progress=self.report)
+        # smooth in bands of rows so progress is reported and cancellation is checked
+        data = data[:, :, self.energies]
+        out = np.empty(data.shape, dtype=np.float32)
+        step = max(1, -(-data.shape[0] // 20))
+        for r0 in range(0, data.shape[0], step):
+            out[r0:r0 + step] = LF.smooth_cube(data[r0:r0 + step], axis=2, window_len=self.window_len,
+                                               window_type=self.window_type)
+            self.report(min(r0 + step, data.shape[0]), data.shape[0])
+        return out
+
+
+class CountMinimaJob(Job):
+    """
+    Count the minima in every smoothed I(V) curve of a data set
+    """
+    name = 'Count minima'
+
+    def __init__(self, data=None, mpd=10, workers=None, budget=None, **kwargs):
+        """
+        :param data: 3d array-like smoothed data with shape (h, w, E); None for the result of the previous job
+        :param mpd: minimum peak distance in energy steps
+        :param workers: number of worker processes for data held in memory; None for one per cpu core
+        :param budget: integer memory budget in bytes per tile for data not held in memory
+        :param kwargs: priority passed to Job
+        """
+        super(CountMinimaJob, self).__init__(source=data, **kwargs)
+        self.mpd = mpd
+        self.workers = workers
+        self.budget = budget
+
+    def run(self, data):
+        if not outofcore.in_memory(data):
+            return outofcore.minima_count_map(data, mpd=self.mpd, budget=self.budget, progress=self.report)
+        # count_minima() cancels its outstanding tiles itself, so progress must not raise
+        mask = minimacounter.count_minima(data, mpd=self.mpd, workers=self.workers,
+                                          progress=lambda num, total: self.report(num, total, check=False),
+                                          cancelled=lambda: self.token.cancelled)
+        self.token.check()
+        return mask
+
+
+class ExtremumIndexJob(Job):
+    """
+    Index the minima of every smoothed I(V) curve over the full energy axis, see outofcore.extremum_index()
+    """
+    name = 'Index minima'
+
+    def __init__(self, data=None, mpd=10, window_len=10, window_type='flat', budget=None, **kwargs):
+        """
+        :param data: 3d array-like raw data with shape (h, w, E); None for the result of the previous job
+        :param kwargs: priority passed to Job
+        """
+        super(ExtremumIndexJob, self).__init__(source=data, **kwargs)
+        self.mpd = mpd
+        self.window_len = window_len
+        self.window_type = window_type
+        self.budget = budget
+
+    def run(self, data):
+        return outofcore.extremum_index(data, valley=True, mpd=self.mpd, window_len=self.window_len,
+                                        window_type=self.window_type, budget=self.budget,
+                                        progress=self.report)
+
+
+class _JobRunnable(QtCore.QRunnable):
+    """
+    QRunnable executing a single job in the thread pool
+    """
+
+    def __init__(self, job):
+        super(_JobRunnable, self).__init__()
+        self.job = job
+
+    def run(self):
+        self.job.execute()
+
+
+class Scheduler(QtCore.QObject):
+    """
+    Run jobs on a bounded thread pool and start chained jobs as their predecessors finish
+    """
+
+    # a job has been submitted
+    job_added = QtCore.pyqtSignal(object)
+
+    def __init__(self, max_jobs=DEF_MAX_JOBS, parent=None):
+        """
+        :param max_jobs: integer maximum number of jobs run at the same time
+        """
+        super(Scheduler, self).__init__(parent)
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(max_jobs)
+        # every submitted job is referenced here so it is not garbage collected while queued
+        self.jobs = []
+
+    def submit(self, job):
+        """
+        Queue a job; jobs chained with then() are started when it is done
+        :param job: Job
+        :return job:
+        """
+        self._add(job)
+        self.pool.start(_JobRunnable(job), job.priority)
+        return job
+
+    def _add(self, job):
+        # chained jobs are listed straight away so the whole analysis shows in the queue
+        for queued in job.chain():
+            if queued not in self.jobs:
+                self.jobs.append(queued)
+                queued.status_changed.connect(lambda status, queued=queued: self._on_status(queued, status))
+                self.job_added.emit(queued)
+
+    def _on_status(self, job, status):
+        """
+        Runs in the GUI thread; start chained jobs once a job is done
+        """
+        if status == DONE:
+            for next_job in job.next_jobs:
+                if next_job.token.cancelled:
+                    continue
+                if next_job.source is None:
+                    next_job.source = job.result
+                self.pool.start(_JobRunnable(next_job), next_job.priority)
+            # the result has been delivered through result_ready and to the chained jobs
+            job.result = None
+        elif status in (FAILED, CANCELLED):
+            # jobs depending on this one will not run
+            for next_job in job.next_jobs:
+                next_job.cancel()
+        self._release_scratch()
+
+    def _release_scratch(self):
+        # scratch files are kept until every job which may read them has finished
+        for job in self.jobs:
+            if job.scratch and all(queued.status in FINISHED for queued in job.chain()):
+                job.release_scratch()
+
+    def active(self):
+        """
+        :return: list of jobs which are queued or running
+        """
+        return [job for job in self.jobs if job.status in (QUEUED, RUNNING)]
+
+    def cancel_all(self):
+        for job in self.active():
+            job.cancel()
+
+    def clear_finished(self):
+        """
+        Forget jobs which are done, failed or cancelled
+        """
+        self._release_scratch()
+        self.jobs = self.active()
+
+    def wait(self, msecs=-1):
+        """
+        Cancel all jobs and block until running jobs have stopped, ex. before quitting
+        :return: True if all jobs stopped in time
+        """
+        self.cancel_all()
+        done = self.pool.waitForDone(msecs)
+        # status signals of the last jobs may not have been delivered yet
+        self._release_scratch()
+        return done
+
+
+def format_eta(seconds):
+    """
+    :param seconds: float seconds remaining
+    :return: string, ex. '1 min 05 s'
+    """
+    minutes, secs = divmod(int(round(seconds)), 60)
+    if minutes:
+        return '{0} min {1:02d} s'.format(minutes, secs)
+    return '{} s'.format(secs)
+
+
+class JobQueueWidget(QtGui.QWidget):
+    """
+    Window listing the jobs of a Scheduler with their status, progress and ETA
+    """
+
+    COLUMNS = ['Job', 'Status', 'Progress', 'Time Left', '']
+
+    def __init__(self, scheduler, parent=None):
+        super(JobQueueWidget, self).__init__(parent)
+        self.scheduler = scheduler
+        self.setWindowTitle("Job Queue")
+        self.resize(600, 300)
+        self.rows = {}
+
+        self.table = QtGui.QTableWidget(0, len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+
+        self.cancel_all_button = QtGui.QPushButton("Cancel All", self)
+        self.cancel_all_button.clicked.connect(self.scheduler.cancel_all)
+        self.clear_button = QtGui.QPushButton("Clear Finished", self)
+        self.clear_button.clicked.connect(self.clear_finished)
+
+        hbox = QtGui.QHBoxLayout()
+        hbox.addStretch()
+        hbox.addWidget(self.clear_button)
+        hbox.addWidget(self.cancel_all_button)
+        vbox = QtGui.QVBoxLayout()
+        vbox.addWidget(self.table)
+        vbox.addLayout(hbox)
+        self.setLayout(vbox)
+
+        for job in self.scheduler.jobs:
+            self.add_job(job)
+        self.scheduler.job_added.connect(self.add_job)
+
+    def add_job(self, job):
+        """
+        PYQT SLOT
+        Add a row for a job and follow its signals
+        :param job: Job
+        :return none:
+        """
+        self._insert_row(job)
+        job.progress.connect(lambda num, total, job=job: self.update_progress(job, num, total))
+        job.eta.connect(lambda secs, job=job: self.update_eta(job, secs))
+        job.status_changed.connect(lambda status, job=job: self.update_status(job, status))
+
+    def _insert_row(self, job):
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        self.rows[id(job)] = row
+        self.table.setItem(row, 0, QtGui.QTableWidgetItem(job.name))
+        self.table.setItem(row, 1, QtGui.QTableWidgetItem(job.status))
+        bar = QtGui.QProgressBar(self.table)
+        bar.setRange(0, max(1, job.total_steps))
+        bar.setValue(job.done_steps)
+        self.table.setCellWidget(row, 2, bar)
+        self.table.setItem(row, 3, QtGui.QTableWidgetItem(''))
+        button = QtGui.QPushButton("Cancel", self.table)
+        button.clicked.connect(job.cancel)
+        button.setEnabled(job.status in (QUEUED, RUNNING))
+        self.table.setCellWidget(row, 4, button)
+
+    def _row(self, job):
+        row = self.rows.get(id(job))
+        if row is None or self.table.item(row, 0) is None:
+            return None
+        return row
+
+    def update_progress(self, job, num, total):
+        row = self._row(job)
+        if row is None:
+            return
+        bar = self.table.cellWidget(row, 2)
+        bar.setRange(0, max(1, total))
+        bar.setValue(num)
+
+    def update_eta(self, job, seconds):
+        row = self._row(job)
+        if row is None:
+            return
+        self.table.item(row, 3).setText(format_eta(seconds))
+
+    def update_status(self, job, status):
+        row = self._row(job)
+        if row is None:
+            return
+        self.table.item(row, 1).setText(status)
+        if status not in (QUEUED, RUNNING):
+            self.table.cellWidget(row, 4).setEnabled(False)
+            if status == DONE:
+                self.table.item(row, 3).setText(format_eta(job.finished_at - job.started_at) + ' total')
+            else:
+                self.table.item(row, 3).setText('')
+
+    def clear_finished(self):
+        """
+        Remove finished jobs from the scheduler and the table
+        :return none:
+        """
+        self.scheduler.clear_finished()
+        self.table.setRowCount(0)
+        self.rows = {}
+        for job in self.scheduler.jobs:
+            # signals of jobs still listed are already connected to this widget
+            self._insert_row(job)
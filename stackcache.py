@@ -0,0 +1,171 @@
+"""
+Consolidated binary cache for assembled image stacks
+
+Loading an experiment normally rescans and decodes every image file in the
+data directory. When caching is enabled the assembled 3d stack is written
+once to a single sidecar file in the data directory; later loads memory map
+that file instead of touching the individual images.
+
+Cache file layout:
+    8 byte magic string
+    8 byte little-endian unsigned integer: length of the JSON header
+    JSON header (fingerprint, shape, dtype, energy list, loader parameters)
+    zero padding up to the next multiple of ALIGNMENT bytes
+    raw stack data in C order with shape (ht, wd, num files)
+
+The cache is keyed by a fingerprint of the data file names, sizes and
+modification times. A cache whose fingerprint or loader parameters do not
+match the current directory is considered stale and is rebuilt.
+"""
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+
+CACHE_NAME = '.please_stack_cache'
+MAGIC = b'PLEASESC'
+VERSION = 1
+ALIGNMENT = 4096
+# number of image rows written to the cache file at a time
+BLOCK_ROWS = 64
+
+
+def cache_path(dirname):
+    """
+    :param dirname: string path to data directory
+    :return: string path to the cache file for dirname
+    """
+    return os.path.join(dirname, CACHE_NAME)
+
+
+def stack_files(dirname, ext):
+    """
+    Sorted list of data files in dirname which make up a stack
+    '.tif' and '.tiff' are treated as the same extension
+    :param dirname: string path to data directory
+    :param ext: string file extension, ex. '.dat' or '.png'
+    :return files: sorted list of file names
+    """
+    if ext in ['.tif', '.tiff']:
+        exts = ('.tif', '.tiff')
+    else:
+        exts = (ext,)
+    files = [name for name in os.listdir(dirname)
+             if name.endswith(exts) and not name.startswith('.')]
+    files.sort()
+    return files
+
+
+def dir_fingerprint(dirname, files):
+    """
+    Generate a fingerprint for a set of data files from their names, sizes and mtimes
+    File contents are not read so this is cheap even for large directories.
+    :param dirname: string path to data directory
+    :param files: list of file names in dirname
+    :return: hex digest string
+    """
+    sha = hashlib.sha1()
+    for fl in sorted(files):
+        st = os.stat(os.path.join(dirname, fl))
+        sha.update('{0}\0{1}\0{2}\n'.format(fl, st.st_size, int(st.st_mtime * 1e6)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def write_cache(dirname, data, fingerprint, elist=None, params=None):
+    """
+    Write an assembled stack to the cache file in dirname
+    The file is written under a temporary name and moved into place
+    so an interrupted write never leaves a truncated cache behind.
+    :param dirname: string path to data directory
+    :param data: 3d numpy array or MemmapStack with shape (ht, wd, num files)
+    :param fingerprint: string from dir_fingerprint()
+    :param elist: list of energy values in eV
+    :param params: dict of loader parameters used to build data
+    :return: string path to cache file
+    """
+    header = {'version': VERSION,
+              'fingerprint': fingerprint,
+              'shape': [int(n) for n in data.shape],
+              'dtype': np.dtype(data.dtype).str,
+              'elist': [float(en) for en in elist] if elist is not None else None,
+              'params': params if params is not None else {}}
+    header = json.dumps(header, sort_keys=True).encode('utf-8')
+    offset = len(MAGIC) + 8 + len(header)
+    padding = (-offset) % ALIGNMENT
+
+    path = cache_path(dirname)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * padding)
+        # write in blocks of rows to avoid a second full copy of the stack
+        for row in range(0, data.shape[0], BLOCK_ROWS):
+            np.ascontiguousarray(data[row:row + BLOCK_ROWS, :, :]).tofile(f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_cache(dirname):
+    """
+    Memory map the cache file in dirname
+    :param dirname: string path to data directory
+    :return (header, data): header dict and read-only np.memmap, or None if no valid cache exists
+    """
+    path = cache_path(dirname)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                print('Ignoring unrecognized stack cache file: {}'.format(path))
+                return None
+            hdlen = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(hdlen).decode('utf-8'))
+        if header.get('version') != VERSION:
+            return None
+        offset = len(MAGIC) + 8 + hdlen
+        offset += (-offset) % ALIGNMENT
+        data = np.memmap(path, dtype=np.dtype(header['dtype']), mode='r',
+                         offset=offset, shape=tuple(header['shape']))
+    except (IOError, OSError, ValueError, KeyError, struct.error) as e:
+        print('Error reading stack cache {0}: {1}'.format(path, e))
+        return None
+    return header, data
+
+
+def cached_load(dirname, ext, loader, elist=None, params=None):
+    """
+    Load a stack from the cache in dirname, or build it with loader() and cache it
+    :param dirname: string path to data directory
+    :param ext: string extension of the data files used to fingerprint the directory
+    :param loader: callable with no arguments returning the assembled stack
+    :param elist: list of energy values in eV to store alongside the stack
+    :param params: dict of loader parameters; a cache built with different parameters is stale
+    :return data: np.memmap of the cached stack, or the output of loader()
+    """
+    params = params if params is not None else {}
+    # round trip through json so params compare equal to those read back from the header
+    params = json.loads(json.dumps(params, sort_keys=True))
+    fingerprint = dir_fingerprint(dirname, stack_files(dirname, ext))
+
+    cached = read_cache(dirname)
+    if cached is not None:
+        header, data = cached
+        if header['fingerprint'] == fingerprint and header['params'] == params:
+            print('Loaded stack from cache: {}'.format(cache_path(dirname)))
+            return data
+        print('Stack cache is out of date - rebuilding ...')
+        del data
+
+    data = loader()
+    if data is None:
+        return None
+    try:
+        write_cache(dirname, data, fingerprint, elist=elist, params=params)
+        print('Wrote stack cache: {}'.format(cache_path(dirname)))
+    except (IOError, OSError) as e:
+        print('Unable to write stack cache to {0}: {1}'.format(dirname, e))
+    return data
@@ -8,6 +8,7 @@ import numpy as np
 from matplotlib import cm as cm
 from matplotlib import colors as clrs
 from matplotlib import colorbar
+from LEEMFUNCTIONS import derivative_cube, check_flat_and_count
 
 
 t_init = time.time()
@@ -125,29 +126,25 @@ while len(energy_list) < len(files):
 image_height = 600
 image_width = 592
 image_header = 520  # discard the first 520 bytes of each file
-arr_list = []
+data_3d = np.empty((image_height, image_width, len(files)), dtype='<u2')  # (600, 592, 250) size numpy array
 
 
-for fl in files:
+for idx, fl in enumerate(files):
     with open(fl, 'rb') as f:
-        arr_list.append(np.fromstring(f.read()[image_header:],
-                                      '<u2').reshape((image_height,
-                                                     image_width)))
-data_3d = np.dstack(arr_list)  # (600, 592, 250) size numpy array
-del arr_list  # no longer need copy of each file in list
+        f.seek(image_header)
+        # decode each file directly into its slice of the preallocated array
+        data_3d[:, :, idx] = np.fromfile(f, '<u2', count=image_height*image_width).reshape((image_height,
+                                                                                           image_width))
 
 print('Generating and Parsing Data Set ...')
 ts = time.time()
-smooth_data = np.apply_along_axis(smooth, 2, data_3d)
-diff_data = np.diff(smooth_data, axis=2) / np.diff(energy_list)
-smooth_diff_data = np.apply_along_axis(smooth, 2, diff_data)
+# smooth, differentiate and smooth again in a single pass
+smooth_diff_data = derivative_cube(data_3d, energy_list, axis=2)
 
 min_energy = 0.0
 max_energy = 5.1
 min_index = energy_list.index(min_energy)
 max_index = energy_list.index(max_energy)
-smooth_data_cut = smooth_data[:, :, min_index:max_index]
-diff_data_cut = diff_data[:, :, min_index:max_index]
 smooth_diff_data_cut = smooth_diff_data[:, :, min_index:max_index]
 energy_cut = energy_list[min_index:max_index]
 
@@ -160,16 +157,10 @@ mask_apply = np.apply_along_axis(count_mins, 2, smooth_diff_data)
 te = time.time()
 print('Apply_Along ... Elapsed: {} '.format(round(te-ts,3)))
 '''
-pool = mp.Pool(2*mp.cpu_count())  # num processes = 2*num cores
 ts = time.time()
-ins = [smooth_diff_data_cut[r,c,:] for r in range(image_height) for c in range(image_width)]
-outs = pool.map(count_and_check_flat, ins)
-pool.close()
-pool.join()
-
-outs = np.array(outs).reshape((600,592))
+outs = check_flat_and_count(smooth_diff_data_cut, thresh=5, axis=2)
 te = time.time()
-print('Min Counting using 4 cores -  Elapsed: {} '.format(round(te-ts,3)))
+print('Vectorized Min Counting -  Elapsed: {} '.format(round(te-ts,3)))
 # print(type(outs))
 # print(outs.shape)
 # print(type(outs[300,300]))